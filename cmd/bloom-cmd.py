@@ -15,8 +15,10 @@ ruin       ruin the specified bloom file (clearing the bitfield)
 f,force    ignore existing bloom file and regenerate it from scratch
 o,output=  output bloom filename (default: auto)
 d,dir=     input directory to look for idx files (default: auto)
-k,hashes=  number of hash functions to use (4 or 5) (default: auto)
+k,hashes=  number of hash functions to use (4 or 5, or 1-7 if blocked) (default: auto)
+blocked    keep all of each object's bits in one 64 byte block
 c,check=   check the given .idx file against the bloom filter
+max-pfalse= percentage of false positives at which to add a generation (default: bup.bloommaxpfalse, or 1)
 """
 
 
@@ -26,8 +28,9 @@ def ruin_bloom(bloomfilename):
         log("%s\n" % bloomfilename)
         add_error("bloom: %s not found to ruin\n" % rbloomfilename)
         return
-    b = bloom.ShaBloom(bloomfilename, readwrite=True, expected=1)
-    b.map[16:16+2**b.bits] = '\0' * 2**b.bits
+    for name in bloom.generations(bloomfilename):
+        b = bloom.ShaBloom(name, readwrite=True, expected=1)
+        b.map[b.table_ofs:b.table_ofs+2**b.bits] = '\0' * 2**b.bits
 
 
 def check_bloom(path, bloomfilename, idx):
@@ -36,33 +39,60 @@ def check_bloom(path, bloomfilename, idx):
     if not os.path.exists(bloomfilename):
         log("bloom: %s: does not exist.\n" % rbloomfilename)
         return
-    b = bloom.ShaBloom(bloomfilename)
-    if not b.valid():
+    gens = bloom.BloomGenerations(bloomfilename)
+    if not gens.valid():
         add_error("bloom: %r is invalid.\n" % rbloomfilename)
         return
     base = os.path.basename(idx)
-    if base not in b.idxnames:
+    log("bloom: bloom file: %s\n" % rbloomfilename)
+    b = None
+    for i, g in enumerate(gens.blooms):
+        log("bloom:   generation %d: %d objects in 2^%d bytes, k=%d%s,"
+            " %.4f%% false positives\n"
+            % (i, len(g), g.bits, g.k, g.blocked and ' blocked' or '',
+               g.pfalse_positive()))
+        if base in g.idxnames:
+            b = g
+    if len(gens.blooms) > 1:
+        log("bloom:   all together: %.4f%% false positives\n"
+            % gens.pfalse_positive())
+    if not b:
         log("bloom: %s does not contain the idx.\n" % rbloomfilename)
         return
     if base == idx:
         idx = os.path.join(path, idx)
-    log("bloom: bloom file: %s\n" % rbloomfilename)
-    log("bloom:   checking %s\n" % ridx)
+    log("bloom:   checking %s in %s\n" % (ridx, git.repo_rel(b.name)))
     for objsha in git.open_idx(idx):
         if not b.exists(objsha):
             add_error("bloom: ERROR: object %s missing" 
                       % str(objsha).encode('hex'))
 
 
-_first = None
-def do_bloom(path, outfilename):
-    global _first
-    b = None
-    if os.path.exists(outfilename) and not opt.force:
-        b = bloom.ShaBloom(outfilename)
+def open_generations(outfilename):
+    gens = []
+    for name in bloom.generations(outfilename):
+        b = bloom.ShaBloom(name)
         if not b.valid():
             debug1("bloom: Existing invalid bloom found, regenerating.\n")
-            b = None
+            return []
+        gens.append(b)
+    return gens
+
+
+_first = None
+def do_bloom(path, outfilename, max_pfalse):
+    global _first
+    gens = []
+    blocked = opt.blocked
+    if not opt.force:
+        gens = open_generations(outfilename)
+    if gens:
+        if gens[0].blocked:
+            blocked = True  # Stick with it
+        elif blocked:
+            debug1("bloom: switching to the blocked layout, regenerating.\n")
+            gens = []
+    covered = set(n for b in gens for n in b.idxnames)
 
     add = []
     rest = []
@@ -72,7 +102,7 @@ def do_bloom(path, outfilename):
         progress('bloom: counting: %d\r' % i)
         ix = git.open_idx(name)
         ixbase = os.path.basename(name)
-        if b and (ixbase in b.idxnames):
+        if ixbase in covered:
             rest.append(name)
             rest_count += len(ix)
         else:
@@ -84,26 +114,41 @@ def do_bloom(path, outfilename):
         debug1("bloom: nothing to do.\n")
         return
 
-    if b:
-        if len(b) != rest_count:
+    # Add to the newest generation while it stays under max_pfalse,
+    # then start a new one, and once there are too many, start over.
+    b = None
+    outname = outfilename
+    if gens:
+        newest = gens[-1]
+        if sum(len(g) for g in gens) != rest_count:
             debug1("bloom: size %d != idx total %d, regenerating\n"
-                   % (len(b), rest_count))
-            b = None
-        elif (b.bits < bloom.MAX_BLOOM_BITS and
-              b.pfalse_positive(add_count) > bloom.MAX_PFALSE_POSITIVE):
-            debug1("bloom: regenerating: adding %d entries gives "
-                   "%.2f%% false positives.\n"
-                   % (add_count, b.pfalse_positive(add_count)))
-            b = None
+                   % (sum(len(g) for g in gens), rest_count))
+            gens = []
+        elif newest.pfalse_positive(add_count) <= max_pfalse:
+            b = bloom.ShaBloom(newest.name, readwrite=True,
+                               expected=add_count)
+        elif len(gens) < bloom.MAX_GENERATIONS:
+            debug1("bloom: adding %d entries gives %.2f%% false positives;"
+                   " starting generation %d.\n"
+                   % (add_count, newest.pfalse_positive(add_count),
+                      len(gens)))
+            outname = bloom.generation_name(outfilename, len(gens))
         else:
-            b = bloom.ShaBloom(outfilename, readwrite=True, expected=add_count)
-    if not b: # Need all idxs to build from scratch
+            debug1("bloom: regenerating: %d generations are full.\n"
+                   % len(gens))
+            gens = []
+    if not gens: # Need all idxs to build from scratch
         add += rest
         add_count += rest_count
     del rest
     del rest_count
 
-    msg = b is None and 'creating from' or 'adding'
+    if b:
+        msg = 'adding'
+    elif gens:
+        msg = 'starting generation %d with' % len(gens)
+    else:
+        msg = 'creating from'
     if not _first: _first = path
     dirprefix = (_first != path) and git.repo_rel(path)+': ' or ''
     progress('bloom: %s%s %d file%s (%d object%s).\n'
@@ -114,7 +159,10 @@ def do_bloom(path, outfilename):
     tfname = None
     if b is None:
         tfname = os.path.join(path, 'bup.tmp.bloom')
-        b = bloom.create(tfname, expected=add_count, k=opt.k)
+        # A new generation is at least as big as the ones before it
+        # together, so that there are only ever a few of them.
+        expected = max(add_count, total - add_count)
+        b = bloom.create(tfname, expected=expected, k=opt.k, blocked=blocked)
     count = 0
     icount = 0
     for name in add:
@@ -130,7 +178,10 @@ def do_bloom(path, outfilename):
     b.close()
 
     if tfname:
-        os.rename(tfname, outfilename)
+        os.rename(tfname, outname)
+        if not gens:
+            for name in bloom.generations(outfilename)[1:]:
+                unlink(name)
 
 
 handle_ctrl_c()
@@ -143,8 +194,20 @@ if extra:
 
 git.check_repo_or_die()
 
-if not opt.check and opt.k and opt.k not in (4,5):
-    o.fatal('only k values of 4 and 5 are supported')
+if not opt.check and opt.k:
+    if opt.blocked and not 1 <= opt.k <= bloom.MAX_BLOCKED_K:
+        o.fatal('only k values from 1 to %d are supported with --blocked'
+                % bloom.MAX_BLOCKED_K)
+    elif not opt.blocked and opt.k not in (4,5):
+        o.fatal('only k values of 4 and 5 are supported')
+
+max_pfalse = opt.max_pfalse or git.git_config_get('bup.bloommaxpfalse')
+try:
+    max_pfalse = float(max_pfalse or bloom.MAX_PFALSE_POSITIVE)
+except ValueError:
+    o.fatal('invalid false positive percentage %r' % max_pfalse)
+if not 0 < max_pfalse < 100:
+    o.fatal('the false positive percentage must be between 0 and 100')
 
 paths = opt.dir and [opt.dir] or git.all_packdirs()
 for path in paths:
@@ -155,7 +218,7 @@ for path in paths:
     elif opt.ruin:
         ruin_bloom(outfilename)
     else:
-        do_bloom(path, outfilename)
+        do_bloom(path, outfilename, max_pfalse)
 
 if saved_errors:
     log('WARNING: %d errors encountered during bloom.\n' % len(saved_errors))
@@ -18,6 +18,7 @@ exclude-from= a file that contains exclude paths (can be used more than once)
 exclude-rx= skip paths matching the unanchored regex (may be repeated)
 exclude-rx-from= skip --exclude-rx patterns in file (may be repeated)
 q,quiet  don't actually print filenames
+j,jobs=  number of threads reading directories [1]
 profile  run under the python profiler
 """
 o = options.Options(optspec)
@@ -25,6 +26,9 @@ o = options.Options(optspec)
 
 if len(extra) != 1:
     o.fatal("exactly one filename expected")
+opt.jobs = int(opt.jobs)
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
 
 drecurse_top = extra[0]
 excluded_paths = parse_excludes(flags, o.fatal)
@@ -33,7 +37,8 @@ if not drecurse_top.startswith('/'):
 exclude_rxs = parse_rx_excludes(flags, o.fatal)
 it = drecurse.recursive_dirlist([drecurse_top], opt.xdev,
                                 excluded_paths=excluded_paths,
-                                exclude_rxs=exclude_rxs)
+                                exclude_rxs=exclude_rxs,
+                                jobs=opt.jobs)
 if opt.profile:
     import cProfile
     def do_it():
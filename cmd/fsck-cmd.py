@@ -130,6 +130,28 @@ def do_pack(base, last, par2_exists):
     return code
 
 
+def check_indexes(bases):
+    """Return the number of objects in the .idx files of the packs with
+    the given bases that can't be found through the index files as a
+    whole (i.e. the .midx and .bloom files, where they're used)."""
+    mi = git.PackIdxList(git.repo('objects/pack'))
+    missing = 0
+    for base in bases:
+        ix = git.open_idx(base + '.idx')
+        shas = list(ix)
+        n = 0
+        for i in xrange(0, len(shas), 100000):
+            batch = shas[i:i+100000]
+            found = mi.exists_many(batch)
+            n += sum(1 for j in xrange(len(batch))
+                     if not bitmap_test(found, j))
+        if n:
+            log('%s: %d objects not found in the index files\n'
+                % (os.path.basename(base), n))
+        missing += n
+    return missing
+
+
 optspec = """
 bup fsck [options...] [filenames...]
 --
@@ -140,6 +162,7 @@ quick       just check pack sha1sum, don't use git verify-pack
 j,jobs=     run 'n' jobs in parallel
 par2-ok     immediately return 0 if par2 is ok, 1 if not
 disable-par2  ignore par2 even if it is available
+indexes     check that the .midx and .bloom files find every object
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -162,6 +185,7 @@ if not extra:
 code = 0
 count = 0
 outstanding = {}
+bases = []
 for name in extra:
     if name.endswith('.pack'):
         base = name[:-5]
@@ -173,6 +197,7 @@ for name in extra:
         base = name
     else:
         raise Exception('%s is not a pack file!' % name)
+    bases.append(base)
     (dir,last) = os.path.split(base)
     par2_exists = os.path.exists(base + '.par2')
     if par2_exists and os.stat(base + '.par2').st_size == 0:
@@ -215,6 +240,11 @@ while len(outstanding):
     if not opt.verbose:
         progress('fsck (%d/%d)\r' % (count, len(extra)))
 
+if opt.indexes:
+    debug('fsck: checking the index files\n')
+    if check_indexes(bases):
+        code = code or 1
+
 if istty2:
     debug('fsck done.           \n')
 sys.exit(code)
@@ -55,7 +55,8 @@ def check_index(reader):
 
 
 def clear_index(indexfile):
-    indexfiles = [indexfile, indexfile + '.meta', indexfile + '.hlink']
+    indexfiles = [indexfile, indexfile + '.meta', indexfile + '.meta.idx',
+                  indexfile + '.hlink', indexfile + '.hlink.log']
     for indexfile in indexfiles:
         path = git.repo(indexfile)
         try:
@@ -89,7 +90,8 @@ def update_index(top, excluded_paths, exclude_rxs):
     for (path,pst) in drecurse.recursive_dirlist([top], xdev=opt.xdev,
                                                  bup_dir=bup_dir,
                                                  excluded_paths=excluded_paths,
-                                                 exclude_rxs=exclude_rxs):
+                                                 exclude_rxs=exclude_rxs,
+                                                 jobs=opt.jobs):
         if opt.verbose>=2 or (opt.verbose==1 and stat.S_ISDIR(pst.st_mode)):
             sys.stdout.write('%s\n' % path)
             sys.stdout.flush()
@@ -109,30 +111,40 @@ def update_index(top, excluded_paths, exclude_rxs):
                     hlinks.del_path(rig.cur.name)
             rig.next()
         if rig.cur and rig.cur.name == path:    # paths that already existed
-            try:
-                meta = metadata.from_path(path, statinfo=pst)
-            except (OSError, IOError) as e:
-                add_error(e)
-                rig.next()
-                continue
-            if not stat.S_ISDIR(rig.cur.mode) and rig.cur.nlink > 1:
-                hlinks.del_path(rig.cur.name)
+            if not opt.full_meta \
+                  and rig.cur.meta_unchanged(pst,
+                                             check_device=opt.check_device):
+                # Nothing that's stored in the metadata can have
+                # changed without changing the ctime, so don't bother
+                # reading the ACLs, xattrs, etc. again.
+                meta_ofs = rig.cur.meta_ofs
+            else:
+                try:
+                    meta = metadata.from_path(path, statinfo=pst)
+                except (OSError, IOError) as e:
+                    add_error(e)
+                    rig.next()
+                    continue
+                # Clear these so they don't bloat the store -- they're
+                # already in the index (since they vary a lot and
+                # they're fixed length).  If you've noticed "tmax", you
+                # might wonder why it's OK to do this, since that code
+                # may adjust (mangle) the index mtime and ctime --
+                # producing fake values which must not end up in a
+                # .bupm.  However, it looks like that shouldn't be
+                # possible:  (1) When "save" validates the index entry,
+                # it always reads the metadata from the filesytem. (2)
+                # Metadata is only read/used from the index if
+                # hashvalid is true. (3) index always invalidates
+                # "faked" entries, because "old != new" in from_stat().
+                meta.ctime = meta.mtime = meta.atime = 0
+                meta_ofs = msw.store(meta)
+            # Only record what changed (add_path() moves the path if
+            # it's now a link to something else).
             if not stat.S_ISDIR(pst.st_mode) and pst.st_nlink > 1:
                 hlinks.add_path(path, pst.st_dev, pst.st_ino)
-            # Clear these so they don't bloat the store -- they're
-            # already in the index (since they vary a lot and they're
-            # fixed length).  If you've noticed "tmax", you might
-            # wonder why it's OK to do this, since that code may
-            # adjust (mangle) the index mtime and ctime -- producing
-            # fake values which must not end up in a .bupm.  However,
-            # it looks like that shouldn't be possible:  (1) When
-            # "save" validates the index entry, it always reads the
-            # metadata from the filesytem. (2) Metadata is only
-            # read/used from the index if hashvalid is true. (3) index
-            # always invalidates "faked" entries, because "old != new"
-            # in from_stat().
-            meta.ctime = meta.mtime = meta.atime = 0
-            meta_ofs = msw.store(meta)
+            elif not stat.S_ISDIR(rig.cur.mode) and rig.cur.nlink > 1:
+                hlinks.del_path(rig.cur.name)
             rig.cur.from_stat(pst, meta_ofs, tstart,
                               check_device=opt.check_device)
             if not (rig.cur.flags & index.IX_HASHVALID):
@@ -152,7 +164,7 @@ def update_index(top, excluded_paths, exclude_rxs):
             # See same assignment to 0, above, for rationale.
             meta.atime = meta.mtime = meta.ctime = 0
             meta_ofs = msw.store(meta)
-            wi.add(path, pst, meta_ofs, hashgen = hashgen)
+            wi.add(path, pst, meta_ofs, hashgen = hashgen, tstart = tstart)
             if not stat.S_ISDIR(pst.st_mode) and pst.st_nlink > 1:
                 hlinks.add_path(path, pst.st_dev, pst.st_ino)
 
@@ -190,7 +202,7 @@ def update_index(top, excluded_paths, exclude_rxs):
 
 
 optspec = """
-bup index <-p|-m|-s|-u|--clear|--check> [options...] <filenames...>
+bup index <-p|-m|-s|-u|--clear|--check|--compact-meta> [options...] <filenames...>
 --
  Modes:
 p,print    print the index entries for the given names (also works with -u)
@@ -199,10 +211,12 @@ s,status   print each filename with a status char (A/M/D) (implies -p)
 u,update   recursively update the index entries for the given file/dir names (default if no mode is specified)
 check      carefully check index file integrity
 clear      clear the default index
+compact-meta  drop unused metadata records from the index's metadata store
  Options:
 H,hash     print the hash for each object next to its name
 l,long     print more information about each file
 no-check-device don't invalidate an entry if the containing device changes
+full-meta  re-read the metadata of paths whose stat hasn't changed too
 fake-valid mark all index entries as up-to-date even if they aren't
 fake-invalid mark all index entries as invalid
 f,indexfile=  the name of the index file (normally BUP_DIR/bupindex)
@@ -212,6 +226,7 @@ exclude-rx= skip paths matching the unanchored regex (may be repeated)
 exclude-rx-from= skip --exclude-rx patterns in file (may be repeated)
 v,verbose  increase log output (can be used more than once)
 x,xdev,one-file-system  don't cross filesystem boundaries
+j,jobs=    number of threads reading directories ahead of the update [1]
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -221,7 +236,8 @@ if not (opt.modified or \
         opt.status or \
         opt.update or \
         opt.check or \
-        opt.clear):
+        opt.clear or \
+        opt.compact_meta):
     opt.update = 1
 if (opt.fake_valid or opt.fake_invalid) and not opt.update:
     o.fatal('--fake-{in,}valid are meaningless without -u')
@@ -229,6 +245,9 @@ if opt.fake_valid and opt.fake_invalid:
     o.fatal('--fake-valid is incompatible with --fake-invalid')
 if opt.clear and opt.indexfile:
     o.fatal('cannot clear an external index (via -f)')
+opt.jobs = int(opt.jobs)
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
 
 # FIXME: remove this once we account for timestamp races, i.e. index;
 # touch new-file; index.  It's possible for this to happen quickly
@@ -242,6 +261,9 @@ indexfile = opt.indexfile or git.repo('bupindex')
 
 handle_ctrl_c()
 
+if index.recover_compaction(indexfile):
+    log('index: recovered from an interrupted --compact-meta\n')
+
 if opt.check:
     log('check: starting initial check.\n')
     check_index(index.Reader(indexfile))
@@ -260,6 +282,10 @@ if opt.update:
     for (rp,path) in paths:
         update_index(rp, excluded_paths, exclude_rxs)
 
+if opt.compact_meta:
+    (old_size, new_size) = index.compact_metastore(indexfile)
+    log('compact-meta: %d -> %d bytes\n' % (old_size, new_size))
+
 if opt['print'] or opt.status or opt.modified:
     for (name, ent) in index.Reader(indexfile).filter(extra or ['']):
         if (opt.modified 
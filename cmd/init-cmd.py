@@ -4,9 +4,9 @@ bup_python="$(dirname "$0")/bup-python" || exit $?
 exec "$bup_python" "$0" ${1+"$@"}
 """
 # end of bup preamble
-import sys
+import glob, sys
 
-from bup import git, options, client
+from bup import git, hashsplit, options, client
 from bup.helpers import *
 
 
@@ -14,12 +14,17 @@ optspec = """
 [BUP_DIR=...] bup init [-r host:path]
 --
 r,remote=  remote repository path
+chunker=   how to split files into blobs (bupsplit or fastcdc)
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
 
 if extra:
     o.fatal("no arguments expected")
+if opt.chunker and opt.chunker not in hashsplit.chunkers:
+    o.fatal('unknown chunker %r' % opt.chunker)
+if opt.chunker and opt.remote:
+    o.fatal('--chunker can only be set when initializing a local repository')
 
 
 try:
@@ -28,6 +33,13 @@ except git.GitError as e:
     log("bup: error: could not init repository: %s" % e)
     sys.exit(1)
 
+if opt.chunker:
+    chunker = git.git_config_get('bup.chunker') or 'bupsplit'
+    if opt.chunker != chunker and glob.glob(git.repo('objects/pack/*.pack')):
+        log('bup: error: repository already uses the %s chunker\n' % chunker)
+        sys.exit(1)
+    git.git_config_set('bup.chunker', opt.chunker)
+
 if opt.remote:
     git.check_repo_or_die()
     cli = client.Client(opt.remote, create=True)
@@ -5,6 +5,7 @@ exec "$bup_python" "$0" ${1+"$@"}
 """
 # end of bup preamble
 import sys, re, struct, time, resource
+from itertools import islice
 from bup import git, bloom, midx, options, _helpers
 from bup.helpers import *
 
@@ -70,6 +71,8 @@ n,number=  number of objects per cycle [10000]
 c,cycles=  number of cycles to run [100]
 ignore-midx  ignore .midx files, use only .idx files
 existing   test with existing objects instead of fake ones
+read       time reading the first n objects in and out of process, and exit
+batch=     look objects up in batches of this many (see exists_many) [0]
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -82,6 +85,22 @@ git.ignore_midx = opt.ignore_midx
 git.check_repo_or_die()
 m = git.PackIdxList(git.repo('objects/pack'))
 
+if opt.read:
+    ids = [str(bin).encode('hex') for bin in islice(m, opt.number)]
+    for use_pack_reader in (False, True):
+        git.use_pack_reader = use_pack_reader
+        cp = git.CatPipe()
+        start = time.time()
+        nbytes = 0
+        for id in ids:
+            for blob in cp.get(id):
+                nbytes += len(blob)
+        secs = time.time() - start
+        print ('%s: %d objects (%d bytes) in %.3fs: %.0f objects/s'
+               % (use_pack_reader and 'pack reader' or 'git cat-file',
+                  len(ids), nbytes, secs, len(ids) / max(secs, 1e-6)))
+    sys.exit(0)
+
 report(-1)
 _helpers.random_sha()
 report(0)
@@ -93,19 +112,29 @@ if opt.existing:
                 yield e
     objit = iter(foreverit(m))
     
+lookups = 0
+lookup_secs = 0.0
 for c in xrange(opt.cycles):
-    for n in xrange(opt.number):
-        if opt.existing:
-            bin = objit.next()
-            assert(m.exists(bin))
-        else:
-            bin = _helpers.random_sha()
-
-            # technically, a randomly generated object id might exist.
-            # but the likelihood of that is the likelihood of finding
-            # a collision in sha-1 by accident, which is so unlikely that
-            # we don't care.
-            assert(not m.exists(bin))
+    if opt.existing:
+        bins = list(islice(objit, opt.number))
+    else:
+        # technically, a randomly generated object id might exist.
+        # but the likelihood of that is the likelihood of finding
+        # a collision in sha-1 by accident, which is so unlikely that
+        # we don't care.
+        bins = [_helpers.random_sha() for n in xrange(opt.number)]
+    lookup_start = time.time()
+    if opt.batch:
+        for i in xrange(0, len(bins), opt.batch):
+            batch = bins[i:i+opt.batch]
+            found = m.exists_many(batch)
+            for j in xrange(len(batch)):
+                assert(bool(bitmap_test(found, j)) == bool(opt.existing))
+    else:
+        for bin in bins:
+            assert(bool(m.exists(bin)) == bool(opt.existing))
+    lookup_secs += time.time() - lookup_start
+    lookups += len(bins)
     report((c+1)*opt.number)
 
 if bloom._total_searches:
@@ -120,4 +149,8 @@ if git._total_searches:
     print ('idx: %d objects searched in %d steps: avg %.3f steps/object' 
            % (git._total_searches, git._total_steps,
               git._total_steps*1.0/git._total_searches))
+if lookups:
+    print ('lookups: %d in %.3fs: %.0f lookups/s, %.0f ns/lookup'
+           % (lookups, lookup_secs, lookups / max(lookup_secs, 1e-6),
+              lookup_secs * 1e9 / lookups))
 print 'Total time: %.3fs' % (time.time() - start)
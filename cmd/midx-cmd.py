@@ -12,6 +12,14 @@ from bup.helpers import *
 PAGE_SIZE=4096
 SHA_PER_PAGE=PAGE_SIZE/20.
 
+# With --auto, the indexes are sorted into tiers by size, each
+# TIER_FANOUT times bigger than the one below, and a tier is only merged
+# once it has TIER_FANOUT indexes in it.  So each object gets rewritten
+# about once per tier, rather than every time a pack is added.  All the
+# indexes smaller than TIER_MIN_SIZE objects share the bottom tier.
+TIER_FANOUT = 4
+TIER_MIN_SIZE = 1024
+
 optspec = """
 bup midx [options...] <idxnames...>
 --
@@ -22,6 +30,7 @@ p,print    print names of generated midx files
 check      validate contents of the given midx files (with -a, all midx files)
 max-files= maximum number of idx files to open at once [-1]
 d,dir=     directory containing idx/midx files
+format=    midx version to write: 5 records each object's pack offset [5]
 """
 
 merge_into = _helpers.merge_into
@@ -60,10 +69,16 @@ def check_midx(name):
                 add_error("%s: %s: %s missing from idx"
                           % (nicename, git.shorten_hash(subname),
                              str(e).encode('hex')))
-            if not ix.exists(e):
+            found = ix.find(e)
+            if not found:
                 add_error("%s: %s: %s missing from midx"
                           % (nicename, git.shorten_hash(subname),
                              str(e).encode('hex')))
+            elif ix.has_offsets() \
+                 and found != (subname, sub.find_offset(e)):
+                add_error("%s: %s: %s has the wrong pack or offset in midx"
+                          % (nicename, git.shorten_hash(subname),
+                             str(e).encode('hex')))
     prev = None
     for ecount,e in enumerate(ix):
         if not (ecount % 1234):
@@ -75,9 +90,44 @@ def check_midx(name):
         prev = e
 
 
+def _merge_source(ix, name_base):
+    """Return the description of ix that merge_into() wants."""
+    if isinstance(ix, git.PackIdxV1):
+        # Each entry is a 32-bit offset followed by the sha.
+        return (ix.map, len(ix), ix.sha_ofs + 4, 24, 0, name_base,
+                ix.sha_ofs, 24, 0)
+    elif isinstance(ix, git.PackIdxV2):
+        return (ix.map, len(ix), ix.sha_ofs, 20, 0, name_base,
+                ix.ofs_ofs, 4, ix.ofs64_ofs)
+    else:
+        return (ix.map, len(ix), ix.sha_ofs, 20, ix.which_ofs, name_base,
+                ix.ofs_ofs, 4, ix.ofs64_ofs)
+
+
+def _with_offsets(infilenames):
+    """Return infilenames, with any midx files that don't record the
+    pack offsets of their objects replaced by the idx files they were
+    made from."""
+    result = []
+    for name in infilenames:
+        if name.endswith('.midx'):
+            mx = midx.PackMidx(name)
+            try:
+                if not mx.has_offsets():
+                    dir = os.path.dirname(name)
+                    result += [os.path.join(dir, n) for n in mx.idxnames]
+                    continue
+            finally:
+                mx.close()
+        result.append(name)
+    return result
+
+
 _first = None
 def _do_midx(outdir, outfilename, infilenames, prefixstr):
     global _first
+    if opt.format >= 5:
+        infilenames = _with_offsets(infilenames)
     if not outfilename:
         assert(outdir)
         sum = Sha1('\0'.join(infilenames)).hexdigest()
@@ -91,13 +141,7 @@ def _do_midx(outdir, outfilename, infilenames, prefixstr):
         for name in infilenames:
             ix = git.open_idx(name)
             midxs.append(ix)
-            inp.append((
-                ix.map,
-                len(ix),
-                ix.sha_ofs,
-                isinstance(ix, midx.PackMidx) and ix.which_ofs or 0,
-                len(allfilenames),
-            ))
+            inp.append(_merge_source(ix, len(allfilenames)))
             for n in ix.idxnames:
                 allfilenames.append(os.path.basename(n))
             total += len(ix)
@@ -118,20 +162,31 @@ def _do_midx(outdir, outfilename, infilenames, prefixstr):
         entries = 2**bits
         debug1('midx: table size: %d (%d bits)\n' % (entries*4, bits))
 
+        size = 12 + 4*entries + 20*total + 4*total
+        if opt.format >= 5:
+            # The 32-bit offsets, the number of 64-bit ones, and room
+            # for all of them to be 64-bit, which is cut off below.
+            size += 4*total + 4 + 8*total
+
         unlink(outfilename)
         with atomically_replaced_file(outfilename, 'wb') as f:
             f.write('MIDX')
-            f.write(struct.pack('!II', midx.MIDX_VERSION, bits))
+            f.write(struct.pack('!II', opt.format, bits))
             assert(f.tell() == 12)
 
-            f.truncate(12 + 4*entries + 20*total + 4*total)
+            f.truncate(size)
             f.flush()
             fdatasync(f.fileno())
 
             fmap = mmap_readwrite(f, close=False)
 
-            count = merge_into(fmap, bits, total, inp)
+            count = merge_into(fmap, bits, total, inp, opt.format)
+            if opt.format >= 5:
+                ofs64_count = _helpers.firstword(fmap[size - 8*total - 4
+                                                      : size - 8*total])
+                size -= 8 * (total - ofs64_count)
             del fmap # Assume this calls msync() now.
+            f.truncate(size)
             f.seek(0, os.SEEK_END)
             f.write('\0'.join(allfilenames))
     finally:
@@ -198,23 +253,16 @@ def do_midx_dir(path, outfilename):
         sizes[iname] = len(i)
 
     all = [(sizes[n],n) for n in (midxs + idxs)]
-    
-    # FIXME: what are the optimal values?  Does this make sense?
-    DESIRED_HWM = opt.force and 1 or 5
-    DESIRED_LWM = opt.force and 1 or 2
     existed = dict((name,1) for sz,name in all)
-    debug1('midx: %d indexes; want no more than %d.\n' 
-           % (len(all), DESIRED_HWM))
-    if len(all) <= DESIRED_HWM:
-        debug1('midx: nothing to do.\n')
-    while len(all) > DESIRED_HWM:
-        all.sort()
-        part1 = [name for sz,name in all[:len(all)-DESIRED_LWM+1]]
-        part2 = all[len(all)-DESIRED_LWM+1:]
-        all = list(do_midx_group(path, outfilename, part1)) + part2
-        if len(all) > DESIRED_HWM:
-            debug1('\nStill too many indexes (%d > %d).  Merging again.\n'
-                   % (len(all), DESIRED_HWM))
+    if opt.force:
+        debug1('midx: %d indexes; want 1.\n' % len(all))
+        if len(all) > 1:
+            all = list(do_midx_group(path, outfilename,
+                                     [name for sz,name in all]))
+        else:
+            debug1('midx: nothing to do.\n')
+    else:
+        all = merge_tiers(path, outfilename, all)
 
     if opt['print']:
         for sz,name in all:
@@ -222,6 +270,37 @@ def do_midx_dir(path, outfilename):
                 print name
 
 
+def tier(size):
+    t = 0
+    size //= TIER_MIN_SIZE
+    while size >= TIER_FANOUT:
+        size //= TIER_FANOUT
+        t += 1
+    return t
+
+
+def merge_tiers(path, outfilename, all):
+    """Merge the (size, name) indexes in all a tier at a time, smallest
+    first, until no tier is full, and return the indexes left."""
+    while True:
+        tiers = {}
+        for sz,name in all:
+            tiers.setdefault(tier(sz), []).append((sz,name))
+        full = [t for t in sorted(tiers) if len(tiers[t]) >= TIER_FANOUT]
+        if not full:
+            debug1('midx: %d indexes in %d tiers; nothing to do.\n'
+                   % (len(all), len(tiers)))
+            return all
+        part = tiers[full[0]][:opt.max_files]
+        debug1('midx: merging %d indexes in tier %d.\n'
+               % (len(part), full[0]))
+        merged = list(do_midx_group(path, outfilename,
+                                    [name for sz,name in part]))
+        if not merged:
+            return all  # too small to bother with
+        all = [x for x in all if x not in part] + merged
+
+
 def do_midx_group(outdir, outfilename, infiles):
     groups = list(_group(infiles, opt.max_files))
     gprefix = ''
@@ -248,6 +327,9 @@ git.check_repo_or_die()
 if opt.max_files < 0:
     opt.max_files = max_files()
 assert(opt.max_files >= 5)
+if not midx.MIN_MIDX_VERSION <= opt.format <= midx.MIDX_VERSION:
+    o.fatal('--format must be between %d and %d'
+            % (midx.MIN_MIDX_VERSION, midx.MIDX_VERSION))
 
 if opt.check:
     # check existing midx files
@@ -0,0 +1,207 @@
+#!/bin/sh
+"""": # -*-python-*-
+bup_python="$(dirname "$0")/bup-python" || exit $?
+exec "$bup_python" "$0" ${1+"$@"}
+"""
+# end of bup preamble
+import sys, glob, struct, zlib
+from bup import options, git, midx, bloom, path
+from bup.helpers import *
+
+optspec = """
+bup repack [options...]
+--
+s,smaller-than=  repack the packs smaller than this (default: an eighth of max-pack-size)
+max-pack-size=  maximum bytes in a single new pack
+max-pack-objects=  maximum number of objects in a single new pack
+#,compress=  recompress the objects at this level (0-9), rather than copying them as they are
+n,dry-run  just list the packs that would be repacked
+"""
+
+
+class NewPacks:
+    """The objcache for the PackWriter: just the packs it has written,
+    so that an object in more than one of the old packs is only copied
+    once."""
+    def __init__(self):
+        self.names = []
+        self.idxs = []
+
+    def exists(self, sha, want_source=False):
+        for ix in self.idxs:
+            if ix.exists(sha):
+                return True
+        return None
+
+    def add_idx(self, filename):
+        self.names.append(filename[:-4])
+        self.idxs.insert(0, git.open_idx(filename))
+
+    def refresh_if_changed(self):
+        pass
+
+
+def small_packs(packdir, limit):
+    """Return the names of the .idx files in packdir whose packs are
+    smaller than limit, oldest first, leaving out any that git has
+    been told to keep."""
+    found = []
+    for name in glob.glob(os.path.join(packdir, '*.idx')):
+        if os.path.exists(name[:-4] + '.keep'):
+            continue  # As for git repack
+        try:
+            st = os.stat(name[:-4] + '.pack')
+        except OSError as e:
+            add_error('repack: %s: %s' % (git.repo_rel(name), e))
+            continue
+        if st.st_size < limit:
+            found.append((st.st_mtime, name))
+    return [name for mtime, name in sorted(found)]
+
+
+def copy_pack(w, reader, idxname):
+    """Write each object in the pack for idxname that w doesn't have
+    yet, in the order they're in the pack, and return the number
+    copied."""
+    ix = git.open_idx(idxname)
+    packname = idxname[:-4] + '.pack'
+    with open(packname, 'rb') as f:
+        map = mmap_read(f)
+    n = len(ix)
+    objs = sorted((ix._ofs_from_idx(i), i) for i in xrange(n))
+    ends = [ofs for ofs, i in objs[1:]] + [len(map) - 20]
+    crcs = None
+    if isinstance(ix, git.PackIdxV2):
+        crcs = buffer(ix.map, ix.sha_ofs + 20 * n, 4 * n)
+    copied = 0
+    for (ofs, i), end in zip(objs, ends):
+        sha = ix._idx_to_hash(i)
+        if w.exists(sha):
+            continue
+        type = git._pack_obj_header(map, ofs)[0]
+        if type in git._typermap and opt.compress is None:
+            data = map[ofs:end]
+            if crcs and zlib.crc32(data) & 0xffffffff \
+               != struct.unpack('!I', crcs[4*i:4*i+4])[0]:
+                raise git.GitError('%s: object %s is corrupt'
+                                   % (git.repo_rel(packname),
+                                      sha.encode('hex')))
+            w.copy_raw(sha, data)
+        else:
+            # A delta has to be applied to its base, which might not be
+            # in the new pack, or the caller asked for recompression.
+            type, content = reader.get(sha)
+            w.maybe_write(type, content, sha=sha)
+        copied += 1
+    map.close()
+    return copied
+
+
+def sync_packs(packdir, nameprefixes):
+    for prefix in nameprefixes:
+        for name in (prefix + '.pack', prefix + '.idx'):
+            with open(name, 'rb') as f:
+                os.fsync(f.fileno())
+    fd = os.open(packdir, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def remove_packs(packdir, idxnames, newnames):
+    """Remove the packs for idxnames, which the packs for newnames
+    replace, while no one else is changing the directory.  The .midx
+    files that refer to any of them are replaced, and they're removed
+    from the bloom filter, before the packs go, so that neither has to
+    be rebuilt from scratch."""
+    old = dict((os.path.basename(n), len(git.open_idx(n))) for n in idxnames)
+    with git.lock_packdir(packdir):
+        stale = []
+        covered = set(newnames)
+        for name in glob.glob(os.path.join(packdir, '*.midx')):
+            mx = midx.PackMidx(name)
+            if any(n in old for n in mx.idxnames):
+                stale.append(name)
+                covered.update(os.path.join(packdir, n) for n in mx.idxnames
+                               if n not in old)
+            mx.close()
+        if stale and len(covered) > 1:
+            git._run_maintenance([path.exe(), 'midx'] + sorted(covered))
+        for name in stale:
+            debug1('repack: removing %s\n' % os.path.basename(name))
+            unlink(name)
+        # The indexes first, so that no one goes looking in the packs
+        for name in idxnames:
+            unlink(name)
+        bloom.remove_idxnames(os.path.join(packdir, 'bup.bloom'), old)
+        git._update_midx(packdir, have_lock=True)
+        for name in idxnames:
+            # Then the pack and anything else that goes with it (par2
+            # files from fsck, or git's .bitmap).
+            for p in glob.glob(name[:-4] + '.*'):
+                unlink(p)
+
+
+handle_ctrl_c()
+
+o = options.Options(optspec)
+(opt, flags, extra) = o.parse(sys.argv[1:])
+
+if extra:
+    o.fatal('no positional parameters expected')
+if opt.compress is not None and not 0 <= opt.compress <= 9:
+    o.fatal('--compress must be between 0 and 9')
+
+git.check_repo_or_die()
+
+if opt.max_pack_size:
+    git.max_pack_size = parse_num(opt.max_pack_size)
+if opt.max_pack_objects:
+    git.max_pack_objects = parse_num(opt.max_pack_objects)
+if opt.smaller_than:
+    limit = parse_num(opt.smaller_than)
+else:
+    limit = git.max_pack_size // 8
+
+packdir = git.repo('objects/pack')
+old = small_packs(packdir, limit)
+if opt.dry_run:
+    for name in old:
+        print name[:-4] + '.pack'
+elif len(old) < 2:
+    log('repack: %d pack%s smaller than %d bytes; nothing to do.\n'
+        % (len(old), len(old) != 1 and 's' or '', limit))
+else:
+    level = opt.compress
+    if level is None:
+        level = 1
+    newpacks = NewPacks()
+    w = git.PackWriter(objcache_maker=lambda: newpacks,
+                       compression_level=level)
+    reader = git.PackReader(packdir)
+    total = 0
+    try:
+        for i, name in enumerate(old):
+            qprogress('repack: reading packs: %d/%d, %d objects\r'
+                      % (i, len(old), total))
+            total += copy_pack(w, reader, name)
+    except:
+        w.abort()
+        raise
+    last = w.close(run_midx=False)
+    if last:
+        newpacks.names.append(last)
+    sync_packs(packdir, newpacks.names)
+    progress('repack: wrote %d objects from %d packs into %d.\n'
+             % (total, len(old), len(newpacks.names)))
+
+    new = [p + '.idx' for p in newpacks.names]
+    names = set(os.path.basename(n) for n in new)
+    remove_packs(packdir, [n for n in old if os.path.basename(n) not in names],
+                 new)
+
+if saved_errors:
+    log('WARNING: %d errors encountered while repacking.\n'
+        % len(saved_errors))
+    sys.exit(1)
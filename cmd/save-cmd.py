@@ -7,8 +7,10 @@ exec "$bup_python" "$0" ${1+"$@"}
 import sys, stat, time, math
 from errno import EACCES
 from io import BytesIO
+from itertools import islice
 
 from bup import hashsplit, git, options, index, client, metadata, hlinkdb
+from bup import chunkmap, stats
 from bup.helpers import *
 from bup.hashsplit import GIT_MODE_TREE, GIT_MODE_FILE, GIT_MODE_SYMLINK
 
@@ -30,6 +32,9 @@ strip      strips the path to every filename given
 strip-path= path-prefix to be stripped when saving
 graft=     a graft point *old_path*=*new_path* (can be used more than once)
 #,compress=  set compression level to # (0-9, 9 is highest) [1]
+j,jobs=    number of threads for hashing and compressing file data [1]
+chunk-maps=  remember how files of at least this size were split (see docs)
+stats-json=  write per-phase timings and counters as JSON to this file
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -42,8 +47,15 @@ if not extra:
 
 opt.progress = (istty2 and not opt.quiet)
 opt.smaller = parse_num(opt.smaller or 0)
+opt.jobs = int(opt.jobs)
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
+if opt.jobs > 1:
+    hashsplit.readahead = 4
 if opt.bwlimit:
     client.bwlimit = parse_num(opt.bwlimit)
+if opt.stats_json:
+    stats.enable()
 
 if opt.date:
     date = parse_date_or_fatal(opt.date, o.fatal)
@@ -53,6 +65,12 @@ else:
 if opt.strip and opt.strip_path:
     o.fatal("--strip is incompatible with --strip-path")
 
+if opt.chunk_maps:
+    try:
+        chunkmap.check_available()
+    except chunkmap.Unavailable as e:
+        o.fatal('--chunk-maps: %s' % e)
+
 graft_points = []
 if opt.graft:
     if opt.strip:
@@ -86,11 +104,17 @@ if opt.remote or is_reverse:
         log('error: %s' % e)
         sys.exit(1)
     oldref = refname and cli.read_ref(refname) or None
-    w = cli.new_packwriter(compression_level=opt.compress)
+    w = cli.new_packwriter(compression_level=opt.compress, jobs=opt.jobs)
 else:
     cli = None
     oldref = refname and git.read_ref(refname) or None
-    w = git.PackWriter(compression_level=opt.compress)
+    w = git.PackWriter(compression_level=opt.compress, jobs=opt.jobs)
+
+try:
+    hashsplit.configure(cli and cli.config_get or git.git_config_get)
+except ValueError as e:
+    log('error: %s\n' % e)
+    sys.exit(1)
 
 handle_ctrl_c()
 
@@ -211,6 +235,8 @@ def progress_report(n):
 
 
 indexfile = opt.indexfile or git.repo('bupindex')
+if index.recover_compaction(indexfile):
+    log('save: recovered from an interrupted "bup index --compact-meta"\n')
 r = index.Reader(indexfile)
 try:
     msr = index.MetaStoreReader(indexfile + '.meta')
@@ -220,9 +246,36 @@ except IOError as ex:
     log('error: cannot access %r; have you run bup index?' % indexfile)
     sys.exit(1)
 hlink_db = hlinkdb.HLinkDB(indexfile + '.hlink')
+chunk_maps = None
+if opt.chunk_maps:
+    chunk_maps = chunkmap.ChunkMaps(indexfile + '.chunks',
+                                    parse_num(opt.chunk_maps))
+
+# The shas of the valid entries in the current batch of the index that
+# are already in the repository (see prefetch_saved()).
+saved_shas = set()
+
+def prefetch_saved(entries, batch=1024):
+    """Yield the (transname, ent) pairs from entries, first looking up
+    the shas of each batch of them in the repository all at once."""
+    global saved_shas
+    entries = iter(entries)
+    while 1:
+        b = list(islice(entries, batch))
+        if not b:
+            break
+        shas = [ent.sha for transname, ent in b if ent.is_valid()]
+        found = w.exists_many(shas)
+        saved_shas = set(sha for i, sha in enumerate(shas)
+                         if bitmap_test(found, i))
+        for x in b:
+            yield x
 
 def already_saved(ent):
-    return ent.is_valid() and w.exists(ent.sha) and ent.sha
+    # Entries outside the batch, and objects written since it was
+    # looked up, fall back to a single lookup.
+    return (ent.is_valid() and (ent.sha in saved_shas or w.exists(ent.sha))
+            and ent.sha)
 
 def wantrecurse_pre(ent):
     return not already_saved(ent)
@@ -238,7 +291,8 @@ def find_hardlink_target(hlink_db, ent):
 
 total = ftotal = 0
 if opt.progress:
-    for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_pre):
+    for (transname,ent) in prefetch_saved(
+            r.filter(extra, wantrecurse=wantrecurse_pre)):
         if not (ftotal % 10024):
             qprogress('Reading index: %d\r' % ftotal)
         exists = ent.exists()
@@ -268,7 +322,8 @@ tstart = time.time()
 count = subcount = fcount = 0
 lastskip_name = None
 lastdir = ''
-for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
+for (transname,ent) in prefetch_saved(
+        r.filter(extra, wantrecurse=wantrecurse_during)):
     (dir, file) = os.path.split(ent.name)
     exists = (ent.flags & index.IX_EXISTS)
     hashvalid = already_saved(ent)
@@ -387,12 +442,23 @@ for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
                 lastskip_name = ent.name
             else:
                 try:
-                    (mode, id) = hashsplit.split_to_blob_or_tree(
-                                            w.new_blob, w.new_tree, [f],
-                                            keep_boundaries=False)
+                    if chunk_maps:
+                        (mode, id) = chunk_maps.split_to_blob_or_tree(
+                                                w.new_blob, w.new_tree, f,
+                                                ent.name, w.exists,
+                                                makeblobs=w.new_blobs)
+                    else:
+                        (mode, id) = hashsplit.split_to_blob_or_tree(
+                                                w.new_blob, w.new_tree, [f],
+                                                keep_boundaries=False,
+                                                makeblobs=w.new_blobs)
                 except (IOError, OSError) as e:
                     add_error('%s: %s' % (ent.name, e))
                     lastskip_name = ent.name
+                except chunkmap.Unavailable as e:
+                    w.abort()
+                    log('error: --chunk-maps: %s\n' % e)
+                    sys.exit(1)
         else:
             if stat.S_ISDIR(ent.mode):
                 assert(0)  # handled above
@@ -456,6 +522,12 @@ if opt.commit or opt.name:
 
 msr.close()
 w.close()  # must close before we can update the ref
+
+if chunk_maps:
+    chunk_maps.prune()
+    if opt.verbose and chunk_maps.bytes_total:
+        log('Read %d of %d bytes in files with chunk maps.\n'
+            % (chunk_maps.bytes_read, chunk_maps.bytes_total))
         
 if opt.name:
     if cli:
@@ -466,6 +538,10 @@ if opt.name:
 if cli:
     cli.close()
 
+if opt.stats_json:
+    stats.write_json(opt.stats_json, command='save', bytes=count,
+                     files=fcount, errors=len(saved_errors))
+
 if saved_errors:
     log('WARNING: %d errors encountered while saving.\n' % len(saved_errors))
     sys.exit(1)
@@ -81,51 +81,89 @@ def receive_objects_v2(conn, junk):
         else:
             w = git.PackWriter()
     while 1:
-        ns = conn.read(4)
-        if not ns:
-            w.abort()
-            raise Exception('object read: expected length header, got EOF\n')
-        n = struct.unpack('!I', ns)[0]
-        #debug2('expecting %d bytes\n' % n)
-        if not n:
+        objs, end = _read_objects(conn, w)
+        if objs:
+            _receive_objects(conn, w, objs, suggested)
+        if end == 0:
             debug1('bup server: received %d object%s.\n' 
                 % (w.count, w.count!=1 and "s" or ''))
-            fullpath = w.close(run_midx=not dumb_server_mode)
+            fullpath = w.close(run_midx=False)
             if fullpath:
                 (dir, name) = os.path.split(fullpath)
                 conn.write('%s.idx\n' % name)
             conn.ok()
+            # The client doesn't need to wait for this.
+            if fullpath and not dumb_server_mode:
+                git.auto_midx(git.repo('objects/pack'), wait=False)
             return
-        elif n == 0xffffffff:
+        elif end == 0xffffffff:
             debug2('bup server: receive-objects suspended.\n')
             suspended_w = w
             conn.ok()
             return
-            
+    # NOTREACHED
+
+
+# The most objects to look up in the repository at once.
+max_object_batch = 256
+
+def _read_objects(conn, w):
+    """Read the (sha, crc, data) of as many objects as the client has
+    already sent, up to max_object_batch, and return them along with
+    the end of stream marker (0 or 0xffffffff) if it was reached."""
+    objs = []
+    while len(objs) < max_object_batch:
+        ns = conn.read(4)
+        if not ns:
+            w.abort()
+            raise Exception('object read: expected length header, got EOF\n')
+        n = struct.unpack('!I', ns)[0]
+        #debug2('expecting %d bytes\n' % n)
+        if not n or n == 0xffffffff:
+            return objs, n
         shar = conn.read(20)
         crcr = struct.unpack('!I', conn.read(4))[0]
         n -= 20 + 4
         buf = conn.read(n)  # object sizes in bup are reasonably small
         #debug2('read %d bytes\n' % n)
         _check(w, n, len(buf), 'object read: expected %d bytes, got %d\n')
+        objs.append((shar, crcr, buf))
+        if not conn.has_input():
+            break
+    return objs, None
+
+
+def _receive_objects(conn, w, objs, suggested):
+    """Write the objects that aren't in the repository yet, and suggest
+    the indexes of the ones that are to the client."""
+    if not dumb_server_mode:
+        # Look them all up at once, and then only the ones that exist
+        # again, to find out where they are.
+        known = w.exists_many([sha for sha, crc, buf in objs])
+        written = set()
+    for i, (shar, crcr, buf) in enumerate(objs):
         if not dumb_server_mode:
-            oldpack = w.exists(shar, want_source=True)
-            if oldpack:
-                assert(not oldpack == True)
-                assert(oldpack.endswith('.idx'))
-                (dir,name) = os.path.split(oldpack)
-                if not (name in suggested):
-                    debug1("bup server: suggesting index %s\n"
-                           % git.shorten_hash(name))
-                    debug1("bup server:   because of object %s\n"
-                           % shar.encode('hex'))
-                    conn.write('index %s\n' % name)
-                    suggested.add(name)
+            if shar in written:
                 continue
+            if bitmap_test(known, i):
+                oldpack = w.exists(shar, want_source=True)
+                if oldpack == True:  # already in the pack being received
+                    continue
+                if oldpack:
+                    assert(oldpack.endswith('.idx'))
+                    (dir,name) = os.path.split(oldpack)
+                    if not (name in suggested):
+                        debug1("bup server: suggesting index %s\n"
+                               % git.shorten_hash(name))
+                        debug1("bup server:   because of object %s\n"
+                               % shar.encode('hex'))
+                        conn.write('index %s\n' % name)
+                        suggested.add(name)
+                    continue
+            written.add(shar)
         nw, crc = w._raw_write((buf,), sha=shar)
         _check(w, crcr, crc, 'object read: expected crc %d, got %d\n')
-    # NOTREACHED
-    
+
 
 def _check(w, expected, actual, msg):
     if expected != actual:
@@ -148,6 +186,13 @@ def update_ref(conn, refname):
     conn.ok()
 
 
+def config_get(conn, name):
+    _init_session()
+    value = git.git_config_get(name)
+    conn.write('%s\n' % (value or '').encode('hex'))
+    conn.ok()
+
+
 cat_pipe = None
 def cat(conn, id):
     global cat_pipe
@@ -189,6 +234,7 @@ commands = {
     'read-ref': read_ref,
     'update-ref': update_ref,
     'cat': cat,
+    'config-get': config_get,
 }
 
 # FIXME: this protocol is totally lame and not at all future-proof.
@@ -212,4 +258,5 @@ for _line in lr:
         else:
             raise Exception('unknown server command: %r\n' % line)
 
+git.wait_for_midx()
 debug1('bup server: done\n')
@@ -4,8 +4,8 @@ bup_python="$(dirname "$0")/bup-python" || exit $?
 exec "$bup_python" "$0" ${1+"$@"}
 """
 # end of bup preamble
-import os, sys, time
-from bup import hashsplit, git, options, client
+import os, sys, time, resource
+from bup import hashsplit, git, options, client, stats
 from bup.helpers import *
 
 
@@ -29,9 +29,12 @@ v,verbose  increase log output (can be used more than once)
 git-ids    read a list of git object ids from stdin and split their contents
 keep-boundaries  don't let one chunk span two input files
 bench      print benchmark timings to stderr
+stats-json=  write per-phase timings and counters as JSON to this file
 max-pack-size=  maximum bytes in a single pack
 max-pack-objects=  maximum number of objects in a single pack
 fanout=    average number of blobs in a single tree
+chunker=   split with this chunker (bupsplit or fastcdc), with --noop or --copy
+survey=    with --noop, report how the given settings would split the files
 bwlimit=   maximum bytes/sec to transmit to server
 #,compress=  set compression level to # (0-9, 9 is highest) [1]
 """
@@ -50,6 +53,18 @@ if opt.blobs and (opt.tree or opt.commit or opt.name):
     o.fatal('-b is incompatible with -t, -c, -n')
 if extra and opt.git_ids:
     o.fatal("don't provide filenames when using --git-ids")
+if opt.chunker and not (opt.noop or opt.copy):
+    o.fatal("--chunker is only allowed with --noop or --copy; "
+            "repositories record their own")
+if opt.chunker and opt.chunker not in hashsplit.chunkers:
+    o.fatal('unknown chunker %r' % opt.chunker)
+if opt.survey and not (opt.noop and extra):
+    o.fatal('--survey requires --noop and filenames')
+if opt.survey and opt.stats_json:
+    o.fatal('--stats-json is incompatible with --survey')
+
+if opt.stats_json:
+    stats.enable()
 
 if opt.verbose >= 2:
     git.verbose = opt.verbose - 1
@@ -58,10 +73,6 @@ if opt.max_pack_size:
     git.max_pack_size = parse_num(opt.max_pack_size)
 if opt.max_pack_objects:
     git.max_pack_objects = parse_num(opt.max_pack_objects)
-if opt.fanout:
-    hashsplit.fanout = parse_num(opt.fanout)
-if opt.blobs:
-    hashsplit.fanout = 0
 if opt.bwlimit:
     client.bwlimit = parse_num(opt.bwlimit)
 if opt.date:
@@ -99,6 +110,79 @@ else:
     oldref = refname and git.read_ref(refname) or None
     pack_writer = git.PackWriter(compression_level=opt.compress)
 
+config_get = cli and cli.config_get or git.git_config_get
+try:
+    hashsplit.configure(config_get)
+except ValueError as e:
+    log('error: %s\n' % e)
+    sys.exit(1)
+if opt.chunker:
+    hashsplit.chunker = opt.chunker
+if opt.fanout:
+    hashsplit.fanout = parse_num(opt.fanout)
+if opt.blobs:
+    hashsplit.fanout = 0
+
+
+def survey(settings):
+    """Split the files named in extra (each on its own, as save would)
+    with the given split settings, and return (total bytes, {blob: size},
+    set(trees))."""
+    hashsplit.configure(settings.get)
+    blobs = {}
+    trees = set()
+    def makeblob(content):
+        sha = git.calc_hash('blob', content)
+        blobs[sha] = len(content)
+        return sha
+    def maketree(shalist):
+        sha = git.calc_hash('tree', git.tree_encode(shalist))
+        trees.add(sha)
+        return sha
+    total = hashsplit.total_split
+    for i, name in enumerate(extra):
+        qprogress('Surveying: file %d/%d\r' % (i + 1, len(extra)))
+        with open(name, 'rb') as f:
+            hashsplit.split_to_blob_or_tree(makeblob, maketree, [f],
+                                            keep_boundaries=False)
+    return hashsplit.total_split - total, blobs, trees
+
+if opt.survey:
+    keys = ('chunker', 'blobbits', 'blobmax', 'fanout', 'treemax')
+    base = dict(('bup.' + k, config_get('bup.' + k)) for k in keys)
+    if opt.chunker:
+        base['bup.chunker'] = opt.chunker
+    candidates = [('(repository)', base)]
+    for k, v in flags:
+        if k != '--survey':
+            continue
+        settings = dict(base)
+        for item in v.split(','):
+            key, eq, value = item.partition('=')
+            if key not in keys or not value:
+                o.fatal('invalid --survey setting %r (expected %s=VALUE)'
+                        % (item, '|'.join(keys)))
+            settings['bup.' + key] = value
+        try:
+            hashsplit.configure(settings.get)
+        except ValueError as e:
+            o.fatal('%s: %s' % (v, e))
+        candidates.append((v, settings))
+    width = max(len(label) for label, settings in candidates)
+    print '%-*s %10s %8s %10s %10s %9s' % (width, 'settings', 'objects',
+                                           'trees', 'idx bytes', 'avg blob',
+                                           'dedup')
+    for label, settings in candidates:
+        total, blobs, trees = survey(settings)
+        unique = sum(blobs.itervalues())
+        nobjs = len(blobs) + len(trees)
+        idx_size = 8 + 256 * 4 + nobjs * (20 + 4 + 4) + 2 * 20
+        print '%-*s %10d %8d %10d %10d %8.3fx' \
+            % (width, label, nobjs, len(trees), idx_size,
+               unique / max(len(blobs), 1), float(total) / max(unique, 1))
+        sys.stdout.flush()
+    sys.exit(saved_errors and 1 or 0)
+
 if opt.git_ids:
     # the input is actually a series of git object ids that we should retrieve
     # and split.
@@ -194,9 +278,15 @@ if cli:
 
 secs = time.time() - start_time
 size = hashsplit.total_split
+if opt.stats_json:
+    stats.write_json(opt.stats_json, command='split', bytes=size)
 if opt.bench:
     log('bup: %.2fkbytes in %.2f secs = %.2f kbytes/sec\n'
         % (size/1024., secs, size/1024./secs))
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss /= 1024  # bytes rather than kbytes
+    log('bup: max RSS %d kbytes\n' % maxrss)
 
 if saved_errors:
     log('WARNING: %d errors encountered while saving.\n' % len(saved_errors))
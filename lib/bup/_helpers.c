@@ -40,11 +40,27 @@
 #endif
 
 #include "bupsplit.h"
+#include "fastcdc.h"
 
 #if defined(FS_IOC_GETFLAGS) && defined(FS_IOC_SETFLAGS)
 #define BUP_HAVE_FILE_ATTRS 1
 #endif
 
+#ifdef FS_IOC_FIEMAP
+#define BUP_HAVE_FIEMAP 1
+#include <linux/fiemap.h>
+#include <sys/vfs.h>
+#endif
+
+#if defined(BUP_HAVE_FIEMAP) && defined(HAVE_LINUX_BTRFS_H) \
+    && defined(HAVE_LINUX_BTRFS_TREE_H)
+#include <linux/btrfs.h>
+#include <linux/btrfs_tree.h>
+#ifdef BTRFS_IOC_TREE_SEARCH
+#define BUP_HAVE_BTRFS_TREE_SEARCH 1
+#endif
+#endif
+
 /*
  * Check for incomplete UTIMENSAT support (NetBSD 6), and if so,
  * pretend we don't have it.
@@ -390,12 +406,120 @@ static PyObject *splitbuf(PyObject *self, PyObject *args)
     if (!PyArg_ParseTuple(args, "t#", &buf, &len))
 	return NULL;
     assert(len <= INT_MAX);
+    Py_BEGIN_ALLOW_THREADS
     out = bupsplit_find_ofs(buf, len, &bits);
+    Py_END_ALLOW_THREADS
     if (out) assert(bits >= BUP_BLOBBITS);
     return Py_BuildValue("ii", out, bits);
 }
 
 
+typedef int (*find_ofs_fn)(const unsigned char *buf, int len, int blobbits,
+                          int *bits);
+
+// Return a string of native ints, holding an (end offset, level) pair
+// for every chunk boundary that find_ofs() finds in buf, with chunks
+// averaging 2^blobbits bytes (BUP_BLOBBITS by default), and limited to
+// max_blob bytes.  When search_max is false, each search
+// covers the rest of buf, and a chunk found to be too long is cut at
+// max_blob, as repeated calls to splitbuf() would do it; when it's
+// true, a search stops at max_blob, and if nothing is found there, the
+// chunk is cut there and the next search starts right away.
+static PyObject *find_splits_with(PyObject *args, find_ofs_fn find_ofs,
+                                  int search_max)
+{
+    unsigned char *buf = NULL;
+    Py_ssize_t len = 0, pos = 0;
+    int max_blob = 0, fanbits = 0, blobbits = BUP_BLOBBITS;
+    int *splits = NULL;
+    size_t nsplits = 0, alloc = 0;
+    int nomem = 0;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "t#ii|i", &buf, &len, &max_blob, &fanbits,
+                          &blobbits))
+	return NULL;
+    assert(len <= INT_MAX);
+    if (max_blob <= 0 || fanbits <= 0)
+    {
+        PyErr_SetString(PyExc_ValueError,
+                        "max_blob and fanbits must be positive");
+        return NULL;
+    }
+    if (blobbits < BUP_MIN_BLOBBITS || blobbits > BUP_MAX_BLOBBITS)
+    {
+        PyErr_Format(PyExc_ValueError, "blobbits must be from %d to %d",
+                     BUP_MIN_BLOBBITS, BUP_MAX_BLOBBITS);
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    while (pos < len)
+    {
+        int bits = -1, level;
+        int avail = len - pos, ofs;
+        if (search_max && avail > max_blob)
+            avail = max_blob;
+        ofs = find_ofs(buf + pos, avail, blobbits, &bits);
+        if (!ofs && search_max && avail == max_blob)
+        {
+            ofs = max_blob;
+            level = 0;
+        }
+        else if (!ofs)
+            break;
+        else if (ofs > max_blob)
+        {
+            ofs = max_blob;
+            level = 0;
+        }
+        else
+            level = bits > blobbits ? (bits - blobbits) / fanbits : 0;
+        if (nsplits == alloc)
+        {
+            int *tmp;
+            alloc = alloc ? alloc * 2 : 64;
+            tmp = realloc(splits, alloc * 2 * sizeof(int));
+            if (!tmp)
+            {
+                nomem = 1;
+                break;
+            }
+            splits = tmp;
+        }
+        pos += ofs;
+        splits[nsplits * 2] = pos;
+        splits[nsplits * 2 + 1] = level;
+        nsplits++;
+    }
+    Py_END_ALLOW_THREADS
+
+    if (nomem)
+    {
+        free(splits);
+        return PyErr_NoMemory();
+    }
+    result = PyString_FromStringAndSize((char *) splits,
+                                        nsplits * 2 * sizeof(int));
+    free(splits);
+    return result;
+}
+
+
+// Return the (end offset, level) pairs as repeated calls to splitbuf()
+// would find them (see find_splits_with()).
+static PyObject *find_splits(PyObject *self, PyObject *args)
+{
+    return find_splits_with(args, bupsplit_find_ofs_bits, 0);
+}
+
+
+static PyObject *fastcdc_find_splits(PyObject *self, PyObject *args)
+{
+    return find_splits_with(args, fastcdc_find_ofs, 1);
+}
+
+
 static PyObject *bitmatch(PyObject *self, PyObject *args)
 {
     unsigned char *buf1 = NULL, *buf2 = NULL;
@@ -441,6 +565,17 @@ static PyObject *firstword(PyObject *self, PyObject *args)
 }
 
 
+// The first 64 bits of a sha, as a number.
+static uint64_t sha_key(const unsigned char *sha)
+{
+    uint64_t v = 0;
+    int i;
+    for (i = 0; i < 8; i++)
+        v = (v << 8) | sha[i];
+    return v;
+}
+
+
 #define BLOOM2_HEADERLEN 16
 
 static void to_bloom_address_bitmask4(const unsigned char *buf,
@@ -568,6 +703,189 @@ static PyObject *bloom_contains(PyObject *self, PyObject *args)
 }
 
 
+// Set bit i of maybe (bit i % 8 of byte i / 8) for each of the shas
+// in the concatenated buf that a bloom filter of 2^nbits bytes might
+// contain, and return (the number of them, the number of steps).
+static PyObject *bloom_contains_many(PyObject *self, PyObject *args)
+{
+    unsigned char *buf = NULL, *bloom = NULL, *maybe;
+    Py_ssize_t len = 0, blen = 0, i, n, count = 0, steps = 0;
+    int nbits = 0, k = 0, j;
+    const unsigned char *sha;
+    PyObject *py_maybe;
+
+    if (!PyArg_ParseTuple(args, "t#t#iiO!", &bloom, &blen, &buf, &len,
+                          &nbits, &k, &PyByteArray_Type, &py_maybe))
+	return NULL;
+
+    n = len / 20;
+    maybe = (unsigned char *) PyByteArray_AS_STRING(py_maybe);
+    if (len % 20 != 0 || PyByteArray_GET_SIZE(py_maybe) * 8 < n)
+        return PyErr_Format(PyExc_ValueError, "invalid query or bitmap size");
+    if (!(k == 5 && nbits <= 29) && !(k == 4 && nbits <= 37))
+        return PyErr_Format(PyExc_ValueError, "invalid bloom parameters");
+    if (blen < 16 + (1 << nbits))
+        return PyErr_Format(PyExc_ValueError, "bloom filter is truncated");
+
+    for (i = 0, sha = buf; i < n; i++, sha += 20)
+    {
+	for (j = 0; j < k; j++)
+	{
+	    steps++;
+	    if (k == 5 ? !bloom_get_bit5(bloom, sha + j * 4, nbits)
+		: !bloom_get_bit4(bloom, sha + j * 5, nbits))
+		break;
+	}
+	if (j == k)
+	{
+	    maybe[i >> 3] |= 1 << (i & 7);
+	    count++;
+	}
+    }
+    return Py_BuildValue("nn", count, steps);
+}
+
+
+#define BLOCKED_BLOOM_HEADERLEN 64
+#define BLOCKED_BLOOM_MAX_K 7
+
+// A blocked bloom filter of 2^nbits bytes is made of 64 byte blocks
+// (aligned, since the header is 64 bytes too), and all k of an
+// object's bits are in the same one, so a lookup only touches a single
+// cache line.  The block is chosen by the top nbits - 6 bits of the
+// sha, and the bits within it by the 9 bit fields of the next 64 bits.
+static uint64_t blocked_bloom_block(const unsigned char *sha, int nbits,
+				    uint64_t *fields)
+{
+    uint32_t high;
+
+    memcpy(&high, sha, 4);
+    *fields = sha_key(sha + 4);
+    return BLOCKED_BLOOM_HEADERLEN
+	+ (((uint64_t)ntohl(high) >> (38 - nbits)) << 6);
+}
+
+static void blocked_bloom_set(unsigned char *bloom, const unsigned char *sha,
+			      int nbits, int k)
+{
+    uint64_t fields;
+    unsigned char *block = bloom + blocked_bloom_block(sha, nbits, &fields);
+    int j, bit;
+
+    for (j = 0; j < k; j++, fields >>= 9)
+    {
+	bit = fields & 0x1ff;
+	block[bit >> 3] |= 1 << (bit & 7);
+    }
+}
+
+// Return true if all of sha's bits are set, and add the number of bits
+// looked at to *steps.
+static int blocked_bloom_get(const unsigned char *bloom,
+			     const unsigned char *sha, int nbits, int k,
+			     Py_ssize_t *steps)
+{
+    uint64_t fields;
+    const unsigned char *block
+	= bloom + blocked_bloom_block(sha, nbits, &fields);
+    int j, bit;
+
+    for (j = 0; j < k; j++, fields >>= 9)
+    {
+	bit = fields & 0x1ff;
+	if (!(block[bit >> 3] & (1 << (bit & 7))))
+	{
+	    *steps += j + 1;
+	    return 0;
+	}
+    }
+    *steps += k;
+    return 1;
+}
+
+static int blocked_bloom_check(Py_ssize_t blen, int nbits, int k)
+{
+    if (k < 1 || k > BLOCKED_BLOOM_MAX_K || nbits < 6 || nbits > 38)
+    {
+	PyErr_Format(PyExc_ValueError, "invalid blocked bloom parameters");
+	return 0;
+    }
+    if (blen < BLOCKED_BLOOM_HEADERLEN + ((Py_ssize_t)1 << nbits))
+    {
+	PyErr_Format(PyExc_ValueError, "bloom filter is truncated");
+	return 0;
+    }
+    return 1;
+}
+
+static PyObject *blocked_bloom_add(PyObject *self, PyObject *args)
+{
+    unsigned char *sha = NULL, *bloom = NULL, *end;
+    Py_ssize_t len = 0, blen = 0;
+    int nbits = 0, k = 0;
+
+    if (!PyArg_ParseTuple(args, "w#s#ii", &bloom, &blen, &sha, &len,
+			  &nbits, &k))
+	return NULL;
+    if (!blocked_bloom_check(blen, nbits, k))
+	return NULL;
+    if (len % 20 != 0)
+	return PyErr_Format(PyExc_ValueError, "invalid sha table size");
+
+    for (end = sha + len; sha < end; sha += 20)
+	blocked_bloom_set(bloom, sha, nbits, k);
+    return Py_BuildValue("n", len/20);
+}
+
+static PyObject *blocked_bloom_contains(PyObject *self, PyObject *args)
+{
+    unsigned char *sha = NULL, *bloom = NULL;
+    Py_ssize_t len = 0, blen = 0, steps = 0;
+    int nbits = 0, k = 0;
+
+    if (!PyArg_ParseTuple(args, "t#s#ii", &bloom, &blen, &sha, &len,
+			  &nbits, &k))
+	return NULL;
+    if (!blocked_bloom_check(blen, nbits, k))
+	return NULL;
+    if (len != 20)
+	return PyErr_Format(PyExc_ValueError, "expected a 20 byte sha");
+
+    if (!blocked_bloom_get(bloom, sha, nbits, k, &steps))
+	return Py_BuildValue("On", Py_None, steps);
+    return Py_BuildValue("in", 1, steps);
+}
+
+// Like bloom_contains_many(), for a blocked bloom filter.
+static PyObject *blocked_bloom_contains_many(PyObject *self, PyObject *args)
+{
+    unsigned char *buf = NULL, *bloom = NULL, *maybe;
+    Py_ssize_t len = 0, blen = 0, i, n, count = 0, steps = 0;
+    int nbits = 0, k = 0;
+    PyObject *py_maybe;
+
+    if (!PyArg_ParseTuple(args, "t#t#iiO!", &bloom, &blen, &buf, &len,
+                          &nbits, &k, &PyByteArray_Type, &py_maybe))
+	return NULL;
+    if (!blocked_bloom_check(blen, nbits, k))
+	return NULL;
+    n = len / 20;
+    maybe = (unsigned char *) PyByteArray_AS_STRING(py_maybe);
+    if (len % 20 != 0 || PyByteArray_GET_SIZE(py_maybe) * 8 < n)
+        return PyErr_Format(PyExc_ValueError, "invalid query or bitmap size");
+
+    for (i = 0; i < n; i++)
+    {
+	if (blocked_bloom_get(bloom, buf + i * 20, nbits, k, &steps))
+	{
+	    maybe[i >> 3] |= 1 << (i & 7);
+	    count++;
+	}
+    }
+    return Py_BuildValue("nn", count, steps);
+}
+
+
 static uint32_t _extract_bits(unsigned char *buf, int nbits)
 {
     uint32_t v, mask;
@@ -607,6 +925,10 @@ struct idx {
     uint32_t *cur_name;
     Py_ssize_t bytes;
     int name_base;
+    int sha_stride;
+    unsigned char *cur_ofs;  // NULL if the offsets aren't known
+    int ofs_stride;
+    unsigned char *ofs64;  // NULL if there's no table of 64-bit offsets
 };
 
 
@@ -666,50 +988,109 @@ static uint32_t _get_idx_i(struct idx *idx)
     return ntohl(*idx->cur_name) + idx->name_base;
 }
 
+static void _idx_next(struct idx *idx)
+{
+    idx->cur = (struct sha *)((unsigned char *)idx->cur + idx->sha_stride);
+    if (idx->cur_name != NULL)
+	++idx->cur_name;
+    if (idx->cur_ofs != NULL)
+	idx->cur_ofs += idx->ofs_stride;
+}
+
+
+// Return the pack offset of the current object, from a table of 32-bit
+// offsets, where (if there's a table of 64-bit ones) those with the
+// high bit set are the index of a 64-bit offset.
+static uint64_t _get_idx_ofs(struct idx *idx)
+{
+    uint32_t v;
+    uint64_t v64;
+
+    memcpy(&v, idx->cur_ofs, 4);
+    v = ntohl(v);
+    if (!(v & 0x80000000) || idx->ofs64 == NULL)
+	return v;
+    memcpy(&v64, idx->ofs64 + (Py_ssize_t) (v & 0x7fffffff) * 8, 8);
+    return htonll(v64);
+}
+
 #define MIDX4_HEADERLEN 12
 
+// Merge the sorted shas of the idx and midx files in ilist into a
+// midx of the given version in fmap.  Each of them is described by a
+// tuple of (map, number of shas, offset of the first sha, distance
+// between shas, offset of the table of which idx each sha is from (or
+// 0), index of its first idx name in the output, offset of its first
+// 32-bit pack offset (or 0), distance between those, offset of its
+// table of 64-bit pack offsets (or 0)).  A version 5 midx also has the
+// pack offset of each object, which requires all of them to have
+// offsets.
 static PyObject *merge_into(PyObject *self, PyObject *args)
 {
     PyObject *py_total, *ilist = NULL;
     unsigned char *fmap = NULL;
     struct sha *sha_ptr, *sha_start = NULL;
     uint32_t *table_ptr, *name_ptr, *name_start;
+    uint32_t *ofs_ptr = NULL, *ofs64_count_ptr = NULL;
+    unsigned char *ofs64_ptr = NULL;
+    uint32_t ofs64_count = 0;
     struct idx **idxs = NULL;
     Py_ssize_t flen = 0;
-    int bits = 0, i;
+    int bits = 0, i, version = 4;
     unsigned int total;
     uint32_t count, prefix;
     int num_i;
     int last_i;
 
-    if (!PyArg_ParseTuple(args, "w#iOO",
-                          &fmap, &flen, &bits, &py_total, &ilist))
+    if (!PyArg_ParseTuple(args, "w#iOO|i",
+                          &fmap, &flen, &bits, &py_total, &ilist, &version))
 	return NULL;
 
     if (!bup_uint_from_py(&total, py_total, "total"))
         return NULL;
+    if (version != 4 && version != 5)
+        return PyErr_Format(PyExc_ValueError, "can't write a v%d midx",
+                            version);
+    if (flen < MIDX4_HEADERLEN + (4 << bits) + 24 * (Py_ssize_t) total
+        + (version >= 5 ? 4 * (Py_ssize_t) total + 4 : 0))
+        return PyErr_Format(PyExc_ValueError, "midx map is too small");
 
     num_i = PyList_Size(ilist);
     idxs = (struct idx **)PyMem_Malloc(num_i * sizeof(struct idx *));
 
     for (i = 0; i < num_i; i++)
     {
-	long len, sha_ofs, name_map_ofs;
+	long len, sha_ofs, name_map_ofs, ofs_ofs, ofs64_ofs;
 	idxs[i] = (struct idx *)PyMem_Malloc(sizeof(struct idx));
 	PyObject *itup = PyList_GetItem(ilist, i);
-	if (!PyArg_ParseTuple(itup, "t#llli", &idxs[i]->map, &idxs[i]->bytes,
-		    &len, &sha_ofs, &name_map_ofs, &idxs[i]->name_base))
+	if (!PyArg_ParseTuple(itup, "t#llililil", &idxs[i]->map,
+		    &idxs[i]->bytes, &len, &sha_ofs, &idxs[i]->sha_stride,
+		    &name_map_ofs, &idxs[i]->name_base,
+		    &ofs_ofs, &idxs[i]->ofs_stride, &ofs64_ofs))
 	    return NULL;
+	if (version >= 5 && !ofs_ofs)
+	    return PyErr_Format(PyExc_ValueError,
+				"can't write a v%d midx without offsets",
+				version);
 	idxs[i]->cur = (struct sha *)&idxs[i]->map[sha_ofs];
-	idxs[i]->end = &idxs[i]->cur[len];
+	idxs[i]->end = (struct sha *)&idxs[i]->map[sha_ofs
+						   + len * idxs[i]->sha_stride];
 	if (name_map_ofs)
 	    idxs[i]->cur_name = (uint32_t *)&idxs[i]->map[name_map_ofs];
 	else
 	    idxs[i]->cur_name = NULL;
+	idxs[i]->cur_ofs = ofs_ofs ? &idxs[i]->map[ofs_ofs] : NULL;
+	idxs[i]->ofs64 = ofs64_ofs ? &idxs[i]->map[ofs64_ofs] : NULL;
     }
     table_ptr = (uint32_t *)&fmap[MIDX4_HEADERLEN];
     sha_start = sha_ptr = (struct sha *)&table_ptr[1<<bits];
     name_start = name_ptr = (uint32_t *)&sha_ptr[total];
+    if (version >= 5)
+    {
+	ofs_ptr = &name_ptr[total];
+	ofs64_count_ptr = &ofs_ptr[total];
+	ofs64_ptr = (unsigned char *)&ofs64_count_ptr[1];
+    }
 
     last_i = num_i-1;
     count = 0;
@@ -727,9 +1108,28 @@ static PyObject *merge_into(PyObject *self, PyObject *args)
 	    table_ptr[prefix++] = htonl(count);
 	memcpy(sha_ptr++, idx->cur, sizeof(struct sha));
 	*name_ptr++ = htonl(_get_idx_i(idx));
-	++idx->cur;
-	if (idx->cur_name != NULL)
-	    ++idx->cur_name;
+	if (ofs_ptr)
+	{
+	    uint64_t ofs = _get_idx_ofs(idx);
+	    if (ofs < 0x80000000)
+		*ofs_ptr++ = htonl(ofs);
+	    else
+	    {
+		if (ofs64_ptr + 8 > fmap + flen)
+		{
+		    for (i = 0; i <= last_i; i++)
+			PyMem_Free(idxs[i]);
+		    PyMem_Free(idxs);
+		    return PyErr_Format(PyExc_ValueError,
+					"midx map is too small");
+		}
+		*ofs_ptr++ = htonl(0x80000000 | ofs64_count++);
+		ofs = htonll(ofs);
+		memcpy(ofs64_ptr, &ofs, 8);
+		ofs64_ptr += 8;
+	    }
+	}
+	_idx_next(idx);
 	_fix_idx_order(idxs, &last_i);
 	++count;
     }
@@ -739,6 +1139,8 @@ static PyObject *merge_into(PyObject *self, PyObject *args)
     assert(prefix == (1<<bits));
     assert(sha_ptr == sha_start+count);
     assert(name_ptr == name_start+count);
+    if (ofs64_count_ptr)
+	*ofs64_count_ptr = htonl(ofs64_count);
 
     PyMem_Free(idxs);
     return PyLong_FromUnsignedLong(count);
@@ -746,6 +1148,240 @@ static PyObject *merge_into(PyObject *self, PyObject *args)
 
 #define FAN_ENTRIES 256
 
+// The objects written to a pack so far are kept in an idx table: 256
+// bytearrays, one for each first byte of the object ids, each holding
+// an array of these, sorted by sha.
+struct idx_entry {
+    struct sha sha;
+    uint32_t crc;
+    uint64_t ofs;
+};
+
+// Return the index of the first of the n entries whose sha is greater
+// than sha, or with or_equal, at least sha.
+static Py_ssize_t idx_entry_bound(const struct idx_entry *e, Py_ssize_t n,
+                                  const unsigned char *sha, int or_equal)
+{
+    Py_ssize_t lo = 0, hi = n;
+    while (lo < hi)
+    {
+        Py_ssize_t mid = lo + (hi - lo) / 2;
+        int c = memcmp(e[mid].sha.bytes, sha, sizeof(struct sha));
+        if (c < 0 || (c == 0 && !or_equal))
+            lo = mid + 1;
+        else
+            hi = mid;
+    }
+    return lo;
+}
+
+static PyObject *idx_table_insert(PyObject *self, PyObject *args)
+{
+    PyObject *bucket;
+    unsigned char *sha = NULL;
+    Py_ssize_t sha_len = 0, n, i;
+    unsigned int crc;
+    unsigned PY_LONG_LONG ofs;
+    struct idx_entry *e;
+
+    if (!PyArg_ParseTuple(args, "O!t#IK", &PyByteArray_Type, &bucket,
+                          &sha, &sha_len, &crc, &ofs))
+        return NULL;
+    if (sha_len != sizeof(struct sha))
+        return PyErr_Format(PyExc_ValueError, "sha must be %d bytes",
+                            (int) sizeof(struct sha));
+    n = PyByteArray_GET_SIZE(bucket) / sizeof(struct idx_entry);
+    i = idx_entry_bound((struct idx_entry *) PyByteArray_AS_STRING(bucket),
+                        n, sha, 0);
+    if (PyByteArray_Resize(bucket, (n + 1) * sizeof(struct idx_entry)) < 0)
+        return NULL;
+    e = (struct idx_entry *) PyByteArray_AS_STRING(bucket);
+    memmove(&e[i + 1], &e[i], (n - i) * sizeof(struct idx_entry));
+    memcpy(e[i].sha.bytes, sha, sizeof(struct sha));
+    e[i].crc = crc;
+    e[i].ofs = ofs;
+    Py_RETURN_NONE;
+}
+
+static PyObject *idx_table_find(PyObject *self, PyObject *args)
+{
+    PyObject *bucket;
+    unsigned char *sha = NULL;
+    Py_ssize_t sha_len = 0, n, i;
+    const struct idx_entry *e;
+
+    if (!PyArg_ParseTuple(args, "O!t#", &PyByteArray_Type, &bucket,
+                          &sha, &sha_len))
+        return NULL;
+    if (sha_len != sizeof(struct sha))
+        return PyErr_Format(PyExc_ValueError, "sha must be %d bytes",
+                            (int) sizeof(struct sha));
+    n = PyByteArray_GET_SIZE(bucket) / sizeof(struct idx_entry);
+    e = (const struct idx_entry *) PyByteArray_AS_STRING(bucket);
+    i = idx_entry_bound(e, n, sha, 1);
+    return PyBool_FromLong(i < n && memcmp(e[i].sha.bytes, sha,
+                                           sizeof(struct sha)) == 0);
+}
+
+// Search a sorted table of n entries, stride bytes apart, each
+// starting with a sha, for the concatenated sorted shas in query, and
+// set bit i of found (bit i % 8 of byte i / 8) for each one that's
+// there.  Shas whose bit is already set in found, or isn't set in want
+// (if given), aren't searched for.  Since the shas are sorted, each
+// search starts where the last one stopped and gallops forward, so a
+// batch costs much less than searching for each sha from scratch.
+// Return (newly found, searched, steps).
+static PyObject *exists_many(PyObject *self, PyObject *args)
+{
+    const unsigned char *table = NULL, *query = NULL, *want = NULL, *q;
+    unsigned char *found;
+    Py_ssize_t table_len = 0, query_len = 0;
+    Py_ssize_t n = 0, nq, i, lo, hi, step, pos = 0;
+    Py_ssize_t newly = 0, searched = 0, steps = 0;
+    int stride = 0;
+    PyObject *py_found, *py_want = Py_None;
+
+    if (!PyArg_ParseTuple(args, "t#int#O!|O", &table, &table_len, &stride,
+                          &n, &query, &query_len, &PyByteArray_Type,
+                          &py_found, &py_want))
+        return NULL;
+
+    nq = query_len / 20;
+    if (stride < 20 || n < 0 || (n && table_len < (n - 1) * stride + 20))
+        return PyErr_Format(PyExc_ValueError, "table is too short");
+    if (query_len % 20 != 0 || PyByteArray_GET_SIZE(py_found) * 8 < nq)
+        return PyErr_Format(PyExc_ValueError, "invalid query or bitmap size");
+    if (py_want != Py_None)
+    {
+        if (!PyByteArray_Check(py_want)
+            || PyByteArray_GET_SIZE(py_want) * 8 < nq)
+            return PyErr_Format(PyExc_ValueError, "invalid want bitmap");
+        want = (const unsigned char *) PyByteArray_AS_STRING(py_want);
+    }
+    found = (unsigned char *) PyByteArray_AS_STRING(py_found);
+
+    for (i = 0, q = query; i < nq && pos < n; i++, q += 20)
+    {
+        if (found[i >> 3] & (1 << (i & 7)))
+            continue;
+        if (want && !(want[i >> 3] & (1 << (i & 7))))
+            continue;
+        searched++;
+        // Everything before pos is less than q, so double the distance
+        // from pos until reaching an entry that isn't...
+        lo = hi = pos;
+        for (step = 1; hi < n; step *= 2)
+        {
+            steps++;
+            if (memcmp(table + hi * stride, q, 20) >= 0)
+                break;
+            lo = hi + 1;
+            hi += step;
+        }
+        if (hi > n)
+            hi = n;
+        // ...and then the first entry >= q is in [lo, hi].
+        while (lo < hi)
+        {
+            Py_ssize_t mid = lo + (hi - lo) / 2;
+            steps++;
+            if (memcmp(table + mid * stride, q, 20) < 0)
+                lo = mid + 1;
+            else
+                hi = mid;
+        }
+        pos = lo;
+        if (pos < n && memcmp(table + pos * stride, q, 20) == 0)
+        {
+            found[i >> 3] |= 1 << (i & 7);
+            newly++;
+        }
+    }
+    return Py_BuildValue("nnn", newly, searched, steps);
+}
+
+// Entry i of a big-endian fanout table, which needn't be aligned.
+static uint32_t fanout_get(const unsigned char *fanout, Py_ssize_t i)
+{
+    uint32_t v;
+    memcpy(&v, fanout + i * 4, 4);
+    return ntohl(v);
+}
+
+// Return the index of sha in a sorted table of entries, stride bytes
+// apart, each starting with a sha, or -1 if it isn't there.  The fanout
+// table has 2^bits big-endian counts of the entries whose first bits
+// bits are <= its index, which bounds the search.  Since shas are
+// uniformly distributed, the position of sha between the bounds is
+// guessed from its value (interpolation search), which usually finds
+// it in a step or two; if that doesn't converge, it falls back to
+// bisection.  *steps is incremented for the fanout lookup and each
+// probe.
+static Py_ssize_t sha_find(const unsigned char *table, int stride,
+                           const unsigned char *fanout, int bits,
+                           const unsigned char *sha, int *steps)
+{
+    uint64_t key = sha_key(sha), lov, hiv, v;
+    uint32_t el = bits ? key >> (64 - bits) : 0;
+    Py_ssize_t lo = el ? fanout_get(fanout, el - 1) : 0;
+    Py_ssize_t hi = fanout_get(fanout, el), mid;
+    int c, probes = 0;
+
+    lov = bits ? (uint64_t) el << (64 - bits) : 0;
+    hiv = bits ? lov | (UINT64_MAX >> bits) : UINT64_MAX;
+    (*steps)++;  // the fanout lookup
+    while (lo < hi)
+    {
+        if (++probes <= 8 && hiv > lov)
+        {
+            double frac = (double) (key - lov) / ((double) (hiv - lov) + 1.0);
+            mid = lo + (Py_ssize_t) (frac * (hi - lo));
+            if (mid < lo)
+                mid = lo;
+            else if (mid >= hi)
+                mid = hi - 1;
+        }
+        else
+            mid = lo + (hi - lo) / 2;
+        (*steps)++;
+        c = memcmp(table + mid * stride, sha, 20);
+        if (c == 0)
+            return mid;
+        v = sha_key(table + mid * stride);
+        if (c < 0)
+        {
+            lo = mid + 1;
+            lov = v;
+        }
+        else
+        {
+            hi = mid;
+            hiv = v;
+        }
+    }
+    return -1;
+}
+
+static PyObject *find_sha(PyObject *self, PyObject *args)
+{
+    const unsigned char *table = NULL, *fanout = NULL, *sha = NULL;
+    Py_ssize_t table_len = 0, fanout_len = 0, sha_len = 0, n, i;
+    int stride = 0, bits = 0, steps = 0;
+
+    if (!PyArg_ParseTuple(args, "t#it#it#", &table, &table_len, &stride,
+                          &fanout, &fanout_len, &bits, &sha, &sha_len))
+        return NULL;
+    if (sha_len != 20)
+        return PyErr_Format(PyExc_ValueError, "sha must be 20 bytes");
+    if (bits < 0 || bits > 32 || fanout_len < ((Py_ssize_t) 4 << bits))
+        return PyErr_Format(PyExc_ValueError, "invalid fanout table");
+    n = fanout_get(fanout, ((Py_ssize_t) 1 << bits) - 1);
+    if (stride < 20 || (n && table_len < (n - 1) * stride + 20))
+        return PyErr_Format(PyExc_ValueError, "table is too short");
+    i = sha_find(table, stride, fanout, bits, sha, &steps);
+    return Py_BuildValue("ni", i, steps);
+}
+
 static PyObject *write_idx(PyObject *self, PyObject *args)
 {
     char *filename = NULL;
@@ -755,7 +1391,7 @@ static PyObject *write_idx(PyObject *self, PyObject *args)
     Py_ssize_t flen = 0;
     unsigned int total = 0;
     uint32_t count;
-    int i, j, ofs64_count;
+    int i, ofs64_count;
     uint32_t *fan_ptr, *crc_ptr, *ofs_ptr;
     uint64_t *ofs64_ptr;
     struct sha *sha_ptr;
@@ -784,41 +1420,31 @@ static PyObject *write_idx(PyObject *self, PyObject *args)
     ofs64_count = 0;
     for (i = 0; i < FAN_ENTRIES; ++i)
     {
-	int plen;
-	part = PyList_GET_ITEM(idx, i);
-	PyList_Sort(part);
-	plen = PyList_GET_SIZE(part);
-	count += plen;
-	*fan_ptr++ = htonl(count);
-	for (j = 0; j < plen; ++j)
-	{
-	    unsigned char *sha = NULL;
-	    Py_ssize_t sha_len = 0;
-            PyObject *crc_py, *ofs_py;
-	    unsigned int crc;
-            unsigned PY_LONG_LONG ofs_ull;
-	    uint64_t ofs;
-	    if (!PyArg_ParseTuple(PyList_GET_ITEM(part, j), "t#OO",
-				  &sha, &sha_len, &crc_py, &ofs_py))
-		return NULL;
-            if(!bup_uint_from_py(&crc, crc_py, "crc"))
-                return NULL;
-            if(!bup_ullong_from_py(&ofs_ull, ofs_py, "ofs"))
-                return NULL;
-            assert(crc <= UINT32_MAX);
-            assert(ofs_ull <= UINT64_MAX);
-	    ofs = ofs_ull;
-	    if (sha_len != sizeof(struct sha))
-		return NULL;
-	    memcpy(sha_ptr++, sha, sizeof(struct sha));
-	    *crc_ptr++ = htonl(crc);
-	    if (ofs > 0x7fffffff)
-	    {
+        const struct idx_entry *e, *end;
+        Py_ssize_t plen;
+        part = PyList_GET_ITEM(idx, i);
+        if (!PyByteArray_Check(part))
+            return PyErr_Format(PyExc_TypeError,
+                                "idx must contain idx table bytearrays");
+        e = (const struct idx_entry *) PyByteArray_AS_STRING(part);
+        plen = PyByteArray_GET_SIZE(part) / sizeof(struct idx_entry);
+        if (plen > total - count)
+            return PyErr_Format(PyExc_ValueError,
+                                "idx has more than %u entries", total);
+        count += plen;
+        *fan_ptr++ = htonl(count);
+        for (end = e + plen; e < end; ++e)
+        {
+            uint64_t ofs = e->ofs;
+            memcpy(sha_ptr++, &e->sha, sizeof(struct sha));
+            *crc_ptr++ = htonl(e->crc);
+            if (ofs > 0x7fffffff)
+            {
                 *ofs64_ptr++ = htonll(ofs);
-		ofs = 0x80000000 | ofs64_count++;
-	    }
-	    *ofs_ptr++ = htonl((uint32_t)ofs);
-	}
+                ofs = 0x80000000 | ofs64_count++;
+            }
+            *ofs_ptr++ = htonl((uint32_t)ofs);
+        }
     }
 
     int rc = msync(fmap, flen, MS_ASYNC);
@@ -1056,6 +1682,192 @@ static PyObject *bup_set_linux_file_attr(PyObject *self, PyObject *args)
 #endif /* def BUP_HAVE_FILE_ATTRS */
 
 
+#ifdef BUP_HAVE_FIEMAP
+#define BUP_FIEMAP_BATCH 256
+
+// Return a list of (logical, physical, length, flags) tuples for the
+// extents of fd, after syncing any pending writes.
+static PyObject *bup_fiemap(PyObject *self, PyObject *args)
+{
+    int fd, i;
+    __u64 start = 0;
+    __u32 flags = FIEMAP_FLAG_SYNC;
+    struct fiemap *fm;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "i", &fd))
+        return NULL;
+
+    fm = malloc(sizeof(struct fiemap)
+                + BUP_FIEMAP_BATCH * sizeof(struct fiemap_extent));
+    if (!fm)
+        return PyErr_NoMemory();
+    result = PyList_New(0);
+    if (!result)
+        goto fail;
+    while (1)
+    {
+        int rc;
+        struct fiemap_extent *last;
+
+        memset(fm, 0, sizeof(struct fiemap));
+        fm->fm_start = start;
+        fm->fm_length = FIEMAP_MAX_OFFSET - start;
+        fm->fm_flags = flags;
+        fm->fm_extent_count = BUP_FIEMAP_BATCH;
+        Py_BEGIN_ALLOW_THREADS
+        rc = ioctl(fd, FS_IOC_FIEMAP, fm);
+        Py_END_ALLOW_THREADS
+        if (rc == -1)
+        {
+            PyErr_SetFromErrno(PyExc_OSError);
+            goto fail;
+        }
+        if (!fm->fm_mapped_extents)
+            break;
+        for (i = 0; i < fm->fm_mapped_extents; i++)
+        {
+            struct fiemap_extent *e = &fm->fm_extents[i];
+            PyObject *t = Py_BuildValue("KKKI",
+                                        (unsigned long long) e->fe_logical,
+                                        (unsigned long long) e->fe_physical,
+                                        (unsigned long long) e->fe_length,
+                                        (unsigned int) e->fe_flags);
+            if (!t || PyList_Append(result, t) == -1)
+            {
+                Py_XDECREF(t);
+                goto fail;
+            }
+            Py_DECREF(t);
+        }
+        last = &fm->fm_extents[fm->fm_mapped_extents - 1];
+        if (last->fe_flags & FIEMAP_EXTENT_LAST)
+            break;
+        start = last->fe_logical + last->fe_length;
+        flags = 0;
+    }
+    free(fm);
+    return result;
+
+ fail:
+    free(fm);
+    Py_XDECREF(result);
+    return NULL;
+}
+
+
+#ifdef BUP_HAVE_BTRFS_TREE_SEARCH
+static unsigned long long le64_at(const unsigned char *p)
+{
+    unsigned long long v = 0;
+    int i;
+    for (i = 7; i >= 0; i--)
+        v = (v << 8) | p[i];
+    return v;
+}
+
+// Return a list of (logical, generation) for each btrfs file extent
+// item of fd, in order, where generation is the transaction that
+// wrote the extent.  This needs CAP_SYS_ADMIN.
+static PyObject *bup_btrfs_extent_generations(PyObject *self, PyObject *args)
+{
+    int fd;
+    struct stat st;
+    struct btrfs_ioctl_search_args *sa;
+    struct btrfs_ioctl_search_key *sk;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "i", &fd))
+        return NULL;
+    if (fstat(fd, &st) == -1)
+        return PyErr_SetFromErrno(PyExc_OSError);
+
+    sa = calloc(1, sizeof(*sa));
+    if (!sa)
+        return PyErr_NoMemory();
+    result = PyList_New(0);
+    if (!result)
+        goto fail;
+    sk = &sa->key;
+    sk->tree_id = 0;  // the subvolume holding fd
+    sk->min_objectid = sk->max_objectid = st.st_ino;
+    sk->min_type = sk->max_type = BTRFS_EXTENT_DATA_KEY;
+    sk->min_offset = 0;
+    sk->max_offset = (__u64) -1;
+    sk->min_transid = 0;
+    sk->max_transid = (__u64) -1;
+    while (1)
+    {
+        int rc;
+        unsigned int i;
+        size_t pos = 0;
+        __u64 last = 0;
+
+        sk->nr_items = 4096;
+        Py_BEGIN_ALLOW_THREADS
+        rc = ioctl(fd, BTRFS_IOC_TREE_SEARCH, sa);
+        Py_END_ALLOW_THREADS
+        if (rc == -1)
+        {
+            PyErr_SetFromErrno(PyExc_OSError);
+            goto fail;
+        }
+        if (!sk->nr_items)
+            break;
+        for (i = 0; i < sk->nr_items; i++)
+        {
+            struct btrfs_ioctl_search_header sh;
+            const unsigned char *item;
+            PyObject *t;
+
+            memcpy(&sh, sa->buf + pos, sizeof(sh));
+            item = (const unsigned char *) sa->buf + pos + sizeof(sh);
+            pos += sizeof(sh) + sh.len;
+            last = sh.offset;
+            if (sh.objectid != st.st_ino || sh.type != BTRFS_EXTENT_DATA_KEY
+                || sh.len < sizeof(__u64))
+                continue;
+            // The generation is the first field of the (little-endian)
+            // btrfs_file_extent_item.
+            t = Py_BuildValue("KK", (unsigned long long) sh.offset,
+                              le64_at(item));
+            if (!t || PyList_Append(result, t) == -1)
+            {
+                Py_XDECREF(t);
+                goto fail;
+            }
+            Py_DECREF(t);
+        }
+        if (last == (__u64) -1)
+            break;
+        sk->min_offset = last + 1;
+    }
+    free(sa);
+    return result;
+
+ fail:
+    free(sa);
+    Py_XDECREF(result);
+    return NULL;
+}
+#endif /* def BUP_HAVE_BTRFS_TREE_SEARCH */
+
+
+static PyObject *bup_fstatfs_type(PyObject *self, PyObject *args)
+{
+    int fd, rc;
+    struct statfs st;
+
+    if (!PyArg_ParseTuple(args, "i", &fd))
+        return NULL;
+    rc = fstatfs(fd, &st);
+    if (rc == -1)
+        return PyErr_SetFromErrno(PyExc_OSError);
+    return PyLong_FromUnsignedLong((unsigned long) st.f_type & 0xffffffff);
+}
+#endif /* def BUP_HAVE_FIEMAP */
+
+
 #ifndef HAVE_UTIMENSAT
 #ifndef HAVE_UTIMES
 #error "cannot find utimensat or utimes()"
@@ -1272,7 +2084,9 @@ static PyObject *bup_stat(PyObject *self, PyObject *args)
         return NULL;
 
     struct stat st;
+    Py_BEGIN_ALLOW_THREADS
     rc = stat(filename, &st);
+    Py_END_ALLOW_THREADS
     if (rc != 0)
         return PyErr_SetFromErrnoWithFilename(PyExc_OSError, filename);
     return stat_struct_to_py(&st, filename, 0);
@@ -1288,7 +2102,9 @@ static PyObject *bup_lstat(PyObject *self, PyObject *args)
         return NULL;
 
     struct stat st;
+    Py_BEGIN_ALLOW_THREADS
     rc = lstat(filename, &st);
+    Py_END_ALLOW_THREADS
     if (rc != 0)
         return PyErr_SetFromErrnoWithFilename(PyExc_OSError, filename);
     return stat_struct_to_py(&st, filename, 0);
@@ -1303,13 +2119,300 @@ static PyObject *bup_fstat(PyObject *self, PyObject *args)
         return NULL;
 
     struct stat st;
+    Py_BEGIN_ALLOW_THREADS
     rc = fstat(fd, &st);
+    Py_END_ALLOW_THREADS
     if (rc != 0)
         return PyErr_SetFromErrno(PyExc_OSError);
     return stat_struct_to_py(&st, NULL, fd);
 }
 
 
+#if defined(HAVE_FSTATAT) && defined(HAVE_FDOPENDIR) && defined(HAVE_OPENAT) \
+    && defined(AT_SYMLINK_NOFOLLOW) && defined(O_DIRECTORY)
+#define BUP_HAVE_READ_DIR 1
+#endif
+
+#ifdef BUP_HAVE_READ_DIR
+
+#include <dirent.h>
+#include <limits.h>
+
+struct dir_entry {
+    const char *name;  // ends in '/' for a directory
+    size_t name_ofs;  // into dir_batch.names, until that stops moving
+    int err;  // from fstatat(), or 0 if st is valid
+    struct stat st;
+};
+
+struct dir_batch {
+    struct dir_entry *ents;
+    size_t n, max;
+    char *names;
+    size_t names_len, names_max;
+};
+
+static void dir_batch_free(struct dir_batch *b)
+{
+    free(b->ents);
+    free(b->names);
+}
+
+static int dir_entry_cmp_reverse(const void *a, const void *b)
+{
+    return strcmp(((const struct dir_entry *) b)->name,
+                  ((const struct dir_entry *) a)->name);
+}
+
+// Read the entries of the directory open as fd into b, lstat()ing each
+// one relative to fd, and sort them in reverse order.  Doesn't touch
+// any Python objects, so it can run without the GIL.  Returns 0, or
+// -1 with errno set.
+static int read_dir_batch(int fd, struct dir_batch *b)
+{
+    int dfd = dup(fd);
+    if (dfd == -1)
+        return -1;
+    DIR *dir = fdopendir(dfd);
+    if (!dir)
+    {
+        int err = errno;
+        close(dfd);
+        errno = err;
+        return -1;
+    }
+    while (1)
+    {
+        errno = 0;
+        struct dirent *d = readdir(dir);
+        if (!d)
+        {
+            if (errno)
+                goto fail;
+            break;
+        }
+        const char *name = d->d_name;
+        if (name[0] == '.'
+            && (name[1] == 0 || (name[1] == '.' && name[2] == 0)))
+            continue;
+        size_t len = strlen(name);
+        if (b->n == b->max)
+        {
+            size_t max = b->max ? b->max * 2 : 64;
+            struct dir_entry *ents = realloc(b->ents, max * sizeof(*ents));
+            if (!ents)
+                goto fail;
+            b->ents = ents;
+            b->max = max;
+        }
+        if (b->names_max - b->names_len < len + 2)
+        {
+            size_t max = b->names_max ? b->names_max * 2 : 4096;
+            while (max - b->names_len < len + 2)
+                max *= 2;
+            char *names = realloc(b->names, max);
+            if (!names)
+                goto fail;
+            b->names = names;
+            b->names_max = max;
+        }
+        struct dir_entry *e = &b->ents[b->n++];
+        char *ename = b->names + b->names_len;
+        memcpy(ename, name, len);
+        e->name_ofs = b->names_len;
+        e->err = 0;
+        if (fstatat(fd, name, &e->st, AT_SYMLINK_NOFOLLOW) != 0)
+            e->err = errno;
+        else if (S_ISDIR(e->st.st_mode))
+            ename[len++] = '/';
+        ename[len] = 0;
+        b->names_len += len + 1;
+    }
+    closedir(dir);
+    size_t i;
+    for (i = 0; i < b->n; i++)
+        b->ents[i].name = b->names + b->ents[i].name_ofs;
+    qsort(b->ents, b->n, sizeof(*b->ents), dir_entry_cmp_reverse);
+    return 0;
+
+ fail:
+    {
+        int err = errno ? errno : ENOMEM;
+        closedir(dir);
+        errno = err;
+        return -1;
+    }
+}
+
+static PyObject *ns_to_py(time_t s, long ns)
+{
+    // As xstat.timespec_to_nsecs() does, in a PY_LONG_LONG if it fits.
+    if (s < LLONG_MAX / 1000000000 - 1 && s > LLONG_MIN / 1000000000 + 1)
+        return PyLong_FromLongLong((PY_LONG_LONG) s * 1000000000 + ns);
+    PyObject *result = NULL;
+    PyObject *py_s = PyLong_FromLongLong(s);
+    PyObject *scale = PyLong_FromLong(1000000000);
+    PyObject *py_ns = PyLong_FromLong(ns);
+    PyObject *scaled = NULL;
+    if (py_s && scale && py_ns)
+        scaled = PyNumber_Multiply(py_s, scale);
+    if (scaled)
+        result = PyNumber_Add(scaled, py_ns);
+    Py_XDECREF(py_s);
+    Py_XDECREF(scale);
+    Py_XDECREF(py_ns);
+    Py_XDECREF(scaled);
+    return result;
+}
+
+static const char * const stat_field_names[] = {
+    "st_mode", "st_ino", "st_dev", "st_nlink", "st_uid", "st_gid",
+    "st_rdev", "st_size", "st_atime", "st_mtime", "st_ctime"
+};
+#define STAT_FIELDS (sizeof(stat_field_names) / sizeof(stat_field_names[0]))
+static PyObject *stat_field_keys[STAT_FIELDS];
+
+#pragma clang diagnostic push
+#pragma clang diagnostic ignored "-Wtautological-compare" // For INTEGER_TO_PY().
+
+// Return an instance of the (old style) class cls with the same
+// attributes as xstat.stat_result.from_xstat_rep() would give it,
+// without running any Python code.
+static PyObject *stat_to_instance(const struct stat *st, PyObject *cls)
+{
+    PyObject *values[STAT_FIELDS] = {
+        INTEGER_TO_PY(st->st_mode),
+        PyLong_FromUnsignedLongLong(st->st_ino),
+        INTEGER_TO_PY(st->st_dev),
+        INTEGER_TO_PY(st->st_nlink),
+        INTEGER_TO_PY(st->st_uid),
+        INTEGER_TO_PY(st->st_gid),
+        INTEGER_TO_PY(st->st_rdev),
+        PyLong_FromLongLong(st->st_size),
+        ns_to_py(st->st_atime, BUP_STAT_ATIME_NS(st)),
+        ns_to_py(st->st_mtime, BUP_STAT_MTIME_NS(st)),
+        ns_to_py(st->st_ctime, BUP_STAT_CTIME_NS(st))
+    };
+    PyObject *result = NULL;
+    PyObject *dict = PyDict_New();
+    size_t i;
+    if (!dict)
+        goto out;
+    for (i = 0; i < STAT_FIELDS; i++)
+        if (!values[i] || PyDict_SetItem(dict, stat_field_keys[i], values[i]))
+            goto out;
+    result = PyInstance_NewRaw(cls, dict);
+ out:
+    for (i = 0; i < STAT_FIELDS; i++)
+        Py_XDECREF(values[i]);
+    Py_XDECREF(dict);
+    return result;
+}
+
+#pragma clang diagnostic pop  // ignored "-Wtautological-compare"
+
+static PyObject *bup_open_dir(PyObject *self, PyObject *args)
+{
+    char *path;
+    int dir_fd = AT_FDCWD, fd;
+    if (!PyArg_ParseTuple(args, "s|i", &path, &dir_fd))
+        return NULL;
+    Py_BEGIN_ALLOW_THREADS
+    fd = openat(dir_fd, path, O_RDONLY | O_DIRECTORY | O_NOFOLLOW | O_NONBLOCK);
+    Py_END_ALLOW_THREADS
+    if (fd == -1)
+        return PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+    return Py_BuildValue("i", fd);
+}
+
+static PyObject *bup_read_dir(PyObject *self, PyObject *args)
+{
+    char *path;
+    PyObject *cls;
+    int dir_fd = AT_FDCWD;
+    if (!PyArg_ParseTuple(args, "sO|i", &path, &cls, &dir_fd))
+        return NULL;
+    if (!PyClass_Check(cls))
+        return PyErr_Format(PyExc_TypeError, "an old style class is required");
+    size_t i;
+    if (!stat_field_keys[0])
+        for (i = 0; i < STAT_FIELDS; i++)
+        {
+            stat_field_keys[i] = PyString_InternFromString(stat_field_names[i]);
+            if (!stat_field_keys[i])
+                return NULL;
+        }
+
+    struct dir_batch b = { NULL, 0, 0, NULL, 0, 0 };
+    struct stat dst;
+    int rc = -1, fd;
+    Py_BEGIN_ALLOW_THREADS
+    fd = openat(dir_fd, path, O_RDONLY | O_DIRECTORY | O_NOFOLLOW | O_NONBLOCK);
+    if (fd != -1)
+    {
+        rc = fstat(fd, &dst);
+        if (rc == 0)
+            rc = read_dir_batch(fd, &b);
+        int err = errno;
+        close(fd);
+        errno = err;
+    }
+    Py_END_ALLOW_THREADS
+    if (rc != 0)
+    {
+        dir_batch_free(&b);
+        return PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+    }
+
+    PyObject *result = NULL, *entries = NULL, *errors = NULL, *dir_st = NULL;
+    entries = PyList_New(0);
+    errors = PyList_New(0);
+    dir_st = stat_to_instance(&dst, cls);
+    if (!entries || !errors || !dir_st)
+        goto out;
+    for (i = 0; i < b.n; i++)
+    {
+        const struct dir_entry *e = &b.ents[i];
+        PyObject *item;
+        if (e->err)
+        {
+            PyObject *ex = PyObject_CallFunction(PyExc_OSError, "iss", e->err,
+                                                 strerror(e->err), e->name);
+            if (!ex)
+                goto out;
+            item = Py_BuildValue("(sN)", e->name, ex);
+            if (!item || PyList_Append(errors, item))
+            {
+                Py_XDECREF(item);
+                goto out;
+            }
+        }
+        else
+        {
+            PyObject *st = stat_to_instance(&e->st, cls);
+            if (!st)
+                goto out;
+            item = Py_BuildValue("(sN)", e->name, st);
+            if (!item || PyList_Append(entries, item))
+            {
+                Py_XDECREF(item);
+                goto out;
+            }
+        }
+        Py_DECREF(item);
+    }
+    result = Py_BuildValue("(OOO)", dir_st, entries, errors);
+ out:
+    Py_XDECREF(dir_st);
+    Py_XDECREF(entries);
+    Py_XDECREF(errors);
+    dir_batch_free(&b);
+    return result;
+}
+
+#endif /* BUP_HAVE_READ_DIR */
+
+
 #ifdef HAVE_TM_TM_GMTOFF
 static PyObject *bup_localtime(PyObject *self, PyObject *args)
 {
@@ -1388,20 +2491,41 @@ static PyMethodDef helper_methods[] = {
 	"Return the number of bits in the rolling checksum." },
     { "splitbuf", splitbuf, METH_VARARGS,
 	"Split a list of strings based on a rolling checksum." },
+    { "find_splits", find_splits, METH_VARARGS,
+	"Find all the chunk boundaries in a buffer and their fanout levels." },
+    { "fastcdc_find_splits", fastcdc_find_splits, METH_VARARGS,
+	"Like find_splits(), but using the FastCDC gear hash chunker." },
     { "bitmatch", bitmatch, METH_VARARGS,
 	"Count the number of matching prefix bits between two strings." },
     { "firstword", firstword, METH_VARARGS,
         "Return an int corresponding to the first 32 bits of buf." },
     { "bloom_contains", bloom_contains, METH_VARARGS,
 	"Check if a bloom filter of 2^nbits bytes contains an object" },
+    { "bloom_contains_many", bloom_contains_many, METH_VARARGS,
+	"Mark which of a string of shas a bloom filter might contain" },
     { "bloom_add", bloom_add, METH_VARARGS,
 	"Add an object to a bloom filter of 2^nbits bytes" },
+    { "blocked_bloom_contains", blocked_bloom_contains, METH_VARARGS,
+	"Check if a blocked bloom filter of 2^nbits bytes contains an object" },
+    { "blocked_bloom_contains_many", blocked_bloom_contains_many,
+	METH_VARARGS,
+	"Mark which of a string of shas a blocked bloom filter might contain" },
+    { "blocked_bloom_add", blocked_bloom_add, METH_VARARGS,
+	"Add objects to a blocked bloom filter of 2^nbits bytes" },
     { "extract_bits", extract_bits, METH_VARARGS,
 	"Take the first 'nbits' bits from 'buf' and return them as an int." },
     { "merge_into", merge_into, METH_VARARGS,
 	"Merges a bunch of idx and midx files into a single midx." },
+    { "idx_table_insert", idx_table_insert, METH_VARARGS,
+	"Insert a (sha, crc, ofs) entry into an idx table bytearray" },
+    { "idx_table_find", idx_table_find, METH_VARARGS,
+	"Return true if an idx table bytearray has an entry for sha" },
+    { "exists_many", exists_many, METH_VARARGS,
+	"Mark which of a string of sorted shas are in a sorted sha table" },
+    { "find_sha", find_sha, METH_VARARGS,
+	"Return (index or -1, steps) for a sha in a sorted table with a fanout" },
     { "write_idx", write_idx, METH_VARARGS,
-	"Write a PackIdxV2 file from an idx list of lists of tuples" },
+	"Write a PackIdxV2 file from the 256 bytearrays of an idx table" },
     { "write_random", write_random, METH_VARARGS,
 	"Write random bytes to the given file descriptor" },
     { "random_sha", random_sha, METH_VARARGS,
@@ -1418,6 +2542,16 @@ static PyMethodDef helper_methods[] = {
     { "set_linux_file_attr", bup_set_linux_file_attr, METH_VARARGS,
       "Set the Linux attributes for the given file." },
 #endif
+#ifdef BUP_HAVE_FIEMAP
+    { "fiemap", bup_fiemap, METH_VARARGS,
+      "Return the (logical, physical, length, flags) extents of a file." },
+    { "fstatfs_type", bup_fstatfs_type, METH_VARARGS,
+      "Return the f_type of the filesystem holding the given fd." },
+#endif
+#ifdef BUP_HAVE_BTRFS_TREE_SEARCH
+    { "btrfs_extent_generations", bup_btrfs_extent_generations, METH_VARARGS,
+      "Return the (logical, generation) of each btrfs extent of a file." },
+#endif
 #ifdef HAVE_UTIMENSAT
     { "bup_utimensat", bup_utimensat, METH_VARARGS,
       "Change path timestamps with nanosecond precision (POSIX)." },
@@ -1437,6 +2571,19 @@ static PyMethodDef helper_methods[] = {
       "Extended version of lstat." },
     { "fstat", bup_fstat, METH_VARARGS,
       "Extended version of fstat." },
+#ifdef BUP_HAVE_READ_DIR
+    { "open_dir", bup_open_dir, METH_VARARGS,
+      "open_dir(path, dir_fd=AT_FDCWD) -> fd\n\n"
+      "Open the directory at path, relative to dir_fd, without following\n"
+      "a symlink." },
+    { "read_dir", bup_read_dir, METH_VARARGS,
+      "read_dir(path, cls, dir_fd=AT_FDCWD)"
+      " -> (stat, [(name, stat)...], [(name, error)...])\n\n"
+      "Read the directory at path (which mustn't be a symlink), relative\n"
+      "to dir_fd, and lstat each entry relative to it, returning the stats\n"
+      "as instances of cls and the entries in reverse order, directories\n"
+      "with a trailing /." },
+#endif
 #ifdef HAVE_TM_TM_GMTOFF
     { "localtime", bup_localtime, METH_VARARGS,
       "Return struct_time elements plus the timezone offset and name." },
@@ -1475,8 +2622,16 @@ PyMODINIT_FUNC init_helpers(void)
     if (m == NULL)
         return;
 
+    fastcdc_init();
+
 #pragma clang diagnostic push
 #pragma clang diagnostic ignored "-Wtautological-compare" // For INTEGER_TO_PY().
+    {
+        PyObject *value;
+        value = INTEGER_TO_PY(BUP_WINDOWSIZE);
+        PyObject_SetAttrString(m, "WINDOWSIZE", value);
+        Py_DECREF(value);
+    }
 #ifdef HAVE_UTIMENSAT
     {
         PyObject *value;
@@ -1499,6 +2654,17 @@ PyMODINIT_FUNC init_helpers(void)
         Py_DECREF(value);
     }
 #endif
+#if defined(SEEK_DATA) && defined(SEEK_HOLE)
+    {
+        PyObject *value;
+        value = INTEGER_TO_PY(SEEK_DATA);
+        PyObject_SetAttrString(m, "SEEK_DATA", value);
+        Py_DECREF(value);
+        value = INTEGER_TO_PY(SEEK_HOLE);
+        PyObject_SetAttrString(m, "SEEK_HOLE", value);
+        Py_DECREF(value);
+    }
+#endif
 #pragma clang diagnostic pop  // ignored "-Wtautological-compare"
 
     e = getenv("BUP_FORCE_TTY");
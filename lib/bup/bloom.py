@@ -78,21 +78,97 @@ table with k=5 can represent the repository.
 None of this tells us what max_pfalse_positive to choose.
 
 Brandon Low <lostlogic@lostlogicx.com> 2011-02-04
+
+Once the filter doesn't fit in memory, the k random pages each lookup
+touches can each be a major fault.  So there's also a "blocked" layout
+(version 3 of the file), where the table is split into 64 byte blocks,
+and all k bits of an object are in the same block: one cache line, and
+one page, per lookup.  The bits are crowded together a bit more, so for
+the same size and k the false positive rate is a little higher (see
+pfalse_positive() and t/bench-bloom).
+
+A filter can't grow in place, so rather than rebuilding it from every
+.idx once it gets too full, bup bloom starts a new generation next to
+it (bup.1.bloom, bup.2.bloom, ...) for the objects that don't fit,
+at least as big as all of the earlier ones together.  BloomGenerations
+looks an object up in each of them, and once there are
+MAX_GENERATIONS, the next growth rebuilds them all as one.
 """
 import sys, os, math, mmap
 from bup import _helpers
 from bup.helpers import *
 
 BLOOM_VERSION = 2
+BLOCKED_BLOOM_VERSION = 3
 MAX_BITS_EACH = 32 # Kinda arbitrary, but 4 bytes per entry is pretty big
 MAX_BLOOM_BITS = {4: 37, 5: 29} # 160/k-log2(8)
 MAX_PFALSE_POSITIVE = 1. # Totally arbitrary, needs benchmarking
+MAX_GENERATIONS = 4
+
+# The block is addressed by 32 bits of the sha, and the bits within
+# it by 9 bits each of the next 64.
+BLOCK_BITS = 6
+MAX_BLOCKED_BLOOM_BITS = 32 + BLOCK_BITS
+MAX_BLOCKED_K = 7
 
 _total_searches = 0
 _total_steps = 0
 
 bloom_contains = _helpers.bloom_contains
+bloom_contains_many = _helpers.bloom_contains_many
 bloom_add = _helpers.bloom_add
+blocked_bloom_contains = _helpers.blocked_bloom_contains
+blocked_bloom_contains_many = _helpers.blocked_bloom_contains_many
+blocked_bloom_add = _helpers.blocked_bloom_add
+
+
+def generation_name(filename, i):
+    """Return the name of generation i of the bloom filter filename."""
+    if not i:
+        return filename
+    assert(filename.endswith('.bloom'))
+    return '%s.%d.bloom' % (filename[:-len('.bloom')], i)
+
+
+def generations(filename):
+    """Return the names of the existing generations of the bloom
+    filter filename, oldest first."""
+    result = []
+    while os.path.exists(generation_name(filename, len(result))):
+        result.append(generation_name(filename, len(result)))
+    return result
+
+
+def remove_idxnames(filename, counts):
+    """Remove the names in counts, a dict of idx names and their object
+    counts, from the generations of the bloom filter filename, and
+    their objects from its entry counts.  Their bits stay set, so it's
+    up to the caller to make sure that the objects it still has to
+    find are in another pack, or to add them again."""
+    for name in generations(filename):
+        b = ShaBloom(name)
+        if not b.valid():
+            continue
+        gone = [n for n in b.idxnames if n in counts]
+        if gone:
+            kept = '\0'.join(n for n in b.idxnames if n not in counts)
+            entries = max(0, b.entries - sum(counts[n] for n in gone))
+            names_ofs = b.table_ofs + 2**b.bits
+            old_len = len(b.map) - names_ofs
+        b.close()
+        if gone:
+            # Overwritten in place, rather than truncated, since other
+            # processes may have the file mapped.
+            with open(name, 'r+b') as f:
+                f.seek(12)
+                f.write(struct.pack('!I', entries))
+                f.seek(names_ofs)
+                f.write(kept + '\0' * (old_len - len(kept)))
+
+
+def _header_len(blocked):
+    # The blocked table starts on a cache line boundary.
+    return blocked and 64 or 16
 
 # FIXME: check bloom create() and ShaBloom handling/ownership of "f".
 # The ownership semantics should be clarified since the caller needs
@@ -146,17 +222,25 @@ class ShaBloom:
             log('Warning: ignoring old-style (v%d) bloom %r\n' 
                 % (ver, filename))
             return self._init_failed()
-        if ver > BLOOM_VERSION:
+        if ver > BLOCKED_BLOOM_VERSION:
             log('Warning: ignoring too-new (v%d) bloom %r\n'
                 % (ver, filename))
             return self._init_failed()
 
-        self.bits, self.k, self.entries = struct.unpack('!HHI', self.map[8:16])
-        idxnamestr = str(self.map[16 + 2**self.bits:])
-        if idxnamestr:
-            self.idxnames = idxnamestr.split('\0')
+        self.blocked = (ver == BLOCKED_BLOOM_VERSION)
+        self.table_ofs = _header_len(self.blocked)
+        if self.blocked:
+            self._add = blocked_bloom_add
+            self._contains = blocked_bloom_contains
+            self._contains_many = blocked_bloom_contains_many
         else:
-            self.idxnames = []
+            self._add = bloom_add
+            self._contains = bloom_contains
+            self._contains_many = bloom_contains_many
+        self.bits, self.k, self.entries = struct.unpack('!HHI', self.map[8:16])
+        idxnamestr = str(self.map[self.table_ofs + 2**self.bits:])
+        # remove_idxnames() may have left some padding
+        self.idxnames = [n for n in idxnamestr.split('\0') if n]
 
     def _init_failed(self):
         if self.map:
@@ -166,6 +250,7 @@ class ShaBloom:
             self.rwfile = None
         self.idxnames = []
         self.bits = self.entries = 0
+        self.blocked = False
 
     def valid(self):
         return self.map and self.bits
@@ -182,7 +267,7 @@ class ShaBloom:
                 self.rwfile.write(self.map)
             else:
                 self.map.flush()
-            self.rwfile.seek(16 + 2**self.bits)
+            self.rwfile.seek(self.table_ofs + 2**self.bits)
             if self.idxnames:
                 self.rwfile.write('\0'.join(self.idxnames))
         self._init_failed()
@@ -191,13 +276,26 @@ class ShaBloom:
         n = self.entries + additional
         m = 8*2**self.bits
         k = self.k
-        return 100*(1-math.exp(-k*float(n)/m))**k
+        if not self.blocked:
+            return 100*(1-math.exp(-k*float(n)/m))**k
+        # Each block is a little bloom filter of its own, holding a
+        # Poisson distributed number of the entries.
+        block = 8 << BLOCK_BITS
+        per_block = float(n) / (m // block)
+        if not per_block:
+            return 0.
+        p = 0.
+        for i in xrange(int(per_block + 10*math.sqrt(per_block) + 10)):
+            p_i = math.exp(i*math.log(per_block) - per_block
+                           - math.lgamma(i + 1))
+            p += p_i * (1 - (1 - 1./block)**(k*i))**k
+        return 100*p
 
     def add_idx(self, ix):
         """Add the object to the filter, return current pfalse_positive."""
         if not self.map:
             raise Exception("Cannot add to closed bloom")
-        self.entries += bloom_add(self.map, ix.shatable, self.bits, self.k)
+        self.entries += self._add(self.map, ix.shatable, self.bits, self.k)
         self.idxnames.append(os.path.basename(ix.name))
 
     def exists(self, sha):
@@ -211,29 +309,116 @@ class ShaBloom:
         _total_searches += 1
         if not self.map:
             return None
-        found, steps = bloom_contains(self.map, str(sha), self.bits, self.k)
+        found, steps = self._contains(self.map, str(sha), self.bits, self.k)
         _total_steps += steps
         return found
 
+    def exists_many(self, shas):
+        """Return a bitmap (see bitmap_test()) with bit i set if shas[i]
+        probably exists in the bloom filter, with the same caveats as
+        exists()."""
+        maybe = bytearray((len(shas) + 7) // 8)
+        self._exists_query(''.join([str(sha) for sha in shas]), maybe)
+        return maybe
+
+    def _exists_query(self, query, maybe):
+        """Set the bit in maybe for each of the concatenated shas in
+        query that probably exists, and return how many there were."""
+        global _total_searches, _total_steps
+        if not self.map:
+            return 0
+        _total_searches += len(query) // 20
+        count, steps = self._contains_many(self.map, query, self.bits,
+                                           self.k, maybe)
+        _total_steps += steps
+        return count
+
     def __len__(self):
         return int(self.entries)
 
 
-def create(name, expected, delaywrite=None, f=None, k=None):
-    """Create and return a bloom filter for `expected` entries."""
+class BloomGenerations:
+    """All the generations of a bloom filter, used as one."""
+    def __init__(self, filename):
+        self.name = filename
+        self.blooms = []
+        for name in generations(filename):
+            b = ShaBloom(name)
+            if not b.valid():
+                self.blooms = []
+                break
+            self.blooms.append(b)
+        self.idxnames = [n for b in self.blooms for n in b.idxnames]
+
+    def valid(self):
+        return bool(self.blooms)
+
+    def close(self):
+        for b in self.blooms:
+            b.close()
+        self.blooms = []
+        self.idxnames = []
+
+    def pfalse_positive(self):
+        p = 1.
+        for b in self.blooms:
+            p *= 1 - b.pfalse_positive() / 100
+        return 100 * (1 - p)
+
+    def exists(self, sha):
+        """Like ShaBloom.exists(), for any of the generations."""
+        for b in self.blooms:
+            found = b.exists(sha)
+            if found:
+                return found
+        return None
+
+    def exists_many(self, shas):
+        maybe = bytearray((len(shas) + 7) // 8)
+        self._exists_query(''.join([str(sha) for sha in shas]), maybe)
+        return maybe
+
+    def _exists_query(self, query, maybe):
+        """Like ShaBloom._exists_query(), for any of the generations.
+        maybe must be clear to begin with."""
+        if len(self.blooms) == 1:
+            return self.blooms[0]._exists_query(query, maybe)
+        for b in self.blooms:
+            b._exists_query(query, maybe)
+        return sum(bin(x).count('1') for x in maybe)
+
+    def __len__(self):
+        return sum(len(b) for b in self.blooms)
+
+
+def create(name, expected, delaywrite=None, f=None, k=None, blocked=False):
+    """Create and return a bloom filter for `expected` entries, with
+    the blocked layout if blocked is true."""
     bits = int(math.floor(math.log(expected*MAX_BITS_EACH/8,2)))
-    k = k or ((bits <= MAX_BLOOM_BITS[5]) and 5 or 4)
-    if bits > MAX_BLOOM_BITS[k]:
+    if blocked:
+        # The extra bits cost next to nothing once the block is in cache.
+        k = k or MAX_BLOCKED_K
+        max_bits = MAX_BLOCKED_BLOOM_BITS
+        bits = max(bits, BLOCK_BITS)
+    else:
+        k = k or ((bits <= MAX_BLOOM_BITS[5]) and 5 or 4)
+        max_bits = MAX_BLOOM_BITS[k]
+    if bits > max_bits:
         log('bloom: warning, max bits exceeded, non-optimal\n')
-        bits = MAX_BLOOM_BITS[k]
-    debug1('bloom: using 2^%d bytes and %d hash functions\n' % (bits, k))
+        bits = max_bits
+    debug1('bloom: using 2^%d bytes and %d hash functions%s\n'
+           % (bits, k, blocked and ' in 64 byte blocks' or ''))
+    header_len = _header_len(blocked)
     f = f or open(name, 'w+b')
     f.write('BLOM')
-    f.write(struct.pack('!IHHI', BLOOM_VERSION, bits, k, 0))
-    assert(f.tell() == 16)
+    f.write(struct.pack('!IHHI',
+                        blocked and BLOCKED_BLOOM_VERSION or BLOOM_VERSION,
+                        bits, k, 0))
+    f.write('\0' * (header_len - 16))
+    assert(f.tell() == header_len)
     # NOTE: On some systems this will not extend+zerofill, but it does on
     # darwin, linux, bsd and solaris.
-    f.truncate(16+2**bits)
+    f.truncate(header_len+2**bits)
     f.seek(0)
     if delaywrite != None and not delaywrite:
         # tell it to expect very few objects, forcing a direct mmap
@@ -91,39 +91,87 @@ static uint32_t rollsum_sum(uint8_t *buf, size_t ofs, size_t len)
 }
 
 
+static int rollsum_bits(uint32_t digest, int blobbits)
+{
+    int bits;
+    digest >>= blobbits;
+    for (bits = blobbits; (digest >>= 1) & 1; bits++)
+	;
+    return bits;
+}
+
+
+// This is rollsum_roll() over the whole buffer, but since the rollsum
+// starts over at every split point, the window is just the previous
+// BUP_WINDOWSIZE bytes of buf (or zeros), so we don't need a copy of it.
+// A split point is where the low blobbits bits of the digest are all
+// set, so blobs average 2^blobbits bytes.
+int bupsplit_find_ofs_bits(const unsigned char *buf, int len, int blobbits,
+			   int *bits)
+{
+    const unsigned mask = (1U << blobbits) - 1;
+    unsigned s1 = BUP_WINDOWSIZE * ROLLSUM_CHAR_OFFSET;
+    unsigned s2 = BUP_WINDOWSIZE * (BUP_WINDOWSIZE-1) * ROLLSUM_CHAR_OFFSET;
+    int count, head = len < BUP_WINDOWSIZE ? len : BUP_WINDOWSIZE;
+
+    for (count = 0; count < head; count++)
+    {
+	s1 += buf[count];
+	s2 += s1 - (BUP_WINDOWSIZE * ROLLSUM_CHAR_OFFSET);
+	if ((s2 & mask) == mask)
+	    goto found;
+    }
+    for (; count < len; count++)
+    {
+	uint8_t drop = buf[count - BUP_WINDOWSIZE];
+	s1 += buf[count] - drop;
+	s2 += s1 - (BUP_WINDOWSIZE * (drop + ROLLSUM_CHAR_OFFSET));
+	if ((s2 & mask) == mask)
+	    goto found;
+    }
+    return 0;
+
+found:
+    if (bits)
+	*bits = rollsum_bits((s1 << 16) | (s2 & 0xffff), blobbits);
+    return count+1;
+}
+
+
 int bupsplit_find_ofs(const unsigned char *buf, int len, int *bits)
+{
+    return bupsplit_find_ofs_bits(buf, len, BUP_BLOBBITS, bits);
+}
+
+
+#ifndef BUP_NO_SELFTEST
+#define BUP_SELFTEST_SIZE 100000
+
+// The straightforward version of bupsplit_find_ofs(), for comparison.
+static int find_ofs_slow(const unsigned char *buf, int len, int *bits)
 {
     Rollsum r;
     int count;
-    
+
     rollsum_init(&r);
     for (count = 0; count < len; count++)
     {
 	rollsum_roll(&r, buf[count]);
 	if ((r.s2 & (BUP_BLOBSIZE-1)) == ((~0) & (BUP_BLOBSIZE-1)))
 	{
-	    if (bits)
-	    {
-		unsigned rsum = rollsum_digest(&r);
-		rsum >>= BUP_BLOBBITS;
-		for (*bits = BUP_BLOBBITS; (rsum >>= 1) & 1; (*bits)++)
-		    ;
-	    }
+	    *bits = rollsum_bits(rollsum_digest(&r), BUP_BLOBBITS);
 	    return count+1;
 	}
     }
     return 0;
 }
 
-
-#ifndef BUP_NO_SELFTEST
-#define BUP_SELFTEST_SIZE 100000
-
 int bupsplit_selftest()
 {
     uint8_t *buf = malloc(BUP_SELFTEST_SIZE);
     uint32_t sum1a, sum1b, sum2a, sum2b, sum3a, sum3b;
     unsigned count;
+    int ofs1, ofs2, bits1 = 0, bits2 = 0, mismatch = 0;
     
     srandom(1);
     for (count = 0; count < BUP_SELFTEST_SIZE; count++)
@@ -143,9 +191,25 @@ int bupsplit_selftest()
     fprintf(stderr, "sum2b = 0x%08x\n", sum2b);
     fprintf(stderr, "sum3a = 0x%08x\n", sum3a);
     fprintf(stderr, "sum3b = 0x%08x\n", sum3b);
+
+    for (count = 0; count < BUP_SELFTEST_SIZE; count += ofs1)
+    {
+	ofs1 = bupsplit_find_ofs(buf + count, BUP_SELFTEST_SIZE - count,
+				 &bits1);
+	ofs2 = find_ofs_slow(buf + count, BUP_SELFTEST_SIZE - count, &bits2);
+	if (ofs1 != ofs2 || (ofs1 && bits1 != bits2))
+	{
+	    fprintf(stderr, "find_ofs mismatch at %u: %d/%d != %d/%d\n",
+		    count, ofs1, bits1, ofs2, bits2);
+	    mismatch = 1;
+	    break;
+	}
+	if (!ofs1)
+	    break;
+    }
     
     free(buf);
-    return sum1a!=sum1b || sum2a!=sum2b || sum3a!=sum3b;
+    return sum1a!=sum1b || sum2a!=sum2b || sum3a!=sum3b || mismatch;
 }
 
 #endif // !BUP_NO_SELFTEST
@@ -0,0 +1,304 @@
+"""Chunk maps, which let bup save re-split only the changed parts of
+large files.
+
+For each large enough file, save can record the (size, sha, level) of
+every blob the file was split into, along with the file's extents as
+reported by FIEMAP.  On a filesystem that never overwrites data in
+place (btrfs, for files without the NOCOW attribute), an unchanged
+extent means unchanged data, so the next save only has to read the
+regions whose extents differ (see hashsplit.resplit_to_blobs()).
+Everywhere else, no maps are kept, and ChunkMaps says so once per
+filesystem.
+
+An extent's location isn't enough by itself, though: once it's freed,
+btrfs can write new data to the same place, and that data can end up
+at the same offset of the same file.  So each extent also records the
+generation (transaction id) btrfs wrote it in, which such a rewrite
+always changes.  Reading those takes the btrfs tree search ioctl,
+which needs CAP_SYS_ADMIN, so without it, file_extents() raises
+Unavailable.
+"""
+
+import bisect, errno, hashlib, os, struct
+
+from bup import _helpers, hashsplit
+from bup.helpers import atomically_replaced_file, debug1, log, mkdirp, unlink
+
+
+BTRFS_SUPER_MAGIC = 0x9123683e
+trusted_fs_types = set([BTRFS_SUPER_MAGIC])
+
+FS_NOCOW_FL = 0x00800000
+
+FIEMAP_EXTENT_LAST = 0x1
+FIEMAP_EXTENT_UNKNOWN = 0x2
+FIEMAP_EXTENT_DELALLOC = 0x4
+FIEMAP_EXTENT_NOT_ALIGNED = 0x100
+FIEMAP_EXTENT_DATA_INLINE = 0x200
+FIEMAP_EXTENT_DATA_TAIL = 0x400
+FIEMAP_EXTENT_SHARED = 0x2000
+
+# Extents with these flags might change without moving.
+_untrusted_flags = (FIEMAP_EXTENT_UNKNOWN | FIEMAP_EXTENT_DELALLOC
+                    | FIEMAP_EXTENT_NOT_ALIGNED | FIEMAP_EXTENT_DATA_INLINE
+                    | FIEMAP_EXTENT_DATA_TAIL)
+# ...and these can change without the data changing.
+_ignored_flags = FIEMAP_EXTENT_LAST | FIEMAP_EXTENT_SHARED
+
+_fiemap = getattr(_helpers, 'fiemap', None)
+_fstatfs_type = getattr(_helpers, 'fstatfs_type', None)
+_btrfs_extent_generations = getattr(_helpers, 'btrfs_extent_generations',
+                                    None)
+_get_linux_file_attr = getattr(_helpers, 'get_linux_file_attr', None)
+
+CHUNKMAP_VERSION = 3
+_header = struct.Struct('!4sIQQQ16sIIIII')
+_extent = struct.Struct('!QQQIQ')
+_blob = struct.Struct('!I20sB')
+
+
+class Unavailable(Exception):
+    pass
+
+
+def check_available():
+    """Raise Unavailable unless this bup can keep chunk maps at all."""
+    if not (_fiemap and _fstatfs_type):
+        raise Unavailable('FIEMAP is not supported by this bup')
+    if not _btrfs_extent_generations:
+        raise Unavailable('btrfs tree searches are not supported by this bup')
+
+
+def _split_params():
+    """Return everything that determines where the blobs of a file
+    begin and end, and their levels."""
+    return (hashsplit.chunker, hashsplit.blobbits, hashsplit.BLOB_MAX,
+            hashsplit.fanout)
+
+
+def _with_generations(extents, generations):
+    """Return the (logical, physical, length, flags) extents as
+    (logical, physical, length, flags, generation), split where each
+    of the sorted (logical, generation) btrfs file extent items
+    starts.  The generation of anything no item covers is 0."""
+    starts = [logical for logical, gen in generations]
+    result = []
+    for logical, physical, length, flags in extents:
+        end = logical + length
+        i = bisect.bisect_right(starts, logical) - 1
+        pos = logical
+        while pos < end:
+            piece_end = min(starts[i + 1], end) if i + 1 < len(starts) else end
+            gen = generations[i][1] if i >= 0 else 0
+            result.append((pos, physical + pos - logical, piece_end - pos,
+                           flags, gen))
+            pos = piece_end
+            i += 1
+    return result
+
+
+def file_extents(f, path):
+    """Return the (logical, physical, length, flags, generation)
+    extents of the open file f, or None unless unchanged extents
+    imply unchanged data.  Raise Unavailable if the generations can't
+    be read."""
+    check_available()
+    fd = f.fileno()
+    try:
+        if _fstatfs_type(fd) not in trusted_fs_types:
+            return None
+        if _get_linux_file_attr and _get_linux_file_attr(path) & FS_NOCOW_FL:
+            return None
+        extents = _fiemap(fd)
+    except (IOError, OSError) as e:
+        debug1('chunkmap: no extents for %r: %s\n' % (path, e))
+        return None
+    try:
+        generations = _btrfs_extent_generations(fd)
+    except (IOError, OSError) as e:
+        if e.errno in (errno.EPERM, errno.EACCES):
+            raise Unavailable('reading btrfs extent generations requires '
+                              'root (CAP_SYS_ADMIN)')
+        debug1('chunkmap: no generations for %r: %s\n' % (path, e))
+        return None
+    return _with_generations(extents, generations)
+
+
+_HOLE = 'hole'
+
+def _segments(extents, size):
+    """Return contiguous (start, end, key) segments covering the first
+    size bytes, where bytes with the same key in two lists of extents
+    are known to be the same (unless the key is None)."""
+    segs = []
+    pos = 0
+    for logical, physical, length, flags, gen in sorted(extents):
+        if logical >= size:
+            break
+        if logical > pos:
+            segs.append((pos, logical, _HOLE))
+        start, end = max(logical, pos), min(logical + length, size)
+        if end <= start:
+            continue
+        if flags & _untrusted_flags or not physical or not gen:
+            key = None
+        else:
+            key = (physical - logical, flags & ~_ignored_flags, gen)
+        segs.append((start, end, key))
+        pos = end
+    if pos < size:
+        segs.append((pos, size, _HOLE))
+    return segs
+
+
+def changed_ranges(old_extents, old_size, extents, size):
+    """Return a sorted list of (start, end) ranges covering every byte
+    of a size byte file that might differ from when it was old_size
+    bytes long with the extents old_extents."""
+    old = _segments(old_extents, min(old_size, size))
+    new = _segments(extents, size)
+    changed = []
+    i = 0
+    for start, end, key in new:
+        pos = start
+        while pos < end:
+            while i < len(old) and old[i][1] <= pos:
+                i += 1
+            if i < len(old):
+                piece_end = min(old[i][1], end)
+                same = key is not None and old[i][2] == key
+            else:
+                piece_end = end
+                same = False
+            if not same:
+                if changed and changed[-1][1] == pos:
+                    changed[-1] = (changed[-1][0], piece_end)
+                else:
+                    changed.append((pos, piece_end))
+            pos = piece_end
+    return changed
+
+
+class ChunkMaps:
+    """The chunk maps stored in dir, for files of at least min_size
+    bytes."""
+    def __init__(self, dir, min_size):
+        self.dir = dir
+        self.min_size = min_size
+        self.bytes_total = 0
+        self.bytes_read = 0
+        self._unmapped_devs = set()
+
+    def _name(self, path):
+        return os.path.join(self.dir, hashlib.sha1(path).hexdigest())
+
+    def _read_header(self, f):
+        hdr = f.read(_header.size)
+        if len(hdr) < _header.size:
+            return None
+        fields = _header.unpack(hdr)
+        if fields[0] != 'BCHM' or fields[1] != CHUNKMAP_VERSION:
+            return None
+        path = f.read(fields[-1])
+        size, dev, ino = fields[2:5]
+        params = (fields[5].rstrip('\0'),) + fields[6:9]
+        return (size, dev, ino, params, fields[9], path)
+
+    def _open(self, path, st):
+        """Return (size, extents, blobs) for the usable map of path, if any."""
+        try:
+            f = open(self._name(path), 'rb')
+        except IOError:
+            return None
+        hdr = self._read_header(f)
+        if not hdr:
+            f.close()
+            return None
+        size, dev, ino, params, n_extents, map_path = hdr
+        if (map_path != path or (dev, ino) != (st.st_dev, st.st_ino)
+            or params != _split_params()):
+            f.close()
+            return None
+        extents = [_extent.unpack(f.read(_extent.size))
+                   for i in xrange(n_extents)]
+        def blobs():
+            try:
+                while 1:
+                    b = f.read(_blob.size)
+                    if len(b) < _blob.size:
+                        break
+                    yield _blob.unpack(b)
+            finally:
+                f.close()
+        return size, extents, blobs()
+
+    def split_to_blob_or_tree(self, makeblob, maketree, f, path, exists,
+                              makeblobs=None):
+        """Return (mode, sha) for the file f at path, just like
+        hashsplit.split_to_blob_or_tree(), but using and updating the
+        chunk map for path when possible."""
+        st = os.fstat(f.fileno())
+        extents = None
+        if st.st_size >= self.min_size:
+            extents = file_extents(f, path)
+            if extents is None:
+                unlink(self._name(path))
+                if st.st_dev not in self._unmapped_devs:
+                    self._unmapped_devs.add(st.st_dev)
+                    log('warning: not keeping a chunk map for %r (maps are'
+                        ' only kept on btrfs, without No_COW)\n' % path)
+        if extents is None:
+            return hashsplit.split_to_blob_or_tree(makeblob, maketree, [f],
+                                                   keep_boundaries=False,
+                                                   makeblobs=makeblobs)
+        self.bytes_total += st.st_size
+        old = self._open(path, st)
+        if old:
+            old_size, old_extents, old_blobs = old
+            changed = changed_ranges(old_extents, old_size,
+                                     extents, st.st_size)
+            debug1('chunkmap: %r: %d changed ranges\n' % (path, len(changed)))
+            read_before = hashsplit.total_resplit_read
+            sl = hashsplit.resplit_to_blobs(makeblob, f, st.st_size,
+                                            old_blobs, old_size,
+                                            changed, exists)
+        else:
+            read_before = None
+            sl = hashsplit.split_to_blobs(makeblob, [f], False, None,
+                                          makeblobs=makeblobs)
+        mkdirp(self.dir)
+        with atomically_replaced_file(self._name(path), 'wb') as out:
+            out.write(_header.pack('BCHM', CHUNKMAP_VERSION, st.st_size,
+                                   st.st_dev, st.st_ino,
+                                   *(_split_params()
+                                     + (len(extents), len(path)))))
+            out.write(path)
+            for e in extents:
+                out.write(_extent.pack(*e))
+            def recorded(sl):
+                for sha, size, level in sl:
+                    out.write(_blob.pack(size, sha, level))
+                    yield sha, size, level
+            result = hashsplit.blobs_to_blob_or_tree(makeblob, maketree,
+                                                     recorded(sl))
+        if read_before is None:
+            self.bytes_read += st.st_size
+        else:
+            self.bytes_read += hashsplit.total_resplit_read - read_before
+        return result
+
+    def prune(self):
+        """Remove the maps of paths that no longer exist."""
+        try:
+            names = os.listdir(self.dir)
+        except OSError:
+            return
+        for name in names:
+            try:
+                with open(os.path.join(self.dir, name), 'rb') as f:
+                    hdr = self._read_header(f)
+            except IOError:
+                continue
+            if not hdr or not os.path.lexists(hdr[-1]):
+                debug1('chunkmap: removing %s\n' % name)
+                unlink(os.path.join(self.dir, name))
@@ -1,5 +1,5 @@
 import re, struct, errno, time, zlib
-from bup import git, ssh
+from bup import git, ssh, stats
 from bup.helpers import *
 
 bwlimit = None
@@ -53,7 +53,7 @@ def parse_remote(remote):
 
 class Client:
     def __init__(self, remote, create=False):
-        self._busy = self.conn = None
+        self._busy = self.conn = self._commands = None
         self.sock = self.p = self.pout = self.pin = None
         is_reverse = os.environ.get('BUP_SERVER_REVERSE')
         if is_reverse:
@@ -101,6 +101,7 @@ class Client:
                 raise
 
     def close(self):
+        git.wait_for_midx(self.cachedir)
         if self.conn and not self._busy:
             self.conn.write('quit\n')
         if self.pin:
@@ -189,12 +190,13 @@ class Client:
         self.conn.write('send-index %s\n' % name)
         n = struct.unpack('!I', self.conn.read(4))[0]
         assert(n)
-        with atomically_replaced_file(fn, 'w') as f:
+        with atomically_replaced_file(fn, 'w') as f, stats.phase('network'):
             count = 0
             progress('Receiving index from server: %d/%d\r' % (count, n))
             for b in chunkyreader(self.conn, n):
                 f.write(b)
                 count += len(b)
+                stats.count('network-bytes-in', len(b))
                 qprogress('Receiving index from server: %d/%d\r' % (count, n))
             progress('Receiving index from server: %d/%d, done.\n' % (count, n))
             self.check_ok()
@@ -228,13 +230,13 @@ class Client:
         idx = None
         for idx in suggested:
             self.sync_index(idx)
-        git.auto_midx(self.cachedir)
+        git.auto_midx(self.cachedir, wait=False)
         if ob:
             self._busy = ob
             self.conn.write('%s\n' % ob)
         return idx
 
-    def new_packwriter(self, compression_level = 1):
+    def new_packwriter(self, compression_level = 1, jobs = 1):
         self.check_busy()
         def _set_busy():
             self._busy = 'receive-objects-v2'
@@ -245,7 +247,8 @@ class Client:
                                  onopen = _set_busy,
                                  onclose = self._not_busy,
                                  ensure_busy = self.ensure_busy,
-                                 compression_level = compression_level)
+                                 compression_level = compression_level,
+                                 jobs = jobs)
 
     def read_ref(self, refname):
         self.check_busy()
@@ -265,6 +268,31 @@ class Client:
                            (oldval or '').encode('hex')))
         self.check_ok()
 
+    def _server_commands(self):
+        if self._commands is None:
+            self.check_busy()
+            self.conn.write('help\n')
+            self.conn.outp.flush()
+            self._commands = set()
+            for line in linereader(self.conn):
+                if line == 'ok':
+                    break
+                if line.startswith('    '):
+                    self._commands.add(line.strip())
+        return self._commands
+
+    def config_get(self, name):
+        """Return the value of the remote repository's configuration
+        option name, or None if it's not set (or the server is too old
+        to say)."""
+        if 'config-get' not in self._server_commands():
+            return None
+        self.check_busy()
+        self.conn.write('config-get %s\n' % re.sub(r'[\s]', '_', name))
+        r = self.conn.readline().strip()
+        self.check_ok()
+        return r.decode('hex') or None
+
     def cat(self, id):
         self.check_busy()
         self._busy = 'cat'
@@ -283,8 +311,8 @@ class PackWriter_Remote(git.PackWriter):
     def __init__(self, conn, objcache_maker, suggest_packs,
                  onopen, onclose,
                  ensure_busy,
-                 compression_level=1):
-        git.PackWriter.__init__(self, objcache_maker)
+                 compression_level=1, jobs=1):
+        git.PackWriter.__init__(self, objcache_maker, jobs=jobs)
         self.file = conn
         self.filename = 'remote socket'
         self.suggest_packs = suggest_packs
@@ -299,18 +327,29 @@ class PackWriter_Remote(git.PackWriter):
         if not self._packopen:
             self.onopen()
             self._packopen = True
+            # Only for exists(); the server decides the offsets.
+            self.idx = git.PackIdxTable()
 
     def _end(self):
         if self._packopen and self.file:
-            self.file.write('\0\0\0\0')
-            self._packopen = False
-            self.onclose() # Unbusy
-            self.objcache = None
-            return self.suggest_packs() # Returns last idx received
+            with stats.phase('network'):
+                self.file.write('\0\0\0\0')
+                self._packopen = False
+                self.onclose() # Unbusy
+                id = self.suggest_packs() # Returns last idx received
+            # The new pack's index is in the cache now.
+            with self._objcache_lock:
+                self.idx = None
+                if self.objcache is not None:
+                    self.objcache.refresh_if_changed()
+            return id
 
     def close(self):
+        self._close_pool()
         id = self._end()
         self.file = None
+        with self._objcache_lock:
+            self.objcache = None
         return id
 
     def abort(self):
@@ -330,15 +369,21 @@ class PackWriter_Remote(git.PackWriter):
                           struct.pack('!I', crc),
                           data))
         try:
-            (self._bwcount, self._bwtime) = _raw_write_bwlimit(
-                    self.file, outbuf, self._bwcount, self._bwtime)
+            with stats.phase('network'):
+                (self._bwcount, self._bwtime) = _raw_write_bwlimit(
+                        self.file, outbuf, self._bwcount, self._bwtime)
         except IOError as e:
             raise ClientError, e, sys.exc_info()[2]
+        self.idx.add(sha, crc, 0)
         self.outbytes += len(data)
         self.count += 1
+        stats.count('pack-objects')
+        stats.count('pack-bytes', len(data))
+        stats.count('network-bytes-out', len(outbuf))
 
         if self.file.has_input():
-            self.suggest_packs()
+            with stats.phase('network'):
+                self.suggest_packs()
             self.objcache.refresh()
 
         return sha, crc
@@ -1,4 +1,6 @@
 import stat, os
+from collections import deque
+from multiprocessing.pool import ThreadPool
 from bup.helpers import *
 import bup.xstat as xstat
 
@@ -16,9 +18,14 @@ except AttributeError:
 #  - help out the kernel by not making it repeatedly look up the absolute path
 #  - avoid race conditions caused by doing listdir() on a changing symlink
 class OsFile:
-    def __init__(self, path):
+    def __init__(self, path, dir_fd=None):
         self.fd = None
-        self.fd = os.open(path, os.O_RDONLY|O_LARGEFILE|O_NOFOLLOW|os.O_NDELAY)
+        if dir_fd is None:
+            self.fd = os.open(path,
+                              os.O_RDONLY|O_LARGEFILE|O_NOFOLLOW|os.O_NDELAY)
+        else:
+            # path must be a directory, relative to dir_fd's.
+            self.fd = xstat.open_dir(path, dir_fd)
         
     def __del__(self):
         if self.fd:
@@ -33,26 +40,19 @@ class OsFile:
         return xstat.fstat(self.fd)
 
 
-_IFMT = stat.S_IFMT(0xffffffff)  # avoid function call in inner loop
 def _dirlist():
-    l = []
-    for n in os.listdir('.'):
-        try:
-            st = xstat.lstat(n)
-        except OSError as e:
-            add_error(Exception('%s: %s' % (resolve_parent(n), str(e))))
-            continue
-        if (st.st_mode & _IFMT) == stat.S_IFDIR:
-            n += '/'
-        l.append((n,st))
-    l.sort(reverse=True)
+    st, l, errors = xstat.read_dir('.')
+    for (n,e) in errors:
+        add_error(Exception('%s: %s' % (resolve_parent(n), str(e))))
     return l
 
 
-def _recursive_dirlist(prepend, xdev, bup_dir=None,
-                       excluded_paths=None,
-                       exclude_rxs=None):
-    for (name,pst) in _dirlist():
+def _walk_entries(prepend, entries, xdev, bup_dir, excluded_paths,
+                  exclude_rxs):
+    """Generate (path, pst, descend) for each of the (name, pst)
+    entries of the directory prepend that isn't excluded, where
+    descend says whether to walk its contents too."""
+    for (name,pst) in entries:
         path = prepend + name
         if excluded_paths:
             if os.path.normpath(path) in excluded_paths:
@@ -60,6 +60,7 @@ def _recursive_dirlist(prepend, xdev, bup_dir=None,
                 continue
         if exclude_rxs and should_rx_exclude_path(path, exclude_rxs):
             continue
+        descend = False
         if name.endswith('/'):
             if bup_dir != None:
                 if os.path.normpath(path) == bup_dir:
@@ -68,23 +69,153 @@ def _recursive_dirlist(prepend, xdev, bup_dir=None,
             if xdev != None and pst.st_dev != xdev:
                 debug1('Skipping contents of %r: different filesystem.\n' % path)
             else:
-                try:
-                    OsFile(name).fchdir()
-                except OSError as e:
-                    add_error('%s: %s' % (prepend, e))
-                else:
-                    for i in _recursive_dirlist(prepend=prepend+name, xdev=xdev,
-                                                bup_dir=bup_dir,
-                                                excluded_paths=excluded_paths,
-                                                exclude_rxs=exclude_rxs):
-                        yield i
-                    os.chdir('..')
+                descend = True
+        yield (path, pst, descend)
+
+
+def _recursive_dirlist(prepend, xdev, bup_dir=None,
+                       excluded_paths=None,
+                       exclude_rxs=None):
+    for (path,pst,descend) in _walk_entries(prepend, _dirlist(), xdev,
+                                            bup_dir, excluded_paths,
+                                            exclude_rxs):
+        if descend:
+            try:
+                OsFile(path[len(prepend):]).fchdir()
+            except OSError as e:
+                add_error('%s: %s' % (prepend, e))
+            else:
+                for i in _recursive_dirlist(prepend=path, xdev=xdev,
+                                            bup_dir=bup_dir,
+                                            excluded_paths=excluded_paths,
+                                            exclude_rxs=exclude_rxs):
+                    yield i
+                os.chdir('..')
+        yield (path, pst)
+
+
+# With more than one job, a pool of threads lists the next few
+# directories the walk will need while it's busy with the current
+# one, which helps most where each lstat() waits on the network.  The
+# threads can't each have their own current directory, so they open
+# each directory relative to its parent's open OsFile (which keeps
+# paths longer than PATH_MAX working), without following symlinks, and
+# check that it's still the one its parent's listing found.
+def _dirlist_at(parent, dir, pst):
+    """Return an OsFile for dir (ending in a slash), opened relative to
+    its parent, which is open as the OsFile parent, and its entries like
+    _dirlist(), or (None, None) if it can't be read, and a list of the
+    errors to report."""
+    try:
+        f = OsFile(os.path.basename(dir[:-1]), dir_fd=parent.fd)
+        st, l, errors = xstat.read_dir('.', dir_fd=f.fd)
+    except OSError as e:
+        return None, None, ['%s: %s' % (dir, e)]
+    if (st.st_dev, st.st_ino) != (pst.st_dev, pst.st_ino):
+        return None, None, ['%s: changed while being indexed' % dir]
+    return f, l, ['%s: %s' % (dir + n, e) for (n,e) in errors]
+
+
+class _DirPrefetcher:
+    """Lists directories in a pool of jobs threads, in the order the
+    walk will want them, holding at most window listings that it
+    hasn't asked for yet, and starting at most ahead of the
+    directories in any one directory before the walk gets to them."""
+    def __init__(self, jobs, window, ahead):
+        self.pool = ThreadPool(jobs)
+        self.window = window
+        self.ahead = ahead
+        # For each directory being walked that has subdirectories the
+        # walk hasn't got to yet, from the top down, its OsFile, which
+        # is only held open here, and a deque of [dir, pst,
+        # AsyncResult or None] for those subdirectories.  The started
+        # ones are always at the front.
+        self.levels = []
+        self.started = 0
+
+    def want(self, parent, dirs):
+        """Note that the (dir, pst) dirs, in the directory open as the
+        OsFile parent, will be wanted, in order, before any others
+        wanted so far."""
+        if dirs:
+            self.levels.append((parent, deque([dir, pst, None]
+                                              for (dir, pst) in dirs)))
+            self._fill()
+
+    def _fill(self):
+        # Start the listings the walk will want soonest first, so that
+        # a wide directory's later subdirectories don't keep the
+        # window full while the walk lists the nearer ones itself.
+        for (parent, level) in reversed(self.levels):
+            for i in xrange(min(self.ahead, len(level))):
+                if self.started >= self.window:
+                    return
+                item = level[i]
+                if not item[2]:
+                    item[2] = self.pool.apply_async(_dirlist_at,
+                                                    (parent, item[0], item[1]))
+                    self.started += 1
+
+    def get(self, dir, pst):
+        """Return what _dirlist_at() does for dir."""
+        (parent, level) = self.levels[-1]
+        (wanted, _, result) = level.popleft()
+        assert(wanted == dir)
+        if not level:
+            self.levels.pop()
+        if result:
+            self.started -= 1
+            result = result.get()
+        else:
+            # The window was full of listings the walk will want
+            # later, so do this one now.
+            result = _dirlist_at(parent, dir, pst)
+        self._fill()
+        return result
+
+    def close(self):
+        del self.levels[:]
+        self.pool.close()
+        self.pool.join()
+
+
+def _recursive_dirlist_parallel(prefetcher, dirfile, prepend, entries, xdev,
+                                bup_dir=None, excluded_paths=None,
+                                exclude_rxs=None):
+    walk = list(_walk_entries(prepend, entries, xdev, bup_dir,
+                              excluded_paths, exclude_rxs))
+    prefetcher.want(dirfile, [(path, pst) for (path, pst, descend) in walk
+                              if descend])
+    # Leave it to the prefetcher to hold each directory open only as
+    # long as it's needed, so that a deep walk doesn't run out of fds.
+    del dirfile
+    for (path,pst,descend) in walk:
+        if descend:
+            subfile, sub, errors = prefetcher.get(path, pst)
+            for e in errors:
+                add_error(e)
+            if sub is not None:
+                sub = _recursive_dirlist_parallel(prefetcher, subfile,
+                                                  path, sub,
+                                                  xdev, bup_dir,
+                                                  excluded_paths,
+                                                  exclude_rxs)
+                del subfile
+                for i in sub:
+                    yield i
         yield (path, pst)
 
 
 def recursive_dirlist(paths, xdev, bup_dir=None, excluded_paths=None,
-                      exclude_rxs=None):
+                      exclude_rxs=None, jobs=1):
+    """Generate (path, stat) for paths and everything under them, each
+    directory's contents in reverse sorted order, before the directory
+    itself.  With jobs > 1, that many threads list directories ahead
+    of the walk, but the order is the same."""
     startdir = OsFile('.')
+    prefetcher = None
+    if jobs > 1 and xstat.have_dir_fd:
+        prefetcher = _DirPrefetcher(jobs, window=jobs * 8, ahead=jobs * 2)
     try:
         assert(type(paths) != type(''))
         for path in paths:
@@ -106,7 +237,24 @@ def recursive_dirlist(paths, xdev, bup_dir=None, excluded_paths=None,
                 xdev = pst.st_dev
             else:
                 xdev = None
-            if stat.S_ISDIR(pst.st_mode):
+            if stat.S_ISDIR(pst.st_mode) and prefetcher:
+                prepend = os.path.join(path, '')
+                try:
+                    st, entries, errors = xstat.read_dir('.', dir_fd=pfile.fd)
+                except OSError as e:
+                    add_error('%s: %s' % (prepend, e))
+                    entries, errors = None, []
+                for (n,e) in errors:
+                    add_error('%s: %s' % (prepend + n, e))
+                if entries is not None:
+                    for i in _recursive_dirlist_parallel(prefetcher, pfile,
+                                                         prepend,
+                                                         entries, xdev,
+                                                         bup_dir,
+                                                         excluded_paths,
+                                                         exclude_rxs):
+                        yield i
+            elif stat.S_ISDIR(pst.st_mode):
                 pfile.fchdir()
                 prepend = os.path.join(path, '')
                 for i in _recursive_dirlist(prepend=prepend, xdev=xdev,
@@ -124,3 +272,6 @@ def recursive_dirlist(paths, xdev, bup_dir=None, excluded_paths=None,
         except:
             pass
         raise
+    finally:
+        if prefetcher:
+            prefetcher.close()
@@ -0,0 +1,96 @@
+#include "fastcdc.h"
+#include <stdint.h>
+
+// A content defined chunker based on a "gear" rolling hash, as
+// described in "FastCDC: a Fast and Efficient Content-Defined Chunking
+// Approach for Data Deduplication" (Xia et al., USENIX ATC '16).  Each
+// byte just shifts the hash left and adds a random value for the byte,
+// so the top bits of the hash depend on the last 64 bytes.  Split
+// points are where enough of the top bits are zero, and nothing in the
+// first quarter of the average chunk size is ever looked at.
+
+// The gear table is part of the repository format: changing it (or
+// the seed it's generated from) changes every split point.
+static uint64_t gear[256];
+
+void fastcdc_init(void)
+{
+    // splitmix64
+    uint64_t x = 0x6275702d67656172ULL;  // "bup-gear"
+    int i;
+    for (i = 0; i < 256; i++)
+    {
+        uint64_t z = (x += 0x9e3779b97f4a7c15ULL);
+        z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+        z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+        gear[i] = z ^ (z >> 31);
+    }
+}
+
+
+static int leading_zeros(uint64_t h)
+{
+    if (!h)
+        return 64;
+#ifdef __GNUC__
+    return __builtin_clzll(h);
+#else
+    {
+        int n = 0;
+        while (!(h & (1ULL << 63)))
+        {
+            h <<= 1;
+            n++;
+        }
+        return n;
+    }
+#endif
+}
+
+
+// Return the number of bytes up to and including the first split point
+// in buf, or 0 if there isn't one, and set *bits to the number of
+// leading zero bits in the hash there.  Before 2^blobbits bytes, a
+// split point needs FASTCDC_NORMAL_LEVEL more zero bits than blobbits,
+// and after it, that many less, which keeps the chunk sizes closer to
+// the average.
+int fastcdc_find_ofs(const unsigned char *buf, int len, int blobbits,
+                     int *bits)
+{
+    const uint64_t hard = UINT64_MAX >> (blobbits + FASTCDC_NORMAL_LEVEL);
+    const uint64_t easy = UINT64_MAX >> (blobbits - FASTCDC_NORMAL_LEVEL);
+    const int normal_size = 1 << blobbits;
+    const int normal = len < normal_size ? len : normal_size;
+    uint64_t h = 0;
+    int i;
+
+#define GEAR_STEP(limit) \
+    do { \
+        h = (h << 1) + gear[buf[i]]; \
+        if (h <= (limit)) \
+            goto found; \
+        i++; \
+    } while (0)
+
+    i = normal_size / 4;
+    for (; i + 4 <= normal;)
+    {
+        GEAR_STEP(hard); GEAR_STEP(hard); GEAR_STEP(hard); GEAR_STEP(hard);
+    }
+    while (i < normal)
+        GEAR_STEP(hard);
+    for (; i + 4 <= len;)
+    {
+        GEAR_STEP(easy); GEAR_STEP(easy); GEAR_STEP(easy); GEAR_STEP(easy);
+    }
+    while (i < len)
+        GEAR_STEP(easy);
+    return 0;
+
+#undef GEAR_STEP
+
+found:
+    if (bits)
+        *bits = leading_zeros(h);
+    return i + 1;
+}
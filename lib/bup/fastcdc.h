@@ -0,0 +1,23 @@
+#ifndef __FASTCDC_H
+#define __FASTCDC_H
+
+#include "bupsplit.h"
+
+// Chunks average a bit more than 2^blobbits bytes: no split point is
+// considered in the first quarter of that, split points are harder to
+// find until 2^blobbits bytes, and easier after.
+#define FASTCDC_NORMAL_LEVEL (2)
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+void fastcdc_init(void);
+int fastcdc_find_ofs(const unsigned char *buf, int len, int blobbits,
+                     int *bits);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif /* __FASTCDC_H */
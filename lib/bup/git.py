@@ -3,17 +3,23 @@ bup repositories are in Git format. This library allows us to
 interact with the Git data structures.
 """
 import os, sys, zlib, time, subprocess, struct, stat, re, tempfile, glob
-from collections import namedtuple
+import fcntl, threading
+from contextlib import contextmanager
+from collections import OrderedDict, deque, namedtuple
 from itertools import islice
+from multiprocessing.pool import ThreadPool
 
 from bup.helpers import *
-from bup import _helpers, path, midx, bloom, xstat
+from bup import _helpers, path, midx, bloom, stats, xstat
 
 max_pack_size = 1000*1000*1000  # larger packs will slow down pruning
 max_pack_objects = 200*1000  # cache memory usage is about 83 bytes per object
+max_pack_held = 64*1000*1000  # packs up to this size are summed without a re-read
 
 verbose = 0
 ignore_midx = 0
+hot_packs = 16  # indexes PackIdxList.exists() tries first, most recent first
+use_pack_reader = True
 repodir = None
 
 _typemap =  { 'blob':3, 'tree':2, 'commit':1, 'tag':4 }
@@ -21,6 +27,11 @@ _typermap = { 3:'blob', 2:'tree', 1:'commit', 4:'tag' }
 
 _total_searches = 0
 _total_steps = 0
+# How PackIdxList.exists() lookups ended: found in a hot index, found in
+# another one, ruled out by the bloom filter, or not found anyway
+# (bloom_false_positives of those despite the bloom).
+_lookups = dict.fromkeys(('hot_hits', 'cold_hits', 'bloom_rejects', 'misses',
+                          'bloom_false_positives'), 0)
 
 
 class GitError(Exception):
@@ -125,8 +136,7 @@ def all_packdirs():
     return paths
 
 
-def auto_midx(objdir):
-    args = [path.exe(), 'midx', '--auto', '--dir', objdir]
+def _run_maintenance(args):
     try:
         rv = subprocess.call(args, stdout=open('/dev/null', 'w'))
     except OSError as e:
@@ -136,15 +146,84 @@ def auto_midx(objdir):
     if rv:
         add_error('%r: returned %d' % (args, rv))
 
-    args = [path.exe(), 'bloom', '--dir', objdir]
-    try:
-        rv = subprocess.call(args, stdout=open('/dev/null', 'w'))
-    except OSError as e:
-        # make sure 'args' gets printed to help with debugging
-        add_error('%r: exception: %s' % (args, e))
-        raise
-    if rv:
-        add_error('%r: returned %d' % (args, rv))
+
+@contextmanager
+def lock_packdir(objdir):
+    """Hold the lock that keeps anyone else from changing the .midx
+    files, bloom filter, or set of packs in objdir, waiting for it if
+    necessary."""
+    with open(os.path.join(objdir, 'bup.lock'), 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def _update_midx(objdir, have_lock=False):
+    """Bring the .midx files and the bloom filter in objdir up to date.
+    If have_lock, the caller already holds lock_packdir(objdir)."""
+    if not os.path.isdir(objdir):
+        return
+    # Only one process at a time merges the indexes in a directory, and
+    # updates its bloom filter in place.  Anyone else waits, and then
+    # finds whatever is left to do, usually nothing.
+    if not have_lock:
+        with lock_packdir(objdir):
+            _update_midx(objdir, have_lock=True)
+        return
+    _run_maintenance([path.exe(), 'midx', '--auto', '--dir', objdir])
+    _run_maintenance([path.exe(), 'bloom', '--dir', objdir])
+
+
+_midx_lock = threading.Lock()
+_midx_pending = {}  # objdir -> [thread, another pass wanted]
+
+def _midx_thread(objdir):
+    while True:
+        try:
+            _update_midx(objdir)
+        except Exception as e:
+            add_error('midx: %s: %s' % (objdir, e))
+        with _midx_lock:
+            pending = _midx_pending[objdir]
+            if not pending[1]:
+                del _midx_pending[objdir]
+                return
+            pending[1] = False
+
+
+def wait_for_midx(objdir=None):
+    """Wait for any background auto_midx() work on objdir (or on every
+    directory, if objdir is None) to finish."""
+    while True:
+        with _midx_lock:
+            threads = [t for d, (t, again) in _midx_pending.iteritems()
+                       if objdir is None or d == objdir]
+        if not threads:
+            return
+        for t in threads:
+            t.join()
+
+
+def auto_midx(objdir, wait=True):
+    """Bring the .midx files and the bloom filter in objdir up to date
+    with its .idx files.  If wait is false, do it in a background
+    thread, so that the caller doesn't wait for it; any further requests
+    made while that runs are folded into one more pass when it's done."""
+    if wait:
+        wait_for_midx(objdir)
+        _update_midx(objdir)
+        return
+    with _midx_lock:
+        pending = _midx_pending.get(objdir)
+        if pending:
+            pending[1] = True
+            return
+        t = threading.Thread(target=_midx_thread, args=(objdir,))
+        t.daemon = True
+        _midx_pending[objdir] = [t, False]
+        t.start()
 
 
 def mangle_name(name, mode, gitmode):
@@ -188,9 +267,12 @@ def demangle_name(name, mode):
 def calc_hash(type, content):
     """Calculate some content's hash in the Git fashion."""
     header = '%s %d\0' % (type, len(content))
-    sum = Sha1(header)
-    sum.update(content)
-    return sum.digest()
+    with stats.phase('sha1'):
+        sum = Sha1(header)
+        sum.update(content)
+        digest = sum.digest()
+    stats.count('sha1-bytes', len(content))
+    return digest
 
 
 def shalist_item_sort_key(ent):
@@ -231,6 +313,10 @@ def tree_decode(buf):
         yield (int(mode, 8), name, sha)
 
 
+def _pack_header(count):
+    return struct.pack('!4sII', 'PACK', 2, count)
+
+
 def _encode_packobj(type, content, compression_level=1):
     szout = ''
     sz = len(content)
@@ -248,9 +334,13 @@ def _encode_packobj(type, content, compression_level=1):
     elif compression_level < 0:
         compression_level = 0
     z = zlib.compressobj(compression_level)
+    with stats.phase('zlib'):
+        data, tail = z.compress(content), z.flush()
+    stats.count('zlib-bytes-in', len(content))
+    stats.count('zlib-bytes-out', len(data) + len(tail))
     yield szout
-    yield z.compress(content)
-    yield z.flush()
+    yield data
+    yield tail
 
 
 def _encode_looseobj(type, content, compression_level=1):
@@ -308,6 +398,26 @@ class PackIdx:
             return want_source and os.path.basename(self.name) or True
         return None
 
+    def exists_many(self, shas):
+        """Return a bitmap (see bitmap_test()) with bit i set if shas[i]
+        exists in this index."""
+        query, order = sha_batch(shas)
+        found = bytearray((len(shas) + 7) // 8)
+        self._exists_query(query, found)
+        return unsort_bitmap(found, order)
+
+    def _exists_query(self, query, found, want=None):
+        """Set the bit in found for each of the sorted, concatenated
+        shas in query that exists in this index, and return how many
+        there were (see _helpers.exists_many())."""
+        global _total_searches, _total_steps
+        table, stride = self._sha_search
+        newly, searched, steps = _helpers.exists_many(table, stride, len(self),
+                                                      query, found, want)
+        _total_searches += searched
+        _total_steps += steps
+        return newly
+
     def __len__(self):
         return int(self.fanout[255])
 
@@ -315,22 +425,13 @@ class PackIdx:
         global _total_searches, _total_steps
         _total_searches += 1
         assert(len(hash) == 20)
-        b1 = ord(hash[0])
-        start = self.fanout[b1-1] # range -1..254
-        end = self.fanout[b1] # range 0..255
-        want = str(hash)
-        _total_steps += 1  # lookup table is a step
-        while start < end:
-            _total_steps += 1
-            mid = start + (end-start)/2
-            v = self._idx_to_hash(mid)
-            if v < want:
-                start = mid+1
-            elif v > want:
-                end = mid
-            else: # got it!
-                return mid
-        return None
+        table, stride = self._sha_search
+        idx, steps = _helpers.find_sha(table, stride, self._fanout_map, 8,
+                                       hash)
+        _total_steps += steps
+        if idx < 0:
+            return None
+        return idx
 
 
 class PackIdxV1(PackIdx):
@@ -345,6 +446,8 @@ class PackIdxV1(PackIdx):
         nsha = self.fanout[255]
         self.sha_ofs = 256*4
         self.shatable = buffer(self.map, self.sha_ofs, nsha*24)
+        self._sha_search = (buffer(self.map, self.sha_ofs + 4), 24)
+        self._fanout_map = buffer(self.map, 0, 256*4)
 
     def _ofs_from_idx(self, idx):
         return struct.unpack('!I', str(self.shatable[idx*24 : idx*24+4]))[0]
@@ -370,11 +473,12 @@ class PackIdxV2(PackIdx):
         nsha = self.fanout[255]
         self.sha_ofs = 8 + 256*4
         self.shatable = buffer(self.map, self.sha_ofs, nsha*20)
-        self.ofstable = buffer(self.map,
-                               self.sha_ofs + nsha*20 + nsha*4,
-                               nsha*4)
-        self.ofs64table = buffer(self.map,
-                                 8 + 256*4 + nsha*20 + nsha*4 + nsha*4)
+        self._sha_search = (self.shatable, 20)
+        self._fanout_map = buffer(self.map, 8, 256*4)
+        self.ofs_ofs = self.sha_ofs + nsha*20 + nsha*4
+        self.ofstable = buffer(self.map, self.ofs_ofs, nsha*4)
+        self.ofs64_ofs = self.ofs_ofs + nsha*4
+        self.ofs64table = buffer(self.map, self.ofs64_ofs)
 
     def _ofs_from_idx(self, idx):
         ofs = struct.unpack('!I', str(buffer(self.ofstable, idx*4, 4)))[0]
@@ -399,10 +503,13 @@ class PackIdxList:
         assert(_mpi_count == 0) # these things suck tons of VM; don't waste it
         _mpi_count += 1
         self.dir = dir
-        self.also = set()
-        self.packs = []
+        self.packs = []  # biggest first
+        # The positions in packs of the recently useful ones, most
+        # recent last
+        self._hot = OrderedDict()
         self.do_bloom = False
         self.bloom = None
+        self._state = None
         self.refresh()
 
     def __del__(self):
@@ -418,27 +525,87 @@ class PackIdxList:
 
     def exists(self, hash, want_source=False):
         """Return nonempty if the object exists in the index files."""
+        with stats.phase('exists'):
+            return self._exists(hash, want_source)
+
+    def _exists(self, hash, want_source):
         global _total_searches
         _total_searches += 1
-        if hash in self.also:
-            return True
+        hot = self._hot
+        asked_bloom = False
         if self.do_bloom and self.bloom:
-            if self.bloom.exists(hash):
-                self.do_bloom = False
-            else:
+            # The last lookup missed, so this one probably will too.
+            if not self.bloom.exists(hash):
                 _total_searches -= 1  # was counted by bloom
+                _lookups['bloom_rejects'] += 1
+                return None
+            asked_bloom = True
+        packs = self.packs
+        for i in reversed(hot):
+            _total_searches -= 1  # will be incremented by sub-pack
+            ix = packs[i].exists(hash, want_source=want_source)
+            if ix:
+                del hot[i]
+                hot[i] = None
+                self.do_bloom = False
+                _lookups['hot_hits'] += 1
+                return ix
+        if self.bloom and not asked_bloom:
+            if not self.bloom.exists(hash):
+                self.do_bloom = True
+                _lookups['bloom_rejects'] += 1
                 return None
-        for i in xrange(len(self.packs)):
-            p = self.packs[i]
+            asked_bloom = True
+        # Checking each pack against hot here would cost more than
+        # searching the few hot ones again.
+        for i, p in enumerate(packs):
             _total_searches -= 1  # will be incremented by sub-pack
             ix = p.exists(hash, want_source=want_source)
             if ix:
-                # reorder so most recently used packs are searched first
-                self.packs = [p] + self.packs[:i] + self.packs[i+1:]
+                self._make_hot(i)
+                self.do_bloom = False
+                _lookups['cold_hits'] += 1
                 return ix
         self.do_bloom = True
+        _lookups['misses'] += 1
+        if asked_bloom:
+            _lookups['bloom_false_positives'] += 1
         return None
 
+    def _make_hot(self, i):
+        """Make self.packs[i] the index that exists() tries first, and
+        forget the one used least recently if there are too many."""
+        hot = self._hot
+        hot.pop(i, None)
+        hot[i] = None
+        if len(hot) > hot_packs:
+            hot.popitem(last=False)
+
+    def exists_many(self, shas):
+        """Return a bitmap (see bitmap_test()) with bit i set if shas[i]
+        exists in the index files.  The shas are sorted once, checked
+        against the bloom filter together, and then merged into each
+        index in turn, which is much faster than calling exists() for
+        each of them."""
+        with stats.phase('exists'):
+            query, order = sha_batch(shas)
+            found = bytearray((len(shas) + 7) // 8)
+            want = None
+            left = len(shas)
+            if self.bloom and self.bloom.valid():
+                want = bytearray(len(found))
+                left = self.bloom._exists_query(query, want)
+            hot = list(reversed(self._hot))
+            for i in hot + [i for i in xrange(len(self.packs))
+                            if i not in self._hot]:
+                if not left:
+                    break
+                n = self.packs[i]._exists_query(query, found, want)
+                if n:
+                    self._make_hot(i)
+                    left -= n
+            return unsort_bitmap(found, order)
+
     def refresh(self, skip_midx = False):
         """Refresh the index list.
         This method verifies if .midx files were superseded (e.g. all of its
@@ -451,34 +618,34 @@ class PackIdxList:
         The module-global variable 'ignore_midx' can force this function to
         always act as if skip_midx was True.
         """
+        self._state = self._index_state()
         self.bloom = None # Always reopen the bloom as it may have been relaced
         self.do_bloom = False
         skip_midx = skip_midx or ignore_midx
-        d = dict((p.name, p) for p in self.packs
-                 if not skip_midx or not isinstance(p, midx.PackMidx))
+        # The list may be kept for a long time (see PackWriter), so
+        # start over from the files that exist now, just reusing the
+        # ones already open, or midx files that were replaced would
+        # be searched forever and could make newer ones look redundant.
+        already_open = dict((p.name, p) for p in self.packs)
+        d = {}
         if os.path.exists(self.dir):
             if not skip_midx:
                 midxl = []
-                for ix in self.packs:
-                    if isinstance(ix, midx.PackMidx):
-                        for name in ix.idxnames:
-                            d[os.path.join(self.dir, name)] = ix
                 for full in glob.glob(os.path.join(self.dir,'*.midx')):
-                    if not d.get(full):
-                        mx = midx.PackMidx(full)
-                        (mxd, mxf) = os.path.split(mx.name)
-                        broken = False
-                        for n in mx.idxnames:
-                            if not os.path.exists(os.path.join(mxd, n)):
-                                log(('warning: index %s missing\n' +
-                                    '  used by %s\n') % (n, mxf))
-                                broken = True
-                        if broken:
-                            mx.close()
-                            del mx
-                            unlink(full)
-                        else:
-                            midxl.append(mx)
+                    mx = already_open.get(full) or midx.PackMidx(full)
+                    (mxd, mxf) = os.path.split(mx.name)
+                    broken = False
+                    for n in mx.idxnames:
+                        if not os.path.exists(os.path.join(mxd, n)):
+                            log(('warning: index %s missing\n' +
+                                '  used by %s\n') % (n, mxf))
+                            broken = True
+                    if broken:
+                        mx.close()
+                        del mx
+                        unlink(full)
+                    else:
+                        midxl.append(mx)
                 midxl.sort(key=lambda ix:
                            (-len(ix), -xstat.stat(ix.name).st_mtime))
                 for ix in midxl:
@@ -500,27 +667,75 @@ class PackIdxList:
                         unlink(ix.name)
             for full in glob.glob(os.path.join(self.dir,'*.idx')):
                 if not d.get(full):
-                    try:
-                        ix = open_idx(full)
-                    except GitError as e:
-                        add_error(e)
-                        continue
+                    ix = already_open.get(full)
+                    if not ix:
+                        try:
+                            ix = open_idx(full)
+                        except GitError as e:
+                            add_error(e)
+                            continue
                     d[full] = ix
-            bfull = os.path.join(self.dir, 'bup.bloom')
-            if self.bloom is None and os.path.exists(bfull):
-                self.bloom = bloom.ShaBloom(bfull)
+            hot = [self.packs[i] for i in self._hot]
             self.packs = list(set(d.values()))
             self.packs.sort(lambda x,y: -cmp(len(x),len(y)))
-            if self.bloom and self.bloom.valid() and len(self.bloom) >= len(self):
-                self.do_bloom = True
-            else:
-                self.bloom = None
+            pos = dict((id(p), i) for i, p in enumerate(self.packs))
+            self._hot = OrderedDict((pos[id(p)], None) for p in hot
+                                    if id(p) in pos)
+            self._open_bloom()
         debug1('PackIdxList: using %d index%s.\n'
             % (len(self.packs), len(self.packs)!=1 and 'es' or ''))
 
-    def add(self, hash):
-        """Insert an additional object in the list."""
-        self.also.add(hash)
+    def _open_bloom(self):
+        self.bloom = None
+        self.do_bloom = False
+        b = bloom.BloomGenerations(os.path.join(self.dir, 'bup.bloom'))
+        if b.valid() and len(b) >= len(self):
+            self.bloom = b
+            self.do_bloom = True
+
+    def _index_state(self):
+        """Return something that changes whenever the indexes in the
+        directory do."""
+        try:
+            names = frozenset(n for n in os.listdir(self.dir)
+                              if n.endswith('.idx') or n.endswith('.midx'))
+        except OSError:
+            return None
+        bloom_id = []
+        for name in bloom.generations(os.path.join(self.dir, 'bup.bloom')):
+            try:
+                st = xstat.stat(name)
+            except OSError:
+                break
+            bloom_id.append((st.st_ino, st.st_mtime, st.st_size))
+        return names, tuple(bloom_id)
+
+    def add_idx(self, filename):
+        """Add filename, a new index in the directory, to the list
+        without a refresh().  It's probably where the next objects
+        will be found, so it's tried first."""
+        self.packs.append(open_idx(filename))
+        self._make_hot(len(self.packs) - 1)
+        name = os.path.basename(filename)
+        if self._state:
+            self._state = (self._state[0] | frozenset([name]), self._state[1])
+        if self.bloom and name not in self.bloom.idxnames:
+            # It would hide the new objects
+            self.bloom = None
+            self.do_bloom = False
+
+    def refresh_if_changed(self):
+        """Like refresh(), but only if the indexes in the directory have
+        changed since the last refresh() or add_idx(), and if only the
+        bloom filter has, just reopen that."""
+        state = self._index_state()
+        if state == self._state:
+            return
+        if state and self._state and state[0] == self._state[0]:
+            self._state = state
+            self._open_bloom()
+        else:
+            self.refresh()
 
 
 def open_idx(filename):
@@ -559,17 +774,56 @@ def idxmerge(idxlist, final_progress=True):
 def _make_objcache():
     return PackIdxList(repo('objects/pack'))
 
+
+class PackIdxTable:
+    """The (sha, crc, offset) of each object written to a pack so far,
+    32 bytes each, in 256 bytearrays by the first byte of the sha,
+    each kept sorted (see _helpers.write_idx())."""
+    def __init__(self):
+        self.buckets = [bytearray() for i in xrange(256)]
+        self.count = 0
+        self.ofs64_count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, sha, crc, ofs):
+        _helpers.idx_table_insert(self.buckets[ord(sha[0])], sha, crc, ofs)
+        self.count += 1
+        if ofs >= 2**31:
+            self.ofs64_count += 1
+
+    def exists(self, sha):
+        return _helpers.idx_table_find(self.buckets[ord(sha[0])], sha)
+
+    def exists_many(self, shas, found):
+        """Set bit i of the bitmap found for each shas[i] in the table."""
+        buckets = self.buckets
+        for i, sha in enumerate(shas):
+            if _helpers.idx_table_find(buckets[ord(sha[0])], sha):
+                found[i >> 3] |= 1 << (i & 7)
+
 class PackWriter:
     """Writes Git objects inside a pack file."""
-    def __init__(self, objcache_maker=_make_objcache, compression_level=1):
+    def __init__(self, objcache_maker=_make_objcache, compression_level=1,
+                 jobs=1):
         self.count = 0
         self.outbytes = 0
         self.filename = None
         self.file = None
         self.idx = None
+        # What's been written to the open pack after its header, while
+        # it's small, and after that the sha1sum of everything written.
+        self._pack_body = None
+        self._pack_sum = None
         self.objcache_maker = objcache_maker
         self.objcache = None
         self.compression_level = compression_level
+        self.jobs = jobs
+        self._pool = None
+        self._midx_dir = None  # Where auto_midx() may still be running
+        # Guards the objcache, which the new_blobs() workers consult.
+        self._objcache_lock = threading.RLock()
 
     def __del__(self):
         self.close()
@@ -580,8 +834,13 @@ class PackWriter:
             self.file = os.fdopen(fd, 'w+b')
             assert(name.endswith('.pack'))
             self.filename = name[:-5]
-            self.file.write('PACK\0\0\0\2\0\0\0\0')
-            self.idx = list(list() for i in xrange(256))
+            # The pack's checksum covers its object count, which isn't
+            # known until it's ended, so the header counts max_pack_objects
+            # for now, and _finish_pack() fixes it up.
+            self.file.write(_pack_header(max_pack_objects))
+            self._pack_body = []
+            self._pack_sum = None
+            self.idx = PackIdxTable()
 
     def _raw_write(self, datalist, sha):
         self._open()
@@ -591,31 +850,46 @@ class PackWriter:
         # all-or-nothing.  (The blob shouldn't be very big anyway, thanks
         # to our hashsplit algorithm.)  f.write() does its own buffering,
         # but that's okay because we'll flush it in _end().
-        oneblob = ''.join(datalist)
-        try:
-            f.write(oneblob)
-        except IOError as e:
-            raise GitError, e, sys.exc_info()[2]
-        nw = len(oneblob)
-        crc = zlib.crc32(oneblob) & 0xffffffff
-        self._update_idx(sha, crc, nw)
+        with stats.phase('pack-write'):
+            oneblob = ''.join(datalist)
+            try:
+                f.write(oneblob)
+            except IOError as e:
+                raise GitError, e, sys.exc_info()[2]
+            nw = len(oneblob)
+            crc = zlib.crc32(oneblob) & 0xffffffff
+            if self._pack_body is not None:
+                self._pack_body.append(oneblob)
+                if self.outbytes + nw > max_pack_held:
+                    # Too big to hold on to: hash it as if it'll be ended
+                    # by its count, and re-read it at the end otherwise.
+                    self._pack_sum = Sha1(_pack_header(max_pack_objects))
+                    for b in self._pack_body:
+                        self._pack_sum.update(b)
+                    self._pack_body = None
+            else:
+                self._pack_sum.update(oneblob)
+            self._update_idx(sha, crc, nw)
+        stats.count('pack-objects')
+        stats.count('pack-bytes', nw)
         self.outbytes += nw
         self.count += 1
         return nw, crc
 
     def _update_idx(self, sha, crc, size):
         assert(sha)
-        if self.idx:
-            self.idx[ord(sha[0])].append((sha, crc, self.file.tell() - size))
+        if self.idx is not None:
+            self.idx.add(sha, crc, self.file.tell() - size)
 
-    def _write(self, sha, type, content):
+    def _write(self, sha, type, content, datalist=None):
         if verbose:
             log('>')
         if not sha:
             sha = calc_hash(type, content)
-        size, crc = self._raw_write(_encode_packobj(type, content,
-                                                    self.compression_level),
-                                    sha=sha)
+        if datalist is None:
+            datalist = list(_encode_packobj(type, content,
+                                            self.compression_level))
+        size, crc = self._raw_write(datalist, sha=sha)
         if self.outbytes >= max_pack_size or self.count >= max_pack_objects:
             self.breakpoint()
         return sha
@@ -634,23 +908,81 @@ class PackWriter:
                     "PackWriter not opened or can't check exists w/o objcache")
 
     def exists(self, id, want_source=False):
-        """Return non-empty if an object is found in the object cache."""
-        self._require_objcache()
-        return self.objcache.exists(id, want_source=want_source)
+        """Return non-empty if an object is found in the object cache,
+        or True if it has already been written to the current pack."""
+        with self._objcache_lock:
+            if self.idx and self.idx.exists(id):
+                return True
+            self._require_objcache()
+            return self.objcache.exists(id, want_source=want_source)
 
-    def maybe_write(self, type, content):
-        """Write an object to the pack file if not present and return its id."""
-        sha = calc_hash(type, content)
-        if not self.exists(sha):
-            self._write(sha, type, content)
+    def exists_many(self, shas):
+        """Return a bitmap (see bitmap_test()) with bit i set if shas[i]
+        is in the object cache or has been written to the current pack."""
+        with self._objcache_lock:
             self._require_objcache()
-            self.objcache.add(sha)
+            found = self.objcache.exists_many(shas)
+            if self.idx:
+                self.idx.exists_many(shas, found)
+            return found
+
+    def maybe_write(self, type, content, sha=None, datalist=None):
+        """Write an object to the pack file if not present and return its id."""
+        if not sha:
+            sha = calc_hash(type, content)
+        with self._objcache_lock:
+            if not self.exists(sha):
+                self._write(sha, type, content, datalist=datalist)
+            else:
+                stats.count('existing-objects')
+        return sha
+
+    def copy_raw(self, sha, data):
+        """Write data, the whole of an object as it was encoded in
+        another pack, as sha, without decompressing it.  It mustn't be
+        a delta, and it's written even if sha already exists."""
+        with self._objcache_lock:
+            self._write(sha, None, None, datalist=[data])
         return sha
 
     def new_blob(self, blob):
         """Create a blob object in the pack with the supplied content."""
         return self.maybe_write('blob', blob)
 
+    def _encode_blob(self, blob):
+        sha = calc_hash('blob', blob)
+        if self.exists(sha):
+            return sha, None
+        return sha, list(_encode_packobj('blob', blob, self.compression_level))
+
+    def new_blobs(self, blobs):
+        """Generate the ids of blobs, creating any that are missing.
+
+        This is equivalent to calling new_blob() for each item, and the
+        objects are written to the pack in the same order, but when
+        self.jobs > 1, the hashing and compression of the next few blobs
+        is handled by a pool of worker threads.  The blobs must not be
+        modified until their id has been generated.
+        """
+        if self.jobs <= 1:
+            for blob in blobs:
+                yield self.new_blob(blob)
+            return
+        if not self._pool:
+            self._pool = ThreadPool(self.jobs)
+        pending = deque()
+        for blob in blobs:
+            pending.append((blob, self._pool.apply_async(self._encode_blob,
+                                                         (blob,))))
+            if len(pending) >= self.jobs * 4:
+                blob, result = pending.popleft()
+                sha, datalist = result.get()
+                yield self.maybe_write('blob', blob, sha=sha, datalist=datalist)
+        while pending:
+            blob, result = pending.popleft()
+            sha, datalist = result.get()
+            yield self.maybe_write('blob', blob, sha=sha, datalist=datalist)
+
     def new_tree(self, shalist):
         """Create a tree object in the pack."""
         content = tree_encode(shalist)
@@ -683,26 +1015,53 @@ class PackWriter:
             f.close()
             os.unlink(self.filename + '.pack')
 
-    def _end(self, run_midx=True):
+    def _end(self, run_midx=True, keep_objcache=True):
         f = self.file
         if not f: return None
         self.file = None
-        self.objcache = None
-        idx = self.idx
-        self.idx = None
 
-        # update object count
-        f.seek(8)
-        cp = struct.pack('!i', self.count)
-        assert(len(cp) == 4)
-        f.write(cp)
+        with stats.phase('pack-finish'):
+            nameprefix = self._finish_pack(f, self.idx)
+        # Rather than building a new objcache for the next pack, just
+        # add the new index to this one, until the directory changes.
+        with self._objcache_lock:
+            self.idx = None
+            if not keep_objcache:
+                self.objcache = None
+            elif self.objcache is not None:
+                self.objcache.add_idx(nameprefix + '.idx')
+        if run_midx:
+            # Between packs, the save carries on while the indexes are
+            # merged; at the end, it waits so that they're up to date.
+            self._midx_dir = repo('objects/pack')
+            with stats.phase('midx'):
+                auto_midx(self._midx_dir, wait=not keep_objcache)
+        with self._objcache_lock:
+            if self.objcache is not None:
+                self.objcache.refresh_if_changed()
+        return nameprefix
 
-        # calculate the pack sha1sum
+    def _finish_pack(self, f, idx):
+        header = _pack_header(self.count)
         f.seek(0)
-        sum = Sha1()
-        for b in chunkyreader(f):
-            sum.update(b)
-        packbin = sum.digest()
+        f.write(header)
+        if self._pack_body is not None:
+            sum = Sha1(header)
+            for b in self._pack_body:
+                sum.update(b)
+            packbin = sum.digest()
+        elif self.count == max_pack_objects:
+            packbin = self._pack_sum.digest()
+        else:
+            # calculate the pack sha1sum
+            f.seek(len(header))
+            sum = Sha1(header)
+            for b in chunkyreader(f):
+                sum.update(b)
+                stats.count('pack-reread-bytes', len(b))
+            packbin = sum.digest()
+        self._pack_body = self._pack_sum = None
+        f.seek(0, os.SEEK_END)
         f.write(packbin)
         f.close()
 
@@ -713,54 +1072,48 @@ class PackWriter:
             os.unlink(self.filename + '.map')
         os.rename(self.filename + '.pack', nameprefix + '.pack')
         os.rename(self.filename + '.idx', nameprefix + '.idx')
-
-        if run_midx:
-            auto_midx(repo('objects/pack'))
         return nameprefix
 
+    def _close_pool(self):
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
     def close(self, run_midx=True):
         """Close the pack file and move it to its definitive path."""
-        return self._end(run_midx=run_midx)
+        self._close_pool()
+        id = self._end(run_midx=run_midx, keep_objcache=False)
+        if self._midx_dir:
+            wait_for_midx(self._midx_dir)
+            self._midx_dir = None
+        with self._objcache_lock:
+            self.objcache = None
+        return id
 
     def _write_pack_idx_v2(self, filename, idx, packbin):
-        ofs64_count = 0
-        for section in idx:
-            for entry in section:
-                if entry[2] >= 2**31:
-                    ofs64_count += 1
-
         # Length: header + fan-out + shas-and-crcs + overflow-offsets
-        index_len = 8 + (4 * 256) + (28 * self.count) + (8 * ofs64_count)
+        index_len = 8 + (4 * 256) + (28 * self.count) + (8 * idx.ofs64_count)
         idx_map = None
         idx_f = open(filename, 'w+b')
         try:
             idx_f.truncate(index_len)
             idx_map = mmap_readwrite(idx_f, close=False)
-            count = _helpers.write_idx(filename, idx_map, idx, self.count)
+            count = _helpers.write_idx(filename, idx_map, idx.buckets,
+                                       self.count)
             assert(count == self.count)
-        finally:
-            if idx_map: idx_map.close()
-            idx_f.close()
-
-        idx_f = open(filename, 'a+b')
-        try:
-            idx_f.write(packbin)
-            idx_f.seek(0)
-            idx_sum = Sha1()
-            b = idx_f.read(8 + 4*256)
-            idx_sum.update(b)
-
-            obj_list_sum = Sha1()
-            for b in chunkyreader(idx_f, 20*self.count):
-                idx_sum.update(b)
-                obj_list_sum.update(b)
+            # The checksums come from the table still in memory, rather
+            # than from reading the file back.
+            obj_list_sum = Sha1(buffer(idx_map, 8 + 4*256, 20*self.count))
             namebase = obj_list_sum.hexdigest()
-
-            for b in chunkyreader(idx_f):
-                idx_sum.update(b)
+            idx_sum = Sha1(idx_map)
+            idx_sum.update(packbin)
+            idx_f.seek(index_len)
+            idx_f.write(packbin)
             idx_f.write(idx_sum.digest())
             return namebase
         finally:
+            if idx_map: idx_map.close()
             idx_f.close()
 
 
@@ -906,6 +1259,28 @@ def delete_ref(refname):
     _git_wait('git update-ref', p)
 
 
+def git_config_get(option, repo_dir=None):
+    """Return the value of the repository configuration option, or None
+    if it isn't set."""
+    p = subprocess.Popen(['git', 'config', '--get', option],
+                         stdout=subprocess.PIPE,
+                         preexec_fn=_gitenv(repo_dir))
+    r = p.stdout.read()
+    rv = p.wait()
+    if rv == 1:
+        return None
+    if rv != 0:
+        raise GitError('git config returned error %d' % rv)
+    return r.rstrip('\n')
+
+
+def git_config_set(option, value, repo_dir=None):
+    """Set the repository configuration option to value."""
+    p = subprocess.Popen(['git', 'config', option, value],
+                         stdout=sys.stderr, preexec_fn=_gitenv(repo_dir))
+    _git_wait('git config', p)
+
+
 def guess_repo(path=None):
     """Set the path value in the global variable "repodir".
     This makes bup look for an existing bup repository, but not fail if a
@@ -1033,22 +1408,267 @@ class _AbortableIter:
         self.abort()
 
 
+def _pack_obj_header(map, ofs):
+    """Return (type, size, data_ofs) for the pack object at ofs in map."""
+    c = ord(map[ofs])
+    type = (c & 0x70) >> 4
+    size = c & 0x0f
+    shift = 4
+    ofs += 1
+    while c & 0x80:
+        c = ord(map[ofs])
+        ofs += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+    return type, size, ofs
+
+
+def _inflate(map, ofs, size):
+    """Return the size bytes of the zlib stream starting at ofs in map."""
+    d = zlib.decompressobj()
+    out = []
+    n = 0
+    want = size + 64
+    while 1:
+        if ofs >= len(map):
+            raise GitError('truncated object in pack')
+        s = d.decompress(buffer(map, ofs, want))
+        ofs += want
+        out.append(s)
+        n += len(s)
+        if n >= size or d.unused_data:
+            break
+        want = 65536
+    out.append(d.flush())
+    data = ''.join(out)
+    if len(data) != size:
+        raise GitError('pack object has size %d, expected %d'
+                       % (len(data), size))
+    return data
+
+
+def _delta_size(delta, i):
+    size = shift = 0
+    while 1:
+        c = ord(delta[i])
+        i += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+        if not (c & 0x80):
+            return size, i
+
+
+def _apply_delta(base, delta):
+    """Return the result of applying a git delta to base."""
+    src_size, i = _delta_size(delta, 0)
+    if src_size != len(base):
+        raise GitError('delta expects a %d byte base, got %d'
+                       % (src_size, len(base)))
+    dst_size, i = _delta_size(delta, i)
+    out = []
+    end = len(delta)
+    while i < end:
+        c = ord(delta[i])
+        i += 1
+        if c & 0x80:
+            ofs = size = 0
+            for bit, shift in ((0x01, 0), (0x02, 8), (0x04, 16), (0x08, 24)):
+                if c & bit:
+                    ofs |= ord(delta[i]) << shift
+                    i += 1
+            for bit, shift in ((0x10, 0), (0x20, 8), (0x40, 16)):
+                if c & bit:
+                    size |= ord(delta[i]) << shift
+                    i += 1
+            out.append(base[ofs:ofs + (size or 0x10000)])
+        elif c:
+            out.append(delta[i:i+c])
+            i += c
+        else:
+            raise GitError('invalid delta opcode 0')
+    result = ''.join(out)
+    if len(result) != dst_size:
+        raise GitError('delta produced %d bytes, expected %d'
+                       % (len(result), dst_size))
+    return result
+
+
+class _PackFile:
+    def __init__(self, idxname):
+        self.idxname = idxname
+        self.idx = None  # only opened if a midx doesn't have the offsets
+        self.name = idxname[:-4] + '.pack'
+        self.map = mmap_read(open(self.name, 'rb'))
+        if self.map[0:4] != 'PACK':
+            raise GitError('%s: not a pack file' % self.name)
+
+    def find_offset(self, sha):
+        if not self.idx:
+            self.idx = open_idx(self.idxname)
+        return self.idx.find_offset(sha)
+
+
+class PackReader:
+    """Read objects directly from the pack files in a directory.
+
+    The packs are mapped into memory and their objects are inflated
+    in-process, including the OFS_DELTA and REF_DELTA objects in packs
+    written by git itself.  Loose objects aren't supported.
+    """
+    def __init__(self, dir):
+        self.dir = dir
+        self.packs = {}  # idx name -> _PackFile, opened as needed
+        self.midxs = []
+        self.idxnames = []  # ones not covered by a midx, most recent first
+        self.dir_mtime = None
+        self._bases = {}
+        self.refresh()
+
+    def refresh(self):
+        """Pick up any packs added to (or removed from) the directory."""
+        try:
+            self.dir_mtime = os.stat(self.dir).st_mtime
+        except OSError:
+            self.dir_mtime = None
+        idxnames = set(os.path.basename(p)
+                       for p in glob.glob(os.path.join(self.dir, '*.idx')))
+        midxs = []
+        if not ignore_midx:
+            for full in glob.glob(os.path.join(self.dir, '*.midx')):
+                mx = midx.PackMidx(full)
+                if not [n for n in mx.idxnames if n not in idxnames]:
+                    midxs.append(mx)
+        midxs.sort(key=lambda mx: -len(mx))
+        covered = set()
+        self.midxs = []
+        for mx in midxs:
+            if not covered.issuperset(mx.idxnames):
+                self.midxs.append(mx)
+                covered.update(mx.idxnames)
+        self.idxnames = [n for n in self.idxnames
+                         if n in idxnames and n not in covered]
+        self.idxnames += [n for n in idxnames
+                          if n not in covered and n not in self.idxnames]
+        for name in self.packs.keys():
+            if name not in idxnames:
+                del self.packs[name]
+        self._bases = {}
+
+    def _pack(self, idxname):
+        p = self.packs.get(idxname)
+        if not p:
+            p = self.packs[idxname] = _PackFile(os.path.join(self.dir,
+                                                             idxname))
+        return p
+
+    def _find(self, sha):
+        for mx in self.midxs:
+            found = mx.find(sha)
+            if found:
+                name, ofs = found
+                p = self._pack(name)
+                if ofs is None:
+                    ofs = p.find_offset(sha)
+                return p, ofs
+        for i, name in enumerate(self.idxnames):
+            p = self._pack(name)
+            ofs = p.find_offset(sha)
+            if ofs is not None:
+                if i:
+                    self.idxnames.insert(0, self.idxnames.pop(i))
+                return p, ofs
+        return None, None
+
+    def _read(self, p, ofs):
+        type, size, data_ofs = _pack_obj_header(p.map, ofs)
+        if type == 6:  # OFS_DELTA
+            c = ord(p.map[data_ofs])
+            data_ofs += 1
+            rel = c & 0x7f
+            while c & 0x80:
+                c = ord(p.map[data_ofs])
+                data_ofs += 1
+                rel = ((rel + 1) << 7) | (c & 0x7f)
+            key = (p.name, ofs - rel)
+            base = self._bases.get(key)
+            if not base:
+                base = self._read(p, ofs - rel)
+                if len(self._bases) >= 64:
+                    self._bases = {}
+                self._bases[key] = base
+        elif type == 7:  # REF_DELTA
+            base_sha = p.map[data_ofs:data_ofs+20]
+            data_ofs += 20
+            base = self.get(base_sha)
+            if not base:
+                raise GitError('%s: missing delta base %s'
+                               % (p.name, base_sha.encode('hex')))
+        else:
+            if type not in _typermap:
+                raise GitError('%s: unknown object type %d at %d'
+                               % (p.name, type, ofs))
+            return _typermap[type], _inflate(p.map, data_ofs, size)
+        base_type, base_data = base
+        return base_type, _apply_delta(base_data, _inflate(p.map, data_ofs, size))
+
+    def get(self, sha):
+        """Return (type, content) for the binary sha, or None if it isn't
+        in any of the packs."""
+        p, ofs = self._find(sha)
+        if p is None:
+            try:
+                mtime = os.stat(self.dir).st_mtime
+            except OSError:
+                mtime = None
+            if mtime == self.dir_mtime:
+                return None
+            self.refresh()
+            p, ofs = self._find(sha)
+            if p is None:
+                return None
+        return self._read(p, ofs)
+
+
+_hex_re = re.compile(r'^[0-9a-f]{40}$')
+
 _ver_warned = 0
 class CatPipe:
-    """Link to 'git cat-file' that is used to retrieve blob data."""
+    """Link to 'git cat-file' that is used to retrieve blob data.
+
+    Objects named by their full hex id are read straight from the
+    repository's packs when possible (see PackReader), and everything
+    else is handed to git.
+    """
     def __init__(self, repo_dir = None):
         global _ver_warned
         self.repo_dir = repo_dir
+        self.packs = None
         wanted = ('1','5','6')
         if ver() < wanted:
             if not _ver_warned:
                 log('warning: git version < %s; bup will be slow.\n'
                     % '.'.join(wanted))
                 _ver_warned = 1
-            self.get = self._slow_get
+            self._get = self._slow_get
         else:
             self.p = self.inprogress = None
-            self.get = self._fast_get
+            self._get = self._fast_get
+
+    def get(self, id):
+        """Generate the type of the object named by id and then its content."""
+        if use_pack_reader and len(id) == 40 and _hex_re.match(id):
+            if not self.packs:
+                self.packs = PackReader(os.path.join(self.repo_dir or repo(),
+                                                     'objects/pack'))
+            obj = self.packs.get(id.decode('hex'))
+            if obj:
+                return self._packed_get(*obj)
+        return self._get(id)
+
+    def _packed_get(self, type, content):
+        yield type
+        if content:
+            yield content
 
     def _abort(self):
         if self.p:
@@ -1,47 +1,106 @@
-import io, math, os
+import bisect, errno, io, math, os, stat, sys, threading, Queue
+from array import array
+from collections import deque
 
-from bup import _helpers, helpers
+from bup import _helpers, helpers, stats
 from bup.helpers import sc_page_size
 
 _fmincore = getattr(helpers, 'fmincore', None)
+_SEEK_DATA = getattr(_helpers, 'SEEK_DATA', None)
+_SEEK_HOLE = getattr(_helpers, 'SEEK_HOLE', None)
 
 BLOB_MAX = 8192*4   # 8192 is the "typical" blob size for bupsplit
 BLOB_READ_SIZE = 1024*1024
+RESPLIT_READ_SIZE = 128*1024
 MAX_PER_TREE = 256
 progress_callback = None
 fanout = 16
+blobbits = _helpers.blobbits()  # blobs average 2^blobbits bytes
+MIN_BLOBBITS, MAX_BLOBBITS = 10, 20
+readahead = 0  # number of BLOB_READ_SIZE blocks to read in the background
+skip_holes = True  # make up the zeros in sparse files instead of reading them
+total_hole_bytes = 0
+
+# The chunkers, by the name a repository records (as bup.chunker), and
+# the _helpers function that finds their split points.  The chunker
+# determines every blob boundary, so all the saves to a repository
+# should use the same one, or they won't deduplicate against each other.
+chunkers = {'bupsplit': 'find_splits',
+            'fastcdc': 'fastcdc_find_splits'}
+chunker = 'bupsplit'
 
 GIT_MODE_FILE = 0100644
 GIT_MODE_TREE = 040000
 GIT_MODE_SYMLINK = 0120000
 assert(GIT_MODE_TREE != 40000)  # 0xxx should be treated as octal
 
-# The purpose of this type of buffer is to avoid copying on peek(), get(),
-# and eat().  We do copy the buffer contents on put(), but that should
-# be ok if we always only put() large amounts of data at a time.
+# The purpose of this type of buffer is to avoid copying and allocating
+# memory.  fill() reads straight into a preallocated bytearray, and
+# peek(), get() and eat() just return or skip views of it.  A view is
+# only valid until the next fill() or put(), which may reuse its space.
+# Only the unconsumed data (normally less than BLOB_MAX) is ever moved,
+# to the front of the buffer, when there's no room left at the end.
+# With reuse=False, it's moved to a new bytearray instead, so that the
+# views stay valid for as long as they're referenced.
 class Buf:
-    def __init__(self):
-        self.data = ''
-        self.start = 0
+    def __init__(self, size=0, reuse=True):
+        self.data = bytearray(size)
+        self.start = self.end = 0
+        self.reuse = reuse
+
+    def _reserve(self, count):
+        used = self.end - self.start
+        if self.end + count <= len(self.data):
+            return
+        if not self.reuse:
+            data = bytearray(max(len(self.data), used + count))
+            data[0:used] = buffer(self.data, self.start, used)
+            self.data = data
+            self.start, self.end = 0, used
+            return
+        if self.start:
+            m = memoryview(self.data)
+            m[0:used] = m[self.start:self.end]
+            del m
+            self.start, self.end = 0, used
+        if used + count > len(self.data):
+            self.data.extend(bytearray(used + count - len(self.data)))
 
     def put(self, s):
         if s:
-            self.data = buffer(self.data, self.start) + s
-            self.start = 0
-            
+            self._reserve(len(s))
+            self.data[self.end:self.end + len(s)] = s
+            self.end += len(s)
+
+    def fill(self, f, count):
+        """Read up to count bytes from f into the buffer, and return
+        the number read, which is 0 at EOF."""
+        if not hasattr(f, 'readinto'):
+            s = f.read(count)
+            self.put(s)
+            return len(s)
+        self._reserve(count)
+        m = memoryview(self.data)
+        try:
+            n = f.readinto(m[self.end:self.end + count]) or 0
+        finally:
+            del m
+        self.end += n
+        return n
+
     def peek(self, count):
-        return buffer(self.data, self.start, count)
-    
+        return buffer(self.data, self.start, min(count, self.used()))
+
     def eat(self, count):
         self.start += count
 
     def get(self, count):
-        v = buffer(self.data, self.start, count)
+        v = self.peek(count)
         self.start += count
         return v
 
     def used(self):
-        return len(self.data) - self.start
+        return self.end - self.start
 
 
 def _fadvise_pages_done(fd, first_page, count):
@@ -89,10 +148,110 @@ def _uncache_ours_upto(fd, offset, first_region, remaining_regions):
     return (rstart, rlen)
 
 
-def readfile_iter(files, progress=None):
+class _SparseReader:
+    """Read f like f.read() or f.readinto() would, but rather than reading
+    the holes in it (as reported by SEEK_DATA and SEEK_HOLE) just make
+    up the zeros they contain.  Nothing but the reader may move the
+    file position while it's in use."""
+    def __init__(self, f, fd):
+        self.f = f
+        self.fd = fd
+        self.ofs = f.tell()
+        # The known data region, and the hole before it
+        self.hole_start = self.data_start = self.data_end = self.ofs
+        self.synced = True
+        self.zeros = ''
+
+    def _find_data(self):
+        try:
+            start = os.lseek(self.fd, self.ofs, _SEEK_DATA)
+            end = os.lseek(self.fd, start, _SEEK_HOLE)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            # Nothing but holes from here to EOF (if we're not there)
+            start = end = max(self.ofs, os.fstat(self.fd).st_size)
+        self.hole_start, self.data_start, self.data_end = self.ofs, start, end
+        self.synced = False
+
+    def _limit(self, count):
+        """Return (is_hole, n) for the next n <= count bytes."""
+        if not (self.hole_start <= self.ofs < self.data_end):
+            self._find_data()
+        if self.ofs < self.data_start:
+            return True, min(count, self.data_start - self.ofs)
+        if self.data_end > self.ofs:
+            count = min(count, self.data_end - self.ofs)
+        if not self.synced:
+            self.f.seek(self.ofs)
+            self.synced = True
+        return False, count
+
+    def _zeros(self, n):
+        global total_hole_bytes
+        if len(self.zeros) < n:
+            self.zeros = '\0' * n
+        self.ofs += n
+        self.synced = False
+        total_hole_bytes += n
+        return buffer(self.zeros, 0, n)
+
+    # Both of these return exactly what was asked for unless they hit
+    # EOF, no matter where the holes are, just as reading the file
+    # would.
+
+    def read(self, count):
+        result = []
+        while count:
+            hole, n = self._limit(count)
+            if hole:
+                b = str(self._zeros(n))
+            else:
+                b = self.f.read(n)
+                if not b:
+                    break
+                self.ofs += len(b)
+            result.append(b)
+            count -= len(b)
+        return ''.join(result)
+
+    def readinto(self, m):
+        done = 0
+        while done < len(m):
+            hole, n = self._limit(len(m) - done)
+            if hole:
+                m[done:done + n] = self._zeros(n)
+            else:
+                n = self.f.readinto(m[done:done + n]) or 0
+                if not n:
+                    break
+                self.ofs += n
+            done += n
+        return done
+
+
+def _sparse_reader(f):
+    """Return a _SparseReader for f, or f itself if its holes can't
+    be found."""
+    if not (skip_holes and _SEEK_DATA and hasattr(f, 'fileno')):
+        return f
+    try:
+        fd = f.fileno()
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            return f
+        r = _SparseReader(f, fd)
+        r._find_data()
+        return r
+    except (io.UnsupportedOperation, IOError, OSError):
+        return f
+
+
+def _read_files(files, read, progress):
+    """For each of files, yield read(f) until it returns (x, 0), and
+    then move on to the next file.  read() must return (x, nbytes)."""
     for filenum,f in enumerate(files):
         ofs = 0
-        b = ''
+        nbytes = 0
         fd = rpr = rstart = rlen = None
         if _fmincore and hasattr(f, 'fileno'):
             try:
@@ -106,53 +265,161 @@ def readfile_iter(files, progress=None):
                     rpr = _nonresident_page_regions(mcore, helpers.MINCORE_INCORE,
                                                     max_chunk)
                     rstart, rlen = next(rpr, (None, None))
+        f = _sparse_reader(f)
         while 1:
             if progress:
-                progress(filenum, len(b))
-            b = f.read(BLOB_READ_SIZE)
-            ofs += len(b)
+                progress(filenum, nbytes)
+            with stats.phase('read'):
+                x, nbytes = read(f)
+            stats.count('read-bytes', nbytes)
+            ofs += nbytes
             if rpr:
                 rstart, rlen = _uncache_ours_upto(fd, ofs, (rstart, rlen), rpr)
-            if not b:
+            if not nbytes:
                 break
-            yield b
+            yield x
         if rpr:
             rstart, rlen = _uncache_ours_upto(fd, ofs, (rstart, rlen), rpr)
 
 
-def _splitbuf(buf, basebits, fanbits):
+def readfile_iter(files, progress=None):
+    def read(f):
+        b = f.read(BLOB_READ_SIZE)
+        return b, len(b)
+    return _read_files(files, read, progress)
+
+
+def _fill_iter(buf, files, progress):
+    """Read each of files into buf, one BLOB_READ_SIZE block at a time,
+    yielding after each read."""
+    def fill(f):
+        return None, buf.fill(f, BLOB_READ_SIZE)
+    return _read_files(files, fill, progress)
+
+
+def _readahead_iter(it, depth):
+    """Generate the items of it, which are fetched by a separate thread
+    that stays at most depth items ahead of the caller."""
+    q = Queue.Queue(depth)
+    stop = []
+    def fetch():
+        try:
+            for x in it:
+                if stop:
+                    return
+                q.put((True, x))
+            q.put((False, None))
+        except:
+            q.put((False, sys.exc_info()))
+    # One name for all of them, so that the stats of each file's
+    # reader add up.
+    t = threading.Thread(target=fetch, name='readahead')
+    t.daemon = True
+    t.start()
+    try:
+        while 1:
+            more, x = q.get()
+            if not more:
+                if x:
+                    raise x[0], x[1], x[2]
+                break
+            yield x
+    finally:
+        stop.append(True)
+        while t.is_alive():
+            try:
+                q.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        t.join()
+
+
+def _config_num(config_get, name, default, min, max):
+    v = config_get(name)
+    if v is None:
+        return default
+    try:
+        v = helpers.parse_num(v)
+    except ValueError:
+        raise ValueError('%s must be a number, not %r' % (name, v))
+    if not min <= v <= max:
+        raise ValueError('%s must be from %d to %d, not %d'
+                         % (name, min, max, v))
+    return v
+
+
+def configure(config_get):
+    """Set up splitting the way the repository whose configuration
+    values are returned by config_get(name) (None when unset) does it.
+    That's the chunker (bup.chunker), the average blob size
+    (2^bup.blobbits bytes), the maximum blob size (bup.blobmax, by
+    default four times the average), and the average and maximum
+    number of entries in the trees of a split file (bup.fanout and
+    bup.treemax).  Raise ValueError if any of them are invalid.
+
+    Since split files are read the same way whatever they were split
+    with, the settings can change without making anything already in
+    the repository unreadable; they just won't deduplicate against data
+    split with other settings."""
+    global chunker, blobbits, BLOB_MAX, BLOB_READ_SIZE, fanout, MAX_PER_TREE
+    name = config_get('bup.chunker') or 'bupsplit'
+    if name not in chunkers:
+        raise ValueError('unknown chunker %r' % name)
+    bits = _config_num(config_get, 'bup.blobbits', _helpers.blobbits(),
+                       MIN_BLOBBITS, MAX_BLOBBITS)
+    blob_max = _config_num(config_get, 'bup.blobmax', 4 << bits,
+                           2 << bits, 16 << bits)
+    tree_fanout = _config_num(config_get, 'bup.fanout', 16, 2, 1 << 16)
+    tree_max = _config_num(config_get, 'bup.treemax', 256, 2, 1 << 20)
+    chunker, blobbits, BLOB_MAX = name, bits, blob_max
+    fanout, MAX_PER_TREE = tree_fanout, tree_max
+    BLOB_READ_SIZE = max(BLOB_READ_SIZE, BLOB_MAX * 2)
+
+
+def _splitbuf(buf, fanbits):
+    find_splits = getattr(_helpers, chunkers[chunker])
+    limit = None
     while 1:
-        b = buf.peek(buf.used())
-        (ofs, bits) = _helpers.splitbuf(b)
-        if ofs:
-            if ofs > BLOB_MAX:
-                ofs = BLOB_MAX
-                level = 0
-            else:
-                level = (bits-basebits)//fanbits  # integer division
-            buf.eat(ofs)
-            yield buffer(b, 0, ofs), level
-        else:
-            break
-    while buf.used() >= BLOB_MAX:
-        # limit max blob size
+        b = buf.peek(buf.used() if limit is None else limit)
+        with stats.phase('split'):
+            splits = array('i', find_splits(b, BLOB_MAX, fanbits, blobbits))
+        stats.count('split-bytes', len(b))
+        start = 0
+        for i in xrange(0, len(splits), 2):
+            end = splits[i]
+            buf.eat(end - start)
+            yield buffer(b, start, end - start), splits[i + 1]
+            start = end
+        if limit is not None and len(splits):
+            continue
+        if buf.used() < BLOB_MAX:
+            return
+        # limit max blob size, and search again from there, just as if
+        # the buffer had ended here, so that the blobs never depend on
+        # where the reads end.  The rest of the buffer has already been
+        # searched, and only the first window of it looks any different
+        # to a new search.
         yield buf.get(BLOB_MAX), 0
+        limit = _helpers.WINDOWSIZE
 
 
-def _hashsplit_iter(files, progress):
+def _hashsplit_iter(files, progress, reuse=True):
     assert(BLOB_READ_SIZE > BLOB_MAX)
-    basebits = _helpers.blobbits()
     fanbits = int(math.log(fanout or 128, 2))
-    buf = Buf()
-    for inblock in readfile_iter(files, progress):
-        buf.put(inblock)
-        for buf_and_level in _splitbuf(buf, basebits, fanbits):
+    buf = Buf(BLOB_READ_SIZE + BLOB_MAX, reuse=reuse)
+    if readahead:
+        blocks = _readahead_iter(readfile_iter(files, progress), readahead)
+        reads = (buf.put(b) for b in blocks)
+    else:
+        reads = _fill_iter(buf, files, progress)
+    for _ in reads:
+        for buf_and_level in _splitbuf(buf, fanbits):
             yield buf_and_level
     if buf.used():
         yield buf.get(buf.used()), 0
 
 
-def _hashsplit_iter_keep_boundaries(files, progress):
+def _hashsplit_iter_keep_boundaries(files, progress, reuse=True):
     for real_filenum,f in enumerate(files):
         if progress:
             def prog(filenum, nbytes):
@@ -161,26 +428,147 @@ def _hashsplit_iter_keep_boundaries(files, progress):
                 return progress(real_filenum, nbytes)
         else:
             prog = None
-        for buf_and_level in _hashsplit_iter([f], progress=prog):
+        for buf_and_level in _hashsplit_iter([f], progress=prog, reuse=reuse):
             yield buf_and_level
 
 
-def hashsplit_iter(files, keep_boundaries, progress):
+def hashsplit_iter(files, keep_boundaries, progress, reuse=True):
+    """Generate (blob, level) for each blob split from files.  Each
+    blob is a view of a buffer that, unless reuse is false, may be
+    overwritten as soon as the next one is generated."""
     if keep_boundaries:
-        return _hashsplit_iter_keep_boundaries(files, progress)
+        return _hashsplit_iter_keep_boundaries(files, progress, reuse)
     else:
-        return _hashsplit_iter(files, progress)
+        return _hashsplit_iter(files, progress, reuse)
 
 
 total_split = 0
-def split_to_blobs(makeblob, files, keep_boundaries, progress):
+def split_to_blobs(makeblob, files, keep_boundaries, progress,
+                   makeblobs=None):
+    """Generate (sha, size, level) for each blob split from files.
+
+    If makeblobs is provided, it must take an iterable of blob
+    contents and generate their ids in the same order; it's used
+    instead of makeblob so that the blob creation can run ahead of
+    the caller (see PackWriter.new_blobs()).
+    """
     global total_split
-    for (blob, level) in hashsplit_iter(files, keep_boundaries, progress):
-        sha = makeblob(blob)
-        total_split += len(blob)
+    # makeblobs() holds on to the next few blobs while they're hashed
+    # and compressed, so their space in the buffer mustn't be reused.
+    chunks = hashsplit_iter(files, keep_boundaries, progress,
+                            reuse=not makeblobs)
+    if not makeblobs:
+        for (blob, level) in chunks:
+            sha = makeblob(blob)
+            total_split += len(blob)
+            if progress_callback:
+                progress_callback(len(blob))
+            yield (sha, len(blob), level)
+        return
+    pending = deque()
+    def blobs():
+        for (blob, level) in chunks:
+            pending.append((len(blob), level))
+            yield blob
+    for sha in makeblobs(blobs()):
+        size, level = pending.popleft()
+        total_split += size
         if progress_callback:
-            progress_callback(len(blob))
-        yield (sha, len(blob), level)
+            progress_callback(size)
+        yield (sha, size, level)
+
+
+class _OldBlobs:
+    """A cursor over the (size, sha, level) blobs of an earlier split."""
+    def __init__(self, blobs):
+        self.blobs = iter(blobs)
+        self.ofs = 0
+        self.cur = next(self.blobs, None)
+
+    def at(self, pos):
+        """Return the old blob that starts at pos, if any.  pos must
+        never decrease from one call to the next."""
+        while self.cur and self.ofs < pos:
+            self.ofs += self.cur[0]
+            self.cur = next(self.blobs, None)
+        if self.cur and self.ofs == pos:
+            return self.cur
+        return None
+
+
+def _overlaps(ranges, starts, start, end):
+    i = bisect.bisect_right(starts, end - 1) - 1
+    return i >= 0 and ranges[i][1] > start
+
+
+total_resplit_read = 0
+def resplit_to_blobs(makeblob, f, size, old, old_size, changed, exists):
+    """Generate (sha, size, level) for each blob of f, exactly as
+    split_to_blobs() would, while reading as little of f as possible.
+
+    old is an iterable of the (size, sha, level) blobs from an earlier
+    split of the file when it was old_size bytes long, and changed is
+    a sorted list of non-overlapping (start, end) byte ranges that may
+    differ since then.  Since the splitter starts over at every split
+    point, an old blob can be reused whenever it starts at a current
+    split point, doesn't overlap a changed range, wasn't cut short by
+    the old end of file, and exists() says it's still in the
+    repository.  Everything else is read from f and split again,
+    starting at the preceding split point, until the new split points
+    line up with the old ones.
+    """
+    global total_split, total_resplit_read
+    fanbits = int(math.log(fanout or 128, 2))
+    starts = [start for start, end in changed]
+    old = _OldBlobs(old)
+
+    def reusable(pos):
+        blob = old.at(pos)
+        if not blob:
+            return None
+        end = pos + blob[0]
+        if end > size or (end == old_size and size != old_size):
+            return None
+        if _overlaps(changed, starts, pos, end) or not exists(blob[1]):
+            return None
+        return blob
+
+    pos = 0
+    while pos < size:
+        blob = reusable(pos)
+        if blob:
+            bsize, sha, level = blob
+            total_split += bsize
+            if progress_callback:
+                progress_callback(bsize)
+            yield (sha, bsize, level)
+            pos += bsize
+            continue
+        f.seek(pos)
+        buf = Buf(RESPLIT_READ_SIZE + BLOB_MAX)
+        while 1:
+            nread = buf.fill(f, RESPLIT_READ_SIZE)
+            total_resplit_read += nread
+            if nread:
+                pieces = _splitbuf(buf, fanbits)
+            elif buf.used():
+                pieces = [(buf.get(buf.used()), 0)]
+            else:
+                pieces = []
+            for blob, level in pieces:
+                sha = makeblob(blob)
+                total_split += len(blob)
+                if progress_callback:
+                    progress_callback(len(blob))
+                yield (sha, len(blob), level)
+                pos += len(blob)
+                if pos < size and reusable(pos):
+                    break
+            else:
+                if nread:
+                    continue
+                return
+            break
 
 
 def _make_shalist(l):
@@ -211,9 +599,9 @@ def _squish(maketree, stacks, n):
         i += 1
 
 
-def split_to_shalist(makeblob, maketree, files,
-                     keep_boundaries, progress=None):
-    sl = split_to_blobs(makeblob, files, keep_boundaries, progress)
+def blobs_to_shalist(maketree, sl):
+    """Return the shalist for the (sha, size, level) blob sequence sl,
+    creating any intermediate trees with maketree."""
     assert(fanout != 0)
     if not fanout:
         shal = []
@@ -231,10 +619,17 @@ def split_to_shalist(makeblob, maketree, files,
         return _make_shalist(stacks[-1])[0]
 
 
-def split_to_blob_or_tree(makeblob, maketree, files,
-                          keep_boundaries, progress=None):
-    shalist = list(split_to_shalist(makeblob, maketree,
-                                    files, keep_boundaries, progress))
+def split_to_shalist(makeblob, maketree, files,
+                     keep_boundaries, progress=None, makeblobs=None):
+    sl = split_to_blobs(makeblob, files, keep_boundaries, progress,
+                        makeblobs=makeblobs)
+    return blobs_to_shalist(maketree, sl)
+
+
+def blobs_to_blob_or_tree(makeblob, maketree, sl):
+    """Return (mode, sha) for the blob or tree representing the
+    (sha, size, level) blob sequence sl."""
+    shalist = list(blobs_to_shalist(maketree, sl))
     if len(shalist) == 1:
         return (shalist[0][0], shalist[0][2])
     elif len(shalist) == 0:
@@ -243,6 +638,13 @@ def split_to_blob_or_tree(makeblob, maketree, files,
         return (GIT_MODE_TREE, maketree(shalist))
 
 
+def split_to_blob_or_tree(makeblob, maketree, files,
+                          keep_boundaries, progress=None, makeblobs=None):
+    sl = split_to_blobs(makeblob, files, keep_boundaries, progress,
+                        makeblobs=makeblobs)
+    return blobs_to_blob_or_tree(makeblob, maketree, sl)
+
+
 def open_noatime(name):
     fd = _helpers.open_noatime(name)
     try:
@@ -820,6 +820,27 @@ def count(l):
     return reduce(lambda x,y: x+1, l)
 
 
+def sha_batch(shas):
+    """Return (query, order) for a batch of exists_many() lookups: the
+    shas sorted and concatenated, and the index in shas of each one."""
+    order = sorted(xrange(len(shas)), key=shas.__getitem__)
+    return ''.join([str(shas[i]) for i in order]), order
+
+
+def bitmap_test(bits, i):
+    """Return true if bit i (bit i % 8 of byte i // 8) is set in bits."""
+    return bits[i >> 3] & (1 << (i & 7))
+
+
+def unsort_bitmap(bits, order):
+    """Return a bitmap with bit order[i] set for each bit i set in bits."""
+    result = bytearray(len(bits))
+    for i, j in enumerate(order):
+        if bits[i >> 3] & (1 << (i & 7)):
+            result[j >> 3] |= 1 << (j & 7)
+    return result
+
+
 saved_errors = []
 def add_error(e):
     """Append an error message to the list of saved errors.
@@ -1,42 +1,286 @@
-import cPickle, errno, os, tempfile
+import cPickle, errno, os, shutil, struct, tempfile
+from io import BytesIO
+from bup import vint
+from bup.helpers import Sha1, log, mmap_read, unlink
+
+# The database is a sorted, mmapped base file, plus a log of the
+# changes made since it was written.  The base file has a table of
+# nodes (dev, ino), sorted, each pointing at its list of paths, and a
+# table of paths, sorted, each with its node, so that both can be
+# looked up (by binary search) without reading the whole thing.
+# Changes are appended to the log (FILENAME.log) in one checksummed
+# record per save, and read into memory on open, until the log is
+# big enough (compared to the base) that it's worth merging it into a
+# new base file.
+#
+# Each node's paths are kept in the order they were added, since
+# "bup save" treats the first one as the hardlink target.
+
+HLINK_HDR = 'BUPH\0\0\0\1'
+HLINK_SIG = '!8sQQ'  # base id, nodes, paths
+HLINK_HDRLEN = len(HLINK_HDR) + struct.calcsize(HLINK_SIG)
+NODE_SIG = '!QQQI'  # dev, ino, offset of paths in data, number of paths
+NODE_LEN = struct.calcsize(NODE_SIG)
+PATH_SIG = '!QIQQ'  # offset of path in data, path length, dev, ino
+PATH_LEN = struct.calcsize(PATH_SIG)
+
+LOG_HDR = 'BUPh\0\0\0\1'  # followed by the id of the base it applies to
+LOG_HDRLEN = len(LOG_HDR) + 8
+
+# Merge the log into the base file when it would grow past this many
+# bytes, or past this fraction of the base file's size, whichever is
+# more.
+max_log_size = 1024 * 1024
+max_log_fraction = 0.25
 
 class Error(Exception):
     pass
 
 class HLinkDB:
     def __init__(self, filename):
-        # Map a "dev:ino" node to a list of paths associated with that node.
-        self._node_paths = {}
-        # Map a path to a "dev:ino" node.
-        self._path_node = {}
         self._filename = filename
+        self._logname = filename + '.log'
         self._save_prepared = None
         self._tmpname = None
+        self._merge = False
+        # Nodes and paths changed since the base file was written: map
+        # (dev, ino) to a list of paths (empty if it's gone), and a
+        # path to a (dev, ino) (None if it's gone).
+        self._node_paths = {}
+        self._path_node = {}
+        # The nodes and paths changed since we opened the database.
+        self._changed_nodes = set()
+        self._changed_paths = set()
+        self._m = ''
+        self._id = '\0' * 8
+        self._nodes = self._paths = 0
+        self._log_len = 0
         f = None
         try:
-            f = open(filename, 'r')
+            f = open(filename, 'rb')
         except IOError as e:
             if e.errno == errno.ENOENT:
                 pass
             else:
                 raise
         if f:
-            try:
-                self._node_paths = cPickle.load(f)
-            finally:
-                f.close()
-                f = None
-        # Set up the reverse hard link index.
-        for node, paths in self._node_paths.iteritems():
+            hdr = f.read(len(HLINK_HDR))
+            if hdr == HLINK_HDR:
+                self._m = mmap_read(f)
+                (self._id, self._nodes, self._paths) = \
+                    struct.unpack_from(HLINK_SIG, self._m, len(HLINK_HDR))
+                self._path_ofs = HLINK_HDRLEN + self._nodes * NODE_LEN
+                self._data_ofs = self._path_ofs + self._paths * PATH_LEN
+            else:
+                try:
+                    if hdr:
+                        f.seek(0)
+                        self._load_pickle(f)
+                finally:
+                    f.close()
+                    f = None
+        self._load_log()
+
+    def _load_pickle(self, f):
+        # The whole database, from an older bup, as a "dev:ino" ->
+        # paths dict.  Treat it all as changes, so that the next save
+        # writes it out in the current format.
+        for node, paths in cPickle.load(f).iteritems():
+            node = tuple(int(x) for x in node.split(':'))
+            self._set_node_paths(node, paths)
+            self._changed_nodes.add(node)
+        self._merge = True
+
+    def _set_node_paths(self, node, paths):
+        self._node_paths[node] = paths
+        for path in paths:
+            self._path_node[path] = node
+
+    def _load_log(self):
+        try:
+            f = open(self._logname, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        with f:
+            hdr = f.read(LOG_HDRLEN)
+            if hdr != LOG_HDR + self._id:
+                # Not for this base file (which must already include
+                # it, if the log was left behind by a merge).
+                return
+            ofs = len(hdr)
+            while 1:
+                b = f.read(4)
+                if len(b) < 4:
+                    break
+                n = struct.unpack('!I', b)[0]
+                payload = f.read(n)
+                digest = f.read(20)
+                if len(payload) < n or Sha1(payload).digest() != digest:
+                    log('warning: %s: ignoring incomplete record at %d\n'
+                        % (self._logname, ofs))
+                    break
+                self._apply_changes(payload)
+                ofs += 4 + n + 20
+            self._log_len = ofs
+
+    def _apply_changes(self, payload):
+        port = BytesIO(payload)
+        for i in xrange(vint.read_vuint(port)):
+            self._path_node[vint.read_bvec(port)] = None
+        for i in xrange(vint.read_vuint(port)):
+            node = (vint.read_vuint(port), vint.read_vuint(port))
+            paths = [vint.read_bvec(port)
+                     for j in xrange(vint.read_vuint(port))]
+            self._set_node_paths(node, paths)
+
+    def _encode_changes(self):
+        port = BytesIO()
+        gone = [p for p in sorted(self._changed_paths)
+                if self._path_node.get(p) is None]
+        vint.write_vuint(port, len(gone))
+        for path in gone:
+            vint.write_bvec(port, path)
+        vint.write_vuint(port, len(self._changed_nodes))
+        for node in sorted(self._changed_nodes):
+            (dev, ino) = node
+            paths = self._node_paths[node]
+            vint.write_vuint(port, dev)
+            vint.write_vuint(port, ino)
+            vint.write_vuint(port, len(paths))
             for path in paths:
-                self._path_node[path] = node
+                vint.write_bvec(port, path)
+        return port.getvalue()
+
+    def _base_node(self, i):
+        return struct.unpack_from(NODE_SIG, self._m,
+                                  HLINK_HDRLEN + i * NODE_LEN)
+
+    def _base_path(self, i):
+        (ofs, n, dev, ino) = struct.unpack_from(PATH_SIG, self._m,
+                                                self._path_ofs + i * PATH_LEN)
+        ofs += self._data_ofs
+        return self._m[ofs:ofs+n], (dev, ino)
+
+    def _base_node_paths(self, ofs, n):
+        m = self._m
+        ofs += self._data_ofs
+        paths = []
+        for i in xrange(n):
+            size = struct.unpack_from('!I', m, ofs)[0]
+            paths.append(m[ofs+4:ofs+4+size])
+            ofs += 4 + size
+        return paths
+
+    def _find_base_node_paths(self, node):
+        lo, hi = 0, self._nodes
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (dev, ino, ofs, n) = self._base_node(mid)
+            c = cmp((dev, ino), node)
+            if c < 0:
+                lo = mid + 1
+            elif c > 0:
+                hi = mid
+            else:
+                return self._base_node_paths(ofs, n)
+        return []
+
+    def _find_base_path_node(self, path):
+        lo, hi = 0, self._paths
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (p, node) = self._base_path(mid)
+            if p < path:
+                lo = mid + 1
+            elif p > path:
+                hi = mid
+            else:
+                return node
+        return None
+
+    def _iter_merged_nodes(self):
+        changed = sorted(self._node_paths.iteritems())
+        ci = 0
+        for i in xrange(self._nodes):
+            (dev, ino, ofs, n) = self._base_node(i)
+            node = (dev, ino)
+            while ci < len(changed) and changed[ci][0] < node:
+                yield changed[ci]
+                ci += 1
+            if ci < len(changed) and changed[ci][0] == node:
+                yield changed[ci]
+                ci += 1
+            else:
+                yield node, self._base_node_paths(ofs, n)
+        for item in changed[ci:]:
+            yield item
+
+    def _iter_merged_paths(self):
+        changed = sorted(self._path_node.iteritems())
+        ci = 0
+        for i in xrange(self._paths):
+            (path, node) = self._base_path(i)
+            while ci < len(changed) and changed[ci][0] < path:
+                yield changed[ci]
+                ci += 1
+            if ci < len(changed) and changed[ci][0] == path:
+                yield changed[ci]
+                ci += 1
+            else:
+                yield path, node
+        for item in changed[ci:]:
+            yield item
+
+    def _write_base(self, f):
+        """Write the base file merged with all of the changes to f.
+        Return the number of paths written."""
+        nodes = paths = 0
+        data_ofs = 0
+        node_f = tempfile.TemporaryFile()
+        path_f = tempfile.TemporaryFile()
+        data_f = tempfile.TemporaryFile()
+        try:
+            for (dev, ino), link_paths in self._iter_merged_nodes():
+                if not link_paths:
+                    continue
+                node_f.write(struct.pack(NODE_SIG, dev, ino, data_ofs,
+                                         len(link_paths)))
+                for path in link_paths:
+                    data_f.write(struct.pack('!I', len(path)))
+                    data_f.write(path)
+                    data_ofs += 4 + len(path)
+                nodes += 1
+            for path, node in self._iter_merged_paths():
+                if not node:
+                    continue
+                path_f.write(struct.pack(PATH_SIG, data_ofs, len(path),
+                                         node[0], node[1]))
+                data_f.write(path)
+                data_ofs += len(path)
+                paths += 1
+            f.write(HLINK_HDR)
+            f.write(struct.pack(HLINK_SIG, os.urandom(8), nodes, paths))
+            for tmp in (node_f, path_f, data_f):
+                tmp.seek(0)
+                shutil.copyfileobj(tmp, f)
+        finally:
+            node_f.close()
+            path_f.close()
+            data_f.close()
+        return paths
 
     def prepare_save(self):
         """ Commit all of the relevant data to disk.  Do as much work
         as possible without actually making the changes visible."""
         if self._save_prepared:
             raise Error('save of %r already in progress' % self._filename)
-        if self._node_paths:
+        if self._changed_nodes or self._changed_paths or self._merge:
+            changes = self._encode_changes()
+            log_len = max(self._log_len, LOG_HDRLEN) + 4 + len(changes) + 20
+            if log_len > max(max_log_size, len(self._m) * max_log_fraction):
+                self._merge = True
             (dir, name) = os.path.split(self._filename)
             (ffd, self._tmpname) = tempfile.mkstemp('.tmp', name, dir)
             try:
@@ -46,14 +290,22 @@ class HLinkDB:
                     os.close(ffd)
                     raise
                 try:
-                    cPickle.dump(self._node_paths, f, 2)
+                    if self._merge:
+                        if not self._write_base(f):
+                            os.unlink(self._tmpname)
+                            self._tmpname = None
+                    else:
+                        f.write(struct.pack('!I', len(changes)))
+                        f.write(changes)
+                        f.write(Sha1(changes).digest())
                 finally:
                     f.close()
                     f = None
             except:
                 tmpname = self._tmpname
                 self._tmpname = None
-                os.unlink(tmpname)
+                if tmpname:
+                    os.unlink(tmpname)
                 raise
         self._save_prepared = True
 
@@ -61,17 +313,27 @@ class HLinkDB:
         if not self._save_prepared:
             raise Error('cannot commit save of %r; no save prepared'
                         % self._filename)
-        if self._tmpname:
-            os.rename(self._tmpname, self._filename)
+        if self._merge:
+            if self._tmpname:
+                os.rename(self._tmpname, self._filename)
+                self._tmpname = None
+            else: # No data -- delete _filename if it exists.
+                unlink(self._filename)
+            # A leftover log won't match the new base file's id.
+            unlink(self._logname)
+        elif self._tmpname:
+            with open(self._logname, 'ab+') as f:
+                f.seek(0)
+                if f.read(LOG_HDRLEN) != LOG_HDR + self._id \
+                        or self._log_len < LOG_HDRLEN:
+                    self._log_len = 0
+                f.truncate(self._log_len)
+                if not self._log_len:
+                    f.write(LOG_HDR + self._id)
+                with open(self._tmpname, 'rb') as tmp:
+                    shutil.copyfileobj(tmp, f)
+            os.unlink(self._tmpname)
             self._tmpname = None
-        else: # No data -- delete _filename if it exists.
-            try:
-                os.unlink(self._filename)
-            except OSError as e:
-                if e.errno == errno.ENOENT:
-                    pass
-                else:
-                    raise
         self._save_prepared = None
 
     def abort_save(self):
@@ -82,35 +344,48 @@ class HLinkDB:
     def __del__(self):
         self.abort_save()
 
+    def _changeable_paths(self, node):
+        paths = self._node_paths.get(node)
+        if paths is None:
+            paths = self._node_paths[node] = self._find_base_node_paths(node)
+        self._changed_nodes.add(node)
+        return paths
+
     def add_path(self, path, dev, ino):
-        # Assume path is new.
-        node = '%s:%s' % (dev, ino)
+        """Record path as a link to (dev, ino), moving it from the
+        node it was recorded for before, if any."""
+        node = (dev, ino)
+        prev_node = self.path_node(path)
+        if prev_node == node:
+            return
+        if prev_node:
+            self.del_path(path)
+        self._changeable_paths(node).append(path)
         self._path_node[path] = node
-        link_paths = self._node_paths.get(node)
-        if link_paths and path not in link_paths:
-            link_paths.append(path)
-        else:
-            self._node_paths[node] = [path]
-
-    def _del_node_path(self, node, path):
-        link_paths = self._node_paths[node]
-        link_paths.remove(path)
-        if not link_paths:
-            del self._node_paths[node]
+        self._changed_paths.add(path)
 
     def change_path(self, path, new_dev, new_ino):
-        prev_node = self._path_node.get(path)
-        if prev_node:
-            self._del_node_path(prev_node, path)
-        self.add_path(new_dev, new_ino, path)
+        self.add_path(path, new_dev, new_ino)
 
     def del_path(self, path):
         # Path may not be in db (if updating a pre-hardlink support index).
-        node = self._path_node.get(path)
+        node = self.path_node(path)
         if node:
-            self._del_node_path(node, path)
-            del self._path_node[path]
+            self._changeable_paths(node).remove(path)
+            self._path_node[path] = None
+            self._changed_paths.add(path)
+
+    def path_node(self, path):
+        """Return the (dev, ino) of path, or None if it's not in the db."""
+        if path in self._path_node:
+            return self._path_node[path]
+        return self._find_base_path_node(path)
 
     def node_paths(self, dev, ino):
-        node = '%s:%s' % (dev, ino)
-        return self._node_paths[node]
+        node = (dev, ino)
+        paths = self._node_paths.get(node)
+        if paths is None:
+            paths = self._find_base_node_paths(node)
+        if not paths:
+            raise KeyError('%s:%s' % node)
+        return paths
@@ -1,4 +1,5 @@
-import metadata, os, stat, struct, tempfile
+import errno, metadata, os, shutil, stat, struct, tempfile
+from io import BytesIO
 from bup import xstat
 from bup.helpers import *
 
@@ -23,6 +24,7 @@ FOOTLEN = struct.calcsize(FOOTER_SIG)
 IX_EXISTS = 0x8000        # file exists on filesystem
 IX_HASHVALID = 0x4000     # the stored sha1 matches the filesystem
 IX_SHAMISSING = 0x2000    # the stored sha1 object doesn't seem to exist
+IX_METAVALID = 0x1000     # the stored metadata (meta_ofs) matches the filesystem
 
 class Error(Exception):
     pass
@@ -46,40 +48,178 @@ class MetaStoreReader:
         return metadata.Metadata.read(self._file)
 
 
+# bupindex.meta.idx is an open addressing hash table (with linear
+# probing) mapping the sha1 of each bupindex.meta record to its offset,
+# so that opening the metastore doesn't require reading the whole
+# .meta file.  The header records how much of the .meta file the
+# table covers, and whether a writer had it open (and so might have
+# left it inconsistent with the .meta file).
+META_IDX_HDR = 'BUPM\0\0\0\1'
+META_IDX_SIG = '!QQII'  # .meta length covered, entries, log2(slots), dirty
+META_IDX_HDRLEN = len(META_IDX_HDR) + struct.calcsize(META_IDX_SIG)
+META_IDX_SLOT = '!20sQ'  # sha1, offset + 1 (0 marks an empty slot)
+META_IDX_SLOTLEN = struct.calcsize(META_IDX_SLOT)
+
+
+class MetaStoreIdx:
+    def __init__(self, filename, bits=10):
+        self.filename = filename
+        self.map = None
+        try:
+            f = open(filename, 'r+b')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            f = None
+        if f:
+            if f.read(len(META_IDX_HDR)) == META_IDX_HDR:
+                self.map = mmap_readwrite(f)
+                (self.meta_len, self.count, self.bits, self.dirty) = \
+                    struct.unpack_from(META_IDX_SIG, self.map,
+                                       len(META_IDX_HDR))
+                if len(self.map) != META_IDX_HDRLEN \
+                                    + (META_IDX_SLOTLEN << self.bits):
+                    self.map.close()
+                    self.map = None
+            else:
+                f.close()
+            if not self.map:
+                log('warning: %s: invalid, rebuilding it\n' % filename)
+        if not self.map:
+            self._create(filename, bits)
+
+    def _create(self, filename, bits):
+        with atomically_replaced_file(filename, 'w+b') as f:
+            f.write(META_IDX_HDR)
+            f.write(struct.pack(META_IDX_SIG, 0, 0, bits, 0))
+            f.truncate(META_IDX_HDRLEN + (META_IDX_SLOTLEN << bits))
+        if self.map:
+            self.map.close()
+        self.map = mmap_readwrite(open(filename, 'r+b'))
+        (self.meta_len, self.count, self.bits, self.dirty) = (0, 0, bits, 0)
+
+    def __del__(self):
+        self.close()
+
+    def _write_header(self):
+        struct.pack_into(META_IDX_SIG, self.map, len(META_IDX_HDR),
+                         self.meta_len, self.count, self.bits, self.dirty)
+
+    def set_dirty(self, dirty):
+        self.dirty = dirty and 1 or 0
+        self._write_header()
+        self.map.flush(0, META_IDX_HDRLEN)
+
+    def clear(self):
+        """Forget every entry, e.g. because the .meta file was replaced."""
+        self._create(self.filename, 10)
+
+    def _slot(self, digest):
+        """Return the position of digest's slot, or of the empty slot
+        where it belongs, and the offset stored there (or None)."""
+        m = self.map
+        mask = (1 << self.bits) - 1
+        i = struct.unpack('!Q', digest[:8])[0] >> (64 - self.bits)
+        while 1:
+            pos = META_IDX_HDRLEN + i * META_IDX_SLOTLEN
+            ofs = struct.unpack_from('!Q', m, pos + 20)[0]
+            if not ofs:
+                return pos, None
+            if m[pos:pos+20] == digest:
+                return pos, ofs - 1
+            i = (i + 1) & mask
+
+    def get(self, digest):
+        return self._slot(digest)[1]
+
+    def add(self, digest, ofs):
+        if (self.count + 1) * 2 > (1 << self.bits):
+            self._grow()
+        pos, old = self._slot(digest)
+        if old is None:
+            struct.pack_into(META_IDX_SLOT, self.map, pos, digest, ofs + 1)
+            self.count += 1
+
+    def _grow(self):
+        old = self.map
+        entries = []
+        for pos in xrange(META_IDX_HDRLEN, len(old), META_IDX_SLOTLEN):
+            (digest, ofs) = struct.unpack_from(META_IDX_SLOT, old, pos)
+            if ofs:
+                entries.append((digest, ofs - 1))
+        (meta_len, dirty) = (self.meta_len, self.dirty)
+        self._create(self.filename, self.bits + 1)
+        (self.meta_len, self.dirty) = (meta_len, dirty)
+        for digest, ofs in entries:
+            pos = self._slot(digest)[0]
+            struct.pack_into(META_IDX_SLOT, self.map, pos, digest, ofs + 1)
+        self.count = len(entries)
+        self._write_header()
+
+    def close(self):
+        if self.map:
+            self._write_header()
+            self.map.flush()
+            self.map.close()
+            self.map = None
+
+
 class MetaStoreWriter:
     # For now, we just append to the file, and try to handle any
     # truncation or corruption somewhat sensibly.
 
     def __init__(self, filename):
-        # Map metadata hashes to bupindex.meta offsets.
-        self._offsets = {}
         self._filename = filename
         self._file = None
-        # FIXME: see how slow this is; does it matter?
-        m_file = open(filename, 'ab+')
-        try:
-            m_file.seek(0)
-            try:
-                m_off = m_file.tell()
-                m = metadata.Metadata.read(m_file)
-                while m:
-                    m_encoded = m.encode()
-                    self._offsets[m_encoded] = m_off
-                    m_off = m_file.tell()
-                    m = metadata.Metadata.read(m_file)
-            except EOFError:
-                pass
-            except:
-                log('index metadata in %r appears to be corrupt' % filename)
-                raise
-        finally:
-            m_file.close()
+        self._idx = None
+        if os.path.exists(filename + '.compacting'):
+            raise Error('%r is being compacted; run "bup index" to finish'
+                        % filename)
+        # Lots of paths have exactly the same (encoded) metadata, so
+        # remember the last few records.
+        self._recent = {}
         self._file = open(filename, 'ab')
+        self._end = os.fstat(self._file.fileno()).st_size
+        self._idx = MetaStoreIdx(filename + '.idx')
+        if self._idx.dirty or self._idx.meta_len > self._end:
+            # Someone didn't finish writing, or the .meta file has
+            # been replaced; start over.
+            self._idx.clear()
+        if self._idx.meta_len < self._end:
+            self._add_records(self._idx.meta_len)
+        self._idx.meta_len = self._end
+        self._idx.set_dirty(True)
+
+    def _add_records(self, start):
+        """Add the records from start to the end of the file (written by
+        an older bup, say) to the index."""
+        with open(self._filename, 'rb') as f:
+            f.seek(start)
+            data = f.read()
+        port = BytesIO(data)
+        ofs = 0
+        try:
+            while 1:
+                metadata.Metadata.read(port)
+                end = port.tell()
+                self._idx.add(Sha1(data[ofs:end]).digest(), start + ofs)
+                ofs = end
+        except EOFError:
+            pass
+        except:
+            log('index metadata in %r appears to be corrupt'
+                % self._filename)
+            raise
 
     def close(self):
         if self._file:
             self._file.close()
             self._file = None
+        if self._idx:
+            self._idx.meta_len = self._end
+            self._idx.set_dirty(False)
+            self._idx.close()
+            self._idx = None
 
     def __del__(self):
         # Be optimistic.
@@ -87,15 +227,118 @@ class MetaStoreWriter:
 
     def store(self, metadata):
         meta_encoded = metadata.encode(include_path=False)
-        ofs = self._offsets.get(meta_encoded)
-        if ofs:
+        ofs = self._recent.get(meta_encoded)
+        if ofs is not None:
             return ofs
-        ofs = self._file.tell()
-        self._file.write(meta_encoded)
-        self._offsets[meta_encoded] = ofs
+        digest = Sha1(meta_encoded).digest()
+        ofs = self._idx.get(digest)
+        if ofs is None:
+            ofs = self._end
+            self._file.write(meta_encoded)
+            self._end += len(meta_encoded)
+            self._idx.add(digest, ofs)
+        if len(self._recent) >= 1000:
+            self._recent.clear()
+        self._recent[meta_encoded] = ofs
         return ofs
 
 
+def _compaction_files(indexfile):
+    metafile = indexfile + '.meta'
+    # The new .meta, the new index, and the marker that says they're
+    # being renamed into place.
+    return (metafile, metafile + '.compact', indexfile + '.compact',
+            metafile + '.compacting')
+
+
+def recover_compaction(indexfile):
+    """Finish, or undo, a compact_metastore() of indexfile that was
+    interrupted while it was replacing the files, so that the index
+    and its .meta agree again.  Return true if there was one."""
+    (metafile, new_meta, new_index, marker) = _compaction_files(indexfile)
+    if not os.path.exists(marker):
+        return False
+    if os.path.exists(new_meta):
+        # Nothing had been replaced yet.
+        unlink(new_meta)
+        unlink(new_index)
+    elif os.path.exists(new_index):
+        # The new .meta was in place, but the index wasn't.
+        os.rename(new_index, indexfile)
+    unlink(metafile + '.idx')
+    unlink(marker)
+    return True
+
+
+def compact_metastore(indexfile):
+    """Rewrite indexfile's .meta file so that it only contains the
+    records the index refers to, and update the index to match.
+    Return the sizes of the old and new .meta files."""
+    recover_compaction(indexfile)
+    (metafile, new_meta, new_index, marker) = _compaction_files(indexfile)
+    ri = Reader(indexfile)
+    try:
+        have_index = bool(ri.exists())
+        offsets = set(e.meta_ofs for e in ri.forward_iter())
+    finally:
+        ri.close()
+    try:
+        old_size = os.path.getsize(metafile)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return 0, 0
+
+    try:
+        remap = {}
+        new_size = 0
+        with open(metafile, 'rb') as f, open(new_meta, 'wb') as out:
+            seen = {}
+            for ofs in sorted(offsets):
+                f.seek(ofs)
+                try:
+                    metadata.Metadata.read(f)
+                except EOFError:
+                    raise Error('%s: no metadata at offset %d'
+                                % (metafile, ofs))
+                n = f.tell() - ofs
+                f.seek(ofs)
+                rec = f.read(n)
+                digest = Sha1(rec).digest()
+                new_ofs = seen.get(digest)
+                if new_ofs is None:
+                    new_ofs = seen[digest] = new_size
+                    out.write(rec)
+                    new_size += n
+                remap[ofs] = new_ofs
+        if have_index:
+            shutil.copyfile(indexfile, new_index)
+            r = Reader(new_index)
+            try:
+                for e in r.forward_iter():
+                    new_ofs = remap[e.meta_ofs]
+                    if new_ofs != e.meta_ofs:
+                        e.meta_ofs = new_ofs
+                        e.repack()
+            finally:
+                r.close()
+    except:
+        unlink(new_meta)
+        unlink(new_index)
+        raise
+    # The two renames can't happen at once, so until the marker is
+    # gone, the index and .meta may not match, and
+    # recover_compaction() must be run (MetaStoreWriter refuses).
+    open(marker, 'wb').close()
+    unlink(metafile + '.idx')
+    os.rename(new_meta, metafile)
+    if have_index:
+        os.rename(new_index, indexfile)
+    unlink(marker)
+    MetaStoreWriter(metafile).close()  # rebuild the .idx
+    return old_size, new_size
+
+
 class Level:
     def __init__(self, ename, parent):
         self.parent = parent
@@ -143,6 +386,14 @@ def _golevel(level, f, ename, newentry, metastore, tmax):
     return level
 
 
+def _racy_ctime(st, tstart):
+    # A change made later in the same second as st's ctime might leave
+    # the ctime as it is (see the notes on timestamp resolution in
+    # bup-index(1)), so nothing read from the path is trustworthy for
+    # long unless its ctime's second is before tstart's.
+    return xstat.fstime_floor_secs(st.st_ctime) * 10**9 >= tstart
+
+
 class Entry:
     def __init__(self, basename, name, meta_ofs, tmax):
         self.basename = str(basename)
@@ -196,12 +447,33 @@ class Entry:
         self.flags |= IX_EXISTS
         self.meta_ofs = meta_ofs
         # Check that the ctime's "second" is at or after tstart's.
-        ctime_sec_in_ns = xstat.fstime_floor_secs(st.st_ctime) * 10**9
-        if ctime_sec_in_ns >= tstart or old != new \
+        racy = _racy_ctime(st, tstart)
+        if racy or old != new \
               or self.sha == EMPTY_SHA or not self.gitmode:
             self.invalidate()
+        if racy:
+            self.flags &= ~IX_METAVALID
+        else:
+            self.flags |= IX_METAVALID
         self._fixup()
-        
+
+    def meta_unchanged(self, st, check_device=True):
+        """Return true if the metadata stored for this entry must still
+        match the path's, given its current stat st.  Changing the
+        owner, mode, ACLs, xattrs, or attrs of a path updates its
+        ctime, and the entry only keeps IX_METAVALID when its ctime
+        was safely before the index run that read the metadata."""
+        f = IX_METAVALID|IX_EXISTS
+        if (self.flags & f) != f:
+            return False
+        return ((not check_device or self.dev == st.st_dev)
+                and self.ino == st.st_ino
+                and self.ctime == st.st_ctime
+                and self.mtime == st.st_mtime
+                and self.size == st.st_size
+                and self.mode == st.st_mode
+                and self.nlink == st.st_nlink)
+
     def _fixup(self):
         self.mtime = self._fixup_time(self.mtime)
         self.ctime = self._fixup_time(self.ctime)
@@ -238,7 +510,7 @@ class Entry:
 
     def set_deleted(self):
         if self.flags & IX_EXISTS:
-            self.flags &= ~(IX_EXISTS | IX_HASHVALID)
+            self.flags &= ~(IX_EXISTS | IX_HASHVALID | IX_METAVALID)
 
     def is_real(self):
         return not self.is_fake()
@@ -488,7 +760,7 @@ class Writer:
         self.level = _golevel(self.level, self.f, ename, entry,
                               self.metastore, self.tmax)
 
-    def add(self, name, st, meta_ofs, hashgen = None):
+    def add(self, name, st, meta_ofs, hashgen = None, tstart = None):
         endswith = name.endswith('/')
         ename = pathsplit(name)
         basename = ename[-1]
@@ -500,6 +772,8 @@ class Writer:
             flags |= IX_HASHVALID
         else:
             (gitmode, sha) = (0, EMPTY_SHA)
+        if st and tstart is not None and not _racy_ctime(st, tstart):
+            flags |= IX_METAVALID
         if st:
             isdir = stat.S_ISDIR(st.st_mode)
             assert(isdir == endswith)
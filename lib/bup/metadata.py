@@ -8,7 +8,7 @@
 from io import BytesIO
 import errno, os, sys, stat, time, pwd, grp, socket, struct
 
-from bup import vint, xstat
+from bup import stats, vint, xstat
 from bup.drecurse import recursive_dirlist
 from bup.helpers import add_error, mkdirp, log, is_superuser, format_filesize
 from bup.helpers import pwd_from_uid, pwd_from_name, grp_from_gid, grp_from_name
@@ -827,6 +827,7 @@ class Metadata:
             and self._same_linux_xattr(other)
 
 
+@stats.timed('metadata')
 def from_path(path, statinfo=None, archive_path=None,
               save_symlinks=True, hardlink_target=None):
     result = Metadata()
@@ -2,7 +2,8 @@ import mmap
 from bup import _helpers
 from bup.helpers import *
 
-MIDX_VERSION = 4
+MIDX_VERSION = 5  # the version written by default
+MIN_MIDX_VERSION = 4  # the oldest version that can be read (or written)
 
 extract_bits = _helpers.extract_bits
 _total_searches = 0
@@ -25,8 +26,8 @@ class PackMidx:
             log('Warning: skipping: invalid MIDX header in %r\n' % filename)
             self.force_keep = True
             return self._init_failed()
-        ver = struct.unpack('!I', self.map[4:8])[0]
-        if ver < MIDX_VERSION:
+        self.version = ver = struct.unpack('!I', self.map[4:8])[0]
+        if ver < MIN_MIDX_VERSION:
             log('Warning: ignoring old-style (v%d) midx %r\n' 
                 % (ver, filename))
             self.force_keep = False  # old stuff is boring  
@@ -45,12 +46,29 @@ class PackMidx:
         self.shatable = buffer(self.map, self.sha_ofs, nsha*20)
         self.which_ofs = self.sha_ofs + 20*nsha
         self.whichlist = buffer(self.map, self.which_ofs, nsha*4)
-        self.idxnames = str(self.map[self.which_ofs + 4*nsha:]).split('\0')
+        names_ofs = self.which_ofs + 4*nsha
+        if ver >= 5:
+            # The pack offset of each object, like a PackIdxV2, with the
+            # number of 64-bit offsets before their table.
+            self.ofs_ofs = names_ofs
+            self.ofstable = buffer(self.map, self.ofs_ofs, nsha*4)
+            count_ofs = self.ofs_ofs + nsha*4
+            ofs64_count = _helpers.firstword(self.map[count_ofs:count_ofs+4])
+            self.ofs64_ofs = count_ofs + 4
+            self.ofs64table = buffer(self.map, self.ofs64_ofs, ofs64_count*8)
+            names_ofs = self.ofs64_ofs + ofs64_count*8
+        else:
+            self.ofs_ofs = self.ofs64_ofs = 0
+            self.ofstable = self.ofs64table = None
+        self.idxnames = str(self.map[names_ofs:]).split('\0')
 
     def __del__(self):
         self.close()
 
     def _init_failed(self):
+        self.version = None
+        self.ofs_ofs = self.ofs64_ofs = 0
+        self.ofstable = self.ofs64table = None
         self.bits = 0
         self.entries = 1
         self.fanout = buffer('\0\0\0\0')
@@ -71,44 +89,73 @@ class PackMidx:
     def _get_idxname(self, i):
         return self.idxnames[self._get_idx_i(i)]
 
+    def _ofs_from_idx(self, i):
+        ofs = struct.unpack('!I', str(buffer(self.ofstable, i*4, 4)))[0]
+        if ofs & 0x80000000:
+            idx64 = ofs & 0x7fffffff
+            ofs = struct.unpack('!Q',
+                                str(buffer(self.ofs64table, idx64*8, 8)))[0]
+        return ofs
+
     def close(self):
         if self.map is not None:
             self.map.close()
             self.map = None
 
+    def _find(self, hash):
+        global _total_searches, _total_steps
+        _total_searches += 1
+        i, steps = _helpers.find_sha(self.shatable, 20, self.fanout,
+                                     self.bits, hash)
+        _total_steps += steps
+        return i
+
     def exists(self, hash, want_source=False):
         """Return nonempty if the object exists in the index files."""
+        i = self._find(hash)
+        if i < 0:
+            return None
+        return want_source and self._get_idxname(i) or True
+
+    def has_offsets(self):
+        """Return true if the midx records where each object is in its
+        pack (i.e. it's at least version 5)."""
+        return self.ofstable is not None
+
+    def find(self, hash):
+        """Return (idx name, pack offset) for the object, or None if it
+        isn't in any of the index files.  The offset is None unless
+        has_offsets()."""
+        i = self._find(hash)
+        if i < 0:
+            return None
+        ofs = self.ofstable is not None and self._ofs_from_idx(i) or None
+        return self._get_idxname(i), ofs
+
+    def find_offset(self, hash):
+        """Return the offset of the object in its pack (see find())."""
+        r = self.find(hash)
+        return r and r[1]
+
+    def exists_many(self, shas):
+        """Return a bitmap (see bitmap_test()) with bit i set if shas[i]
+        exists in the index files."""
+        query, order = sha_batch(shas)
+        found = bytearray((len(shas) + 7) // 8)
+        self._exists_query(query, found)
+        return unsort_bitmap(found, order)
+
+    def _exists_query(self, query, found, want=None):
+        """Set the bit in found for each of the sorted, concatenated
+        shas in query that exists in the index files, and return how
+        many there were (see _helpers.exists_many())."""
         global _total_searches, _total_steps
-        _total_searches += 1
-        want = str(hash)
-        el = extract_bits(want, self.bits)
-        if el:
-            start = self._fanget(el-1)
-            startv = el << (32-self.bits)
-        else:
-            start = 0
-            startv = 0
-        end = self._fanget(el)
-        endv = (el+1) << (32-self.bits)
-        _total_steps += 1   # lookup table is a step
-        hashv = _helpers.firstword(hash)
-        #print '(%08x) %08x %08x %08x' % (extract_bits(want, 32), startv, hashv, endv)
-        while start < end:
-            _total_steps += 1
-            #print '! %08x %08x %08x   %d - %d' % (startv, hashv, endv, start, end)
-            mid = start + (hashv-startv)*(end-start-1)/(endv-startv)
-            #print '  %08x %08x %08x   %d %d %d' % (startv, hashv, endv, start, mid, end)
-            v = self._get(mid)
-            #print '    %08x' % self._num(v)
-            if v < want:
-                start = mid+1
-                startv = _helpers.firstword(v)
-            elif v > want:
-                end = mid
-                endv = _helpers.firstword(v)
-            else: # got it!
-                return want_source and self._get_idxname(mid) or True
-        return None
+        newly, searched, steps = _helpers.exists_many(self.shatable, 20,
+                                                      len(self), query,
+                                                      found, want)
+        _total_searches += searched
+        _total_steps += steps
+        return newly
 
     def __iter__(self):
         for i in xrange(self._fanget(self.entries-1)):
@@ -0,0 +1,170 @@
+"""Cumulative timings and counters for the phases of a save or split.
+
+Each phase (reading, splitting, hashing, compressing, ...) records how
+many times it was entered, and the wall clock and CPU time spent in
+it, by thread, and anything can bump a named counter.  Nothing is recorded unless
+enable() has been called, so the instrumentation is nearly free the
+rest of the time.
+"""
+
+import functools, json, resource, sys, threading, time
+
+
+enabled = False
+
+_lock = threading.Lock()
+_phases = {}    # (name, thread name) -> [calls, wall seconds, cpu seconds]
+_counters = {}
+_start = None
+
+# The CPU time of just the calling thread, so that phases run by worker
+# threads (e.g. save --jobs) aren't charged for each other's work.
+_RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD',
+                         1 if sys.platform.startswith('linux') else None)
+
+def _rusage_cpu(who):
+    ru = resource.getrusage(who)
+    return ru.ru_utime + ru.ru_stime
+
+def _process_cpu():
+    return _rusage_cpu(resource.RUSAGE_SELF)
+
+def _thread_cpu():
+    return _rusage_cpu(_RUSAGE_THREAD)
+
+try:
+    _thread_cpu()
+except (TypeError, ValueError, resource.error):
+    _thread_cpu = _process_cpu
+
+
+class _Phase(object):
+    __slots__ = ('name', 'wall', 'cpu')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.cpu = _thread_cpu()
+        self.wall = time.time()
+
+    def __exit__(self, type, value, traceback):
+        wall = time.time() - self.wall
+        cpu = _thread_cpu() - self.cpu
+        key = (self.name, threading.current_thread().name)
+        with _lock:
+            p = _phases.get(key)
+            if p is None:
+                p = _phases[key] = [0, 0.0, 0.0]
+            p[0] += 1
+            p[1] += wall
+            p[2] += cpu
+
+
+class _NoPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+_no_phase = _NoPhase()
+
+
+def phase(name):
+    """Return a context manager that adds the time spent inside it to
+    the phase called name.  Phases are cumulative, and shouldn't nest,
+    or the time in the inner one will be counted twice."""
+    if not enabled:
+        return _no_phase
+    return _Phase(name)
+
+
+def timed(name):
+    """Return a decorator that adds the time spent in each call of the
+    function to the phase called name."""
+    def decorate(f):
+        @functools.wraps(f)
+        def timed_f(*args, **kwargs):
+            with phase(name):
+                return f(*args, **kwargs)
+        return timed_f
+    return decorate
+
+
+def count(name, n=1):
+    """Add n to the counter called name."""
+    if enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def enable():
+    """Start recording, from scratch."""
+    global enabled, _start
+    with _lock:
+        _phases.clear()
+        _counters.clear()
+    _start = (time.time(), _process_cpu())
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def _index_counters():
+    from bup import bloom, git, midx
+    lookups = dict((name.replace('_', '-'), n)
+                   for name, n in git._lookups.iteritems())
+    lookups.update({'searches': git._total_searches,
+                    'steps': git._total_steps})
+    return {'git': lookups,
+            'midx': {'searches': midx._total_searches,
+                     'steps': midx._total_steps},
+            'bloom': {'searches': bloom._total_searches,
+                      'steps': bloom._total_steps}}
+
+
+def report():
+    """Return everything recorded since enable() as a dict.  Each phase
+    has its totals, and the same for each thread that ran it under
+    'threads'.  The wall clock times of different threads overlap, so
+    with more than one, the total can be more than the elapsed time."""
+    phases = {}
+    with _lock:
+        for (name, thread), (calls, wall, cpu) in _phases.iteritems():
+            p = phases.get(name)
+            if p is None:
+                p = phases[name] = {'calls': 0, 'wall': 0.0, 'cpu': 0.0,
+                                    'threads': {}}
+            p['calls'] += calls
+            p['wall'] += wall
+            p['cpu'] += cpu
+            p['threads'][thread] = {'calls': calls, 'wall': wall, 'cpu': cpu}
+        counters = dict(_counters)
+    result = {'phases': phases,
+              'counters': counters,
+              'index': _index_counters()}
+    if _start:
+        result['wall'] = time.time() - _start[0]
+        result['cpu'] = _process_cpu() - _start[1]
+    return result
+
+
+def write_json(filename, **extra):
+    """Write report(), plus extra, as JSON to filename, or to stdout
+    if filename is '-'."""
+    r = report()
+    r.update(extra)
+    s = json.dumps(r, indent=2, sort_keys=True) + '\n'
+    if filename == '-':
+        sys.stdout.flush()
+        sys.stdout.write(s)
+        sys.stdout.flush()
+    else:
+        with open(filename, 'w') as f:
+            f.write(s)
@@ -16,12 +16,16 @@ def test_bloom():
     ix = Idx()
     ix.name='dummy.idx'
     ix.shatable = ''.join(hashes)
-    for k in (4, 5):
-        b = bloom.create(tmpdir + '/pybuptest.bloom', expected=100, k=k)
+    for blocked, k in ((False, 4), (False, 5), (True, 5), (True, 7)):
+        b = bloom.create(tmpdir + '/pybuptest.bloom', expected=100, k=k,
+                         blocked=blocked)
         b.add_idx(ix)
         WVPASSLT(b.pfalse_positive(), .1)
         b.close()
         b = bloom.ShaBloom(tmpdir + '/pybuptest.bloom')
+        WVPASSEQ(b.blocked, blocked)
+        WVPASSEQ(b.k, k)
+        WVPASSEQ(b.idxnames, ['dummy.idx'])
         all_present = True
         for h in hashes:
             all_present &= b.exists(h)
@@ -31,12 +35,25 @@ def test_bloom():
             if b.exists(h):
                 false_positives += 1
         WVPASSLT(false_positives, 5)
+        others = [os.urandom(20) for i in range(1000)]
+        found = b.exists_many(hashes + others)
+        WVPASS(all(bitmap_test(found, i) for i in range(len(hashes))))
+        WVPASSEQ([bool(bitmap_test(found, i + len(hashes)))
+                  for i in range(len(others))],
+                 [bool(b.exists(h)) for h in others])
         os.unlink(tmpdir + '/pybuptest.bloom')
 
     tf = tempfile.TemporaryFile()
     b = bloom.create('bup.bloom', f=tf, expected=100)
     WVPASSEQ(b.rwfile, tf)
     WVPASSEQ(b.k, 5)
+    tf = tempfile.TemporaryFile()
+    b = bloom.create('bup.bloom', f=tf, expected=1, blocked=True)
+    WVPASSEQ(b.k, bloom.MAX_BLOCKED_K)
+    WVPASSEQ(b.bits, bloom.BLOCK_BITS)
+    WVPASSEQ(b.table_ofs % 64, 0)
+    WVEXCEPT(ValueError, bloom.blocked_bloom_contains, b.map, '\0' * 20,
+             b.bits + 1, b.k)
 
     # Test large (~1GiB) filter.  This may fail on s390 (31-bit
     # architecture), and anywhere else where the address space is
@@ -57,3 +74,41 @@ def test_bloom():
         WVPASSEQ(b.k, 4)
     if wvfailure_count() == initial_failures:
         subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_remove_idxnames():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tbloom-')
+    class Idx:
+        pass
+    idxs = []
+    for i in range(3):
+        ix = Idx()
+        ix.name = 'pack-%d.idx' % i
+        ix.shatable = os.urandom(20 * 10 * (i + 1))
+        idxs.append(ix)
+    name = tmpdir + '/bup.bloom'
+    b = bloom.create(name, expected=100)
+    for ix in idxs:
+        b.add_idx(ix)
+    b.close()
+    bloom.remove_idxnames(name, {'pack-1.idx': 20, 'other.idx': 5})
+    b = bloom.ShaBloom(name)
+    WVPASSEQ(b.idxnames, ['pack-0.idx', 'pack-2.idx'])
+    WVPASSEQ(len(b), 40)
+    WVPASS(b.exists(idxs[1].shatable[:20]))
+    b.close()
+    # The padding left behind doesn't get in the way of more names
+    b = bloom.ShaBloom(name, readwrite=True, expected=10)
+    ix = Idx()
+    ix.name = 'pack-3.idx'
+    ix.shatable = os.urandom(20 * 10)
+    b.add_idx(ix)
+    b.close()
+    b = bloom.ShaBloom(name)
+    WVPASSEQ(b.idxnames, ['pack-0.idx', 'pack-2.idx', 'pack-3.idx'])
+    WVPASSEQ(len(b), 50)
+    b.close()
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
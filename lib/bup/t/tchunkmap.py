@@ -0,0 +1,168 @@
+import errno, hashlib, os, tempfile
+
+from bup import chunkmap, hashsplit
+from bup.helpers import *
+from wvtest import *
+
+
+bup_tmp = os.path.realpath('../../../t/tmp')
+mkdirp(bup_tmp)
+
+
+@wvtest
+def test_with_generations():
+    wg = chunkmap._with_generations
+    WVPASSEQ(wg([], [(0, 7)]), [])
+    WVPASSEQ(wg([(0, 4096, 8192, 0)], [(0, 7)]), [(0, 4096, 8192, 0, 7)])
+    # FIEMAP may merge adjacent items into one extent
+    WVPASSEQ(wg([(0, 4096, 8192, 0), (8192, 40960, 4096, 1)],
+                [(0, 7), (4096, 9), (8192, 9)]),
+             [(0, 4096, 4096, 0, 7), (4096, 8192, 4096, 0, 9),
+              (8192, 40960, 4096, 1, 9)])
+    # Nothing (like a hole) covers the start
+    WVPASSEQ(wg([(0, 4096, 8192, 0)], [(4096, 9)]),
+             [(0, 4096, 4096, 0, 0), (4096, 8192, 4096, 0, 9)])
+
+
+@wvtest
+def test_file_extents():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tchunkmap-')
+    orig = (chunkmap._fiemap, chunkmap._fstatfs_type,
+            chunkmap._btrfs_extent_generations, chunkmap._get_linux_file_attr)
+    try:
+        path = tmpdir + '/data'
+        with open(path, 'wb') as f:
+            f.write('x' * 16384)
+        fs_type = [chunkmap.BTRFS_SUPER_MAGIC]
+        generations = [[(0, 7), (8192, 9)]]
+        def btrfs_extent_generations(fd):
+            if isinstance(generations[0], Exception):
+                raise generations[0]
+            return generations[0]
+        chunkmap._fiemap = lambda fd: [(0, 4096, 16384,
+                                        chunkmap.FIEMAP_EXTENT_LAST)]
+        chunkmap._fstatfs_type = lambda fd: fs_type[0]
+        chunkmap._btrfs_extent_generations = btrfs_extent_generations
+        chunkmap._get_linux_file_attr = lambda path: 0
+        with open(path, 'rb') as f:
+            WVPASSEQ(chunkmap.file_extents(f, path),
+                     [(0, 4096, 8192, chunkmap.FIEMAP_EXTENT_LAST, 7),
+                      (8192, 12288, 8192, chunkmap.FIEMAP_EXTENT_LAST, 9)])
+
+            # Without root, the maps can't be trusted
+            generations[0] = OSError(errno.EPERM, os.strerror(errno.EPERM))
+            WVEXCEPT(chunkmap.Unavailable, chunkmap.file_extents, f, path)
+            generations[0] = OSError(errno.ENOTTY, os.strerror(errno.ENOTTY))
+            WVPASSEQ(chunkmap.file_extents(f, path), None)
+
+            # Neither can other filesystems
+            fs_type[0] = 0xef53
+            WVPASSEQ(chunkmap.file_extents(f, path), None)
+
+            # ...or a bup built without the tree search
+            chunkmap._btrfs_extent_generations = None
+            WVEXCEPT(chunkmap.Unavailable, chunkmap.check_available)
+            WVEXCEPT(chunkmap.Unavailable, chunkmap.file_extents, f, path)
+    finally:
+        (chunkmap._fiemap, chunkmap._fstatfs_type,
+         chunkmap._btrfs_extent_generations,
+         chunkmap._get_linux_file_attr) = orig
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_changed_ranges():
+    cr = chunkmap.changed_ranges
+    WVPASSEQ(cr([], 0, [], 0), [])
+    ext = [(0, 4096, 8192, 0, 5),
+           (8192, 40960, 4096, chunkmap.FIEMAP_EXTENT_LAST, 5)]
+    WVPASSEQ(cr(ext, 12288, ext, 12288), [])
+    # The LAST flag moving doesn't matter
+    ext2 = [(0, 4096, 8192, chunkmap.FIEMAP_EXTENT_LAST, 5),
+            (8192, 40960, 4096, 0, 5)]
+    WVPASSEQ(cr(ext, 12288, ext2, 12288), [])
+    # A rewritten block in the middle of an extent
+    ext2 = [(0, 4096, 4096, 0, 5), (4096, 90000, 1024, 0, 6),
+            (5120, 5120 + 4096, 3072, 0, 5), (8192, 40960, 4096, 0, 5)]
+    WVPASSEQ(cr(ext, 12288, ext2, 12288), [(4096, 5120)])
+    # The same place, written again later
+    ext2 = [(0, 4096, 4096, 0, 5), (4096, 8192, 4096, 0, 6),
+            (8192, 40960, 4096, 0, 5)]
+    WVPASSEQ(cr(ext, 12288, ext2, 12288), [(4096, 8192)])
+    # Growth, and the old tail
+    WVPASSEQ(cr(ext, 10000, ext + [(12288, 70000, 4096, 0, 6)], 16384),
+             [(10000, 16384)])
+    # Delayed allocation is never trusted, and neither are unknown
+    # generations
+    ext2 = [(0, 4096, 8192, chunkmap.FIEMAP_EXTENT_DELALLOC, 5),
+            (8192, 40960, 4096, 0, 0)]
+    WVPASSEQ(cr(ext2, 12288, ext2, 12288), [(0, 12288)])
+    # Holes stay holes
+    WVPASSEQ(cr([(4096, 4096, 4096, 0, 5)], 16384,
+                [(4096, 4096, 4096, 0, 5)], 16384), [])
+    WVPASSEQ(cr([(4096, 4096, 4096, 0, 5)], 16384,
+                [(4096, 4096, 4096, 0, 5), (8192, 9000, 4096, 0, 6)], 16384),
+             [(8192, 12288)])
+
+
+@wvtest
+def test_chunk_maps():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tchunkmap-')
+    old_file_extents = chunkmap.file_extents
+    try:
+        extents = {}
+        chunkmap.file_extents = lambda f, path: extents.get(path)
+        makeblob = lambda b: hashlib.sha1(b).digest()
+        maketree = lambda shalist: hashlib.sha1(repr(shalist)).digest()
+        def plain(path):
+            with open(path, 'rb') as f:
+                return hashsplit.split_to_blob_or_tree(makeblob, maketree, [f],
+                                                       keep_boundaries=False)
+
+        path = tmpdir + '/data'
+        data = os.urandom(4 * 1024 * 1024)
+        with open(path, 'wb') as f:
+            f.write(data)
+        extents[path] = [(0, 1 << 20, len(data), 0, 5)]
+
+        maps = chunkmap.ChunkMaps(tmpdir + '/maps', 1024)
+        def split():
+            with open(path, 'rb') as f:
+                return maps.split_to_blob_or_tree(makeblob, maketree, f, path,
+                                                  lambda sha: True)
+        WVPASSEQ(split(), plain(path))
+        WVPASSEQ(maps.bytes_read, len(data))
+
+        # Rewrite 100 bytes, which the "filesystem" puts elsewhere
+        with open(path, 'r+b') as f:
+            f.seek(2000000)
+            f.write('x' * 100)
+        extents[path] = [(0, 1 << 20, 2000000 - 1904, 0, 5),
+                         (2000000 - 1904, 1 << 30, 4096, 0, 6),
+                         (2002192, (1 << 20) + 2002192, len(data) - 2002192,
+                          0, 5)]
+        maps.bytes_read = 0
+        WVPASSEQ(split(), plain(path))
+        WVPASS(0 < maps.bytes_read < len(data) / 8)
+
+        # Unsupported filesystems drop the map
+        del extents[path]
+        WVPASSEQ(split(), plain(path))
+        WVPASSEQ(os.listdir(tmpdir + '/maps'), [])
+
+        # Maps for files that are gone are pruned
+        extents[path] = [(0, 1 << 20, len(data), 0, 5)]
+        split()
+        WVPASSEQ(len(os.listdir(tmpdir + '/maps')), 1)
+        maps.prune()
+        WVPASSEQ(len(os.listdir(tmpdir + '/maps')), 1)
+        os.unlink(path)
+        maps.prune()
+        WVPASSEQ(os.listdir(tmpdir + '/maps'), [])
+    finally:
+        chunkmap.file_extents = old_file_extents
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
@@ -66,8 +66,8 @@ def test_multiple_suggestions():
            not c.conn.has_input()):
         pass
     rw.new_blob(s2)
-    WVPASS(rw.objcache.exists(s1sha))
-    WVPASS(rw.objcache.exists(s2sha))
+    WVPASS(rw.exists(s1sha))
+    WVPASS(rw.exists(s2sha))
     rw.new_blob(s3)
     WVPASSEQ(len(glob.glob(c.cachedir+IDX_PAT)), 2)
     rw.close()
@@ -1,6 +1,7 @@
-import struct, os, tempfile, time
+import glob, re, struct, os, tempfile, time
+from io import BytesIO
 from subprocess import check_call
-from bup import git
+from bup import bloom, git, hashsplit, midx, stats, vfs
 from bup.helpers import *
 from wvtest import *
 
@@ -115,6 +116,225 @@ def testpacks():
     if wvfailure_count() == initial_failures:
         subprocess.call(['rm', '-rf', tmpdir])
 
+@wvtest
+def test_parallel_new_blobs():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bup_exe
+    chunk = os.urandom(200000)
+    data = chunk + os.urandom(300000) + chunk + chunk[:1000]
+    orig = git.max_pack_objects, hashsplit.BLOB_READ_SIZE
+    packs = {}
+    try:
+        git.max_pack_objects = 10
+        # Many reads, so that the buffer is refilled while the workers
+        # still hold on to blobs in it
+        hashsplit.BLOB_READ_SIZE = 100003
+        for jobs in (1, 4):
+            os.environ['BUP_DIR'] = bupdir = '%s/bup-%d' % (tmpdir, jobs)
+            git.init_repo(bupdir)
+            w = git.PackWriter(jobs=jobs, compression_level=6)
+            tree = hashsplit.split_to_blob_or_tree(w.new_blob, w.new_tree,
+                                                   [BytesIO(data)],
+                                                   keep_boundaries=False,
+                                                   makeblobs=w.new_blobs)
+            w.close()
+            packdir = bupdir + '/objects/pack'
+            packs[jobs] = (tree,
+                           [(name, open(packdir + '/' + name).read())
+                            for name in sorted(os.listdir(packdir))
+                            if name.endswith('.pack')])
+    finally:
+        git.max_pack_objects, hashsplit.BLOB_READ_SIZE = orig
+    WVPASS(len(packs[1][1]) > 1)
+    WVPASSEQ(packs[1][0], packs[4][0])
+    WVPASS(packs[1][1] == packs[4][1])
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_pack_checksums():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bup_exe
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    packdir = bupdir + '/objects/pack'
+    def reread():
+        return stats.report()['counters'].get('pack-reread-bytes', 0)
+    def pack_sizes():
+        return dict((len(git.open_idx(name)), os.path.getsize(name[:-4] + '.pack'))
+                    for name in glob.glob(packdir + '/*.idx'))
+    def clear():
+        for name in glob.glob(packdir + '/*'):
+            os.unlink(name)
+        stats.enable()
+    orig = git.max_pack_objects, git.max_pack_size, git.max_pack_held
+    try:
+        # A small save is checksummed from what's still in memory.
+        clear()
+        w = git.PackWriter()
+        for i in xrange(25):
+            w.new_blob(os.urandom(100))
+        w.close(run_midx=False)
+        WVPASSEQ(sorted(pack_sizes()), [25])
+        WVPASSEQ(reread(), 0)
+
+        # So are packs ended early by their object count.
+        clear()
+        git.max_pack_objects = 10
+        w = git.PackWriter()
+        for i in xrange(25):
+            w.new_blob(os.urandom(100))
+        w.close(run_midx=False)
+        WVPASSEQ(sorted(pack_sizes()), [5, 10])
+        WVPASSEQ(len(glob.glob(packdir + '/*.pack')), 3)
+        WVPASSEQ(reread(), 0)
+        for name in glob.glob(packdir + '/*.idx'):
+            exc('git', 'verify-pack', name)
+
+        # Bigger packs are checksummed as they're written, and only read
+        # back if they don't end up with max_pack_objects objects.
+        clear()
+        git.max_pack_held = 500
+        w = git.PackWriter()
+        for i in xrange(25):
+            w.new_blob(os.urandom(100))
+        w.close(run_midx=False)
+        sizes = pack_sizes()
+        WVPASSEQ(sorted(sizes), [5, 10])
+        WVPASSEQ(len(glob.glob(packdir + '/*.pack')), 3)
+        WVPASSEQ(reread(), sizes[5] - 12 - 20)
+        for name in glob.glob(packdir + '/*.idx'):
+            exc('git', 'verify-pack', name)
+
+        # Packs are still ended by their size where they used to be.
+        clear()
+        git.max_pack_objects = 1000
+        git.max_pack_size = 20000
+        w = git.PackWriter()
+        for i in xrange(58):
+            w.new_blob(os.urandom(1000))
+        w.close(run_midx=False)
+        sizes = pack_sizes()
+        WVPASSEQ(sorted(sizes), [18, 20])
+        WVPASSEQ(len(glob.glob(packdir + '/*.pack')), 3)
+    finally:
+        git.max_pack_objects, git.max_pack_size, git.max_pack_held = orig
+        stats.disable()
+    for name in glob.glob(packdir + '/*.idx'):
+        exc('git', 'verify-pack', name)
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_objcache_updates():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bup_exe
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    packdir = bupdir + '/objects/pack'
+
+    # The objcache survives pack boundaries
+    w = git.PackWriter()
+    sha1 = w.new_blob('one')
+    oc = w.objcache
+    w.breakpoint()
+    sha2 = w.new_blob('two')
+    WVPASS(w.objcache is oc)
+    WVPASS(oc.exists(sha1))
+    WVFAIL(oc.exists(sha2))
+    WVPASS(w.exists(sha2))
+    w.close()
+    WVPASSEQ(w.objcache, None)
+    del oc
+
+    def write_pack(content):
+        w = git.PackWriter(objcache_maker=None)
+        sha = w._write(None, 'blob', content)
+        return sha, w.close(run_midx=False) + '.idx'
+    refreshes = []
+    orig_refresh = git.PackIdxList.refresh
+    def refresh(self, *args, **kwargs):
+        refreshes.append(1)
+        return orig_refresh(self, *args, **kwargs)
+    l = git.PackIdxList(packdir)
+    try:
+        git.PackIdxList.refresh = refresh
+        l.refresh_if_changed()
+        WVPASSEQ(len(refreshes), 0)
+        sha3, idx3 = write_pack('three')
+        l.add_idx(idx3)
+        l.refresh_if_changed()
+        WVPASSEQ(len(refreshes), 0)
+        WVPASS(l.exists(sha3))
+        # Someone else's pack
+        sha4, idx4 = write_pack('four')
+        WVFAIL(l.exists(sha4))
+        l.refresh_if_changed()
+        WVPASSEQ(len(refreshes), 1)
+        WVPASS(l.exists(sha4))
+        # Only the bloom changes
+        exc(bup_exe, 'bloom', '--dir', packdir)
+        WVFAIL(l.bloom)
+        l.refresh_if_changed()
+        WVPASSEQ(len(refreshes), 1)
+        WVPASS(l.bloom)
+        WVFAIL(l.exists('\0' * 20))
+        # A new index the bloom doesn't know about
+        sha5, idx5 = write_pack('five')
+        l.add_idx(idx5)
+        WVFAIL(l.bloom)
+        WVPASS(l.exists(sha5))
+    finally:
+        git.PackIdxList.refresh = orig_refresh
+        del l
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_refresh_replaced_midx():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bup_exe
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    packdir = bupdir + '/objects/pack'
+
+    shas = []
+    idxs = []
+    for i in xrange(4):
+        w = git.PackWriter()
+        shas.append(w.new_blob(str(i)))
+        idxs.append(w.close(run_midx=False) + '.idx')
+    small = []
+    for i, idx in enumerate(idxs):
+        small.append('%s/small-%d.midx' % (packdir, i))
+        exc(bup_exe, 'midx', '-o', small[-1], idx)
+    l = git.PackIdxList(packdir)
+    try:
+        WVPASSEQ(sorted(p.name for p in l.packs), small)
+        # A midx covering all of them makes them redundant, not it.
+        big = packdir + '/big.midx'
+        exc(bup_exe, 'midx', '-o', big, *idxs)
+        l.refresh()
+        WVPASSEQ([p.name for p in l.packs], [big])
+        WVPASSEQ(glob.glob(packdir + '/*.midx'), [big])
+        WVPASS(all([l.exists(sha) for sha in shas]))
+        # Indexes that are gone aren't searched any more.
+        os.unlink(big)
+        l.refresh()
+        WVPASSEQ(sorted(p.name for p in l.packs), sorted(idxs))
+    finally:
+        del l
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
 @wvtest
 def test_pack_name_lookup():
     initial_failures = wvfailure_count()
@@ -144,6 +364,223 @@ def test_pack_name_lookup():
         subprocess.call(['rm', '-rf', tmpdir])
 
 
+@wvtest
+def test_auto_midx_tiers():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bup_exe
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    packdir = git.repo('objects/pack')
+    def midxs():
+        return sorted(glob.glob(packdir + '/*.midx'))
+    def write_packs(n, start):
+        for i in xrange(n):
+            w = git.PackWriter()
+            for j in xrange(1100):
+                w.new_blob('%d %d' % (start + i, j))
+            w.close()
+
+    # Four packs fill the bottom tier, and are merged.
+    write_packs(3, 0)
+    WVPASSEQ(midxs(), [])
+    write_packs(1, 3)
+    first = midxs()
+    WVPASSEQ(len(first), 1)
+    WVPASSEQ(len(git.open_idx(first[0])), 4400)
+    # The next ones don't touch that midx, which is in the tier above,
+    # until there are four more to merge.
+    write_packs(3, 4)
+    WVPASSEQ(midxs(), first)
+    write_packs(1, 7)
+    WVPASSEQ(len(midxs()), 2)
+    WVPASS(first[0] in midxs())
+    r = git.PackIdxList(packdir)
+    WVPASSEQ(len(r.packs), 2)
+    del r
+
+    # Between packs, the merging is done in the background, and it's
+    # finished by the time the writer is closed.
+    orig = git.max_pack_objects, git.verbose
+    try:
+        git.max_pack_objects = 1100
+        git.verbose = 0
+        w = git.PackWriter()
+        for j in xrange(1100 * 8):
+            w.new_blob('background %d' % j)
+        w.close()
+    finally:
+        git.max_pack_objects, git.verbose = orig
+    WVPASS(os.path.exists(packdir + '/bup.lock'))
+    r = git.PackIdxList(packdir)
+    WVPASS(len(r.packs) < 10)
+    WVPASSEQ(sum(len(ix) for ix in r.packs), 1100 * 16)
+    del r
+    # Which packs were merged depends on when the background runs
+    # happened, but there's nothing left to do.
+    before = midxs()
+    exc(bup_exe, 'midx', '--auto')
+    WVPASSEQ(midxs(), before)
+    exc(bup_exe, 'midx', '--check', '-a')
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_bloom_generations():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bup_exe
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    packdir = git.repo('objects/pack')
+    bloomname = packdir + '/bup.bloom'
+    hashes = []
+    def write_pack():
+        w = git.PackWriter()
+        for i in xrange(100):
+            hashes.append(w.new_blob('%d' % len(hashes)))
+        return w.close(run_midx=False) + '.idx'
+    def generations():
+        return [os.path.basename(n) for n in bloom.generations(bloomname)]
+    def check(idx):
+        p = subprocess.Popen([bup_exe, 'bloom', '-c', idx],
+                             stderr=subprocess.PIPE)
+        out = p.stderr.read()
+        WVPASSEQ(p.wait(), 0)
+        return out
+
+    first = write_pack()
+    exc(bup_exe, 'bloom')
+    WVPASSEQ(generations(), ['bup.bloom'])
+    # While its false positive rate stays under the threshold (the
+    # default here), the existing filter is added to in place.
+    second = write_pack()
+    exc(bup_exe, 'bloom')
+    WVPASSEQ(generations(), ['bup.bloom'])
+    # Once it would go over (a tiny threshold here), a new generation
+    # is started for the new objects.
+    third = write_pack()
+    exc(bup_exe, 'bloom', '--max-pfalse', '1e-9')
+    WVPASSEQ(generations(), ['bup.bloom', 'bup.1.bloom'])
+    gen1 = bloom.ShaBloom(packdir + '/bup.1.bloom')
+    WVPASSEQ(gen1.idxnames, [os.path.basename(third)])
+    WVPASS(gen1.bits >= bloom.ShaBloom(bloomname).bits)
+    del gen1
+
+    r = git.PackIdxList(packdir)
+    WVPASS(r.do_bloom)
+    WVPASSEQ(len(r.bloom.blooms), 2)
+    WVPASSEQ(len(r.bloom), 300)
+    WVPASS(all([r.bloom.exists(sha) for sha in hashes]))
+    found = r.exists_many(hashes + ['\0' * 20])
+    WVPASSEQ([bool(bitmap_test(found, i)) for i in xrange(301)],
+             [True] * 300 + [False])
+    maybe = r.bloom.exists_many(hashes)
+    WVPASS(all(bitmap_test(maybe, i) for i in xrange(300)))
+    del r
+    out = check(first)
+    WVPASS('generation 0: 200 objects' in out)
+    WVPASS('generation 1: 100 objects' in out)
+    WVPASS('checking objects/pack/' in out)
+    WVPASS(check(third).endswith('/bup.1.bloom\nAll tests passed.\n'))
+
+    # Once there are MAX_GENERATIONS, they're rebuilt as one
+    for i in xrange(bloom.MAX_GENERATIONS - 2):
+        write_pack()
+        exc(bup_exe, 'bloom', '--max-pfalse', '1e-9')
+    WVPASSEQ(len(generations()), bloom.MAX_GENERATIONS)
+    write_pack()
+    exc(bup_exe, 'bloom', '--max-pfalse', '1e-9')
+    WVPASSEQ(generations(), ['bup.bloom'])
+    WVPASSEQ(len(bloom.ShaBloom(bloomname)), len(hashes))
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_exists_many():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bup_exe
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    packdir = git.repo('objects/pack')
+
+    hashes = []
+    names = []
+    for start in range(0, 40, 10):
+        w = git.PackWriter()
+        for i in range(start, start+10):
+            hashes.append(w.new_blob(str(i)))
+        names.append(w.close(run_midx=False))
+    missing = ['\0'*20, '\xff'*20] + [os.urandom(20) for i in range(20)]
+    shas = []
+    expected = []
+    for i in range(len(missing)):
+        shas += [hashes[i], missing[i]]
+        expected += [True, False]
+    shas += hashes[len(missing):] + [hashes[3]]
+    expected += [True] * (len(hashes) - len(missing) + 1)
+    def bits(found):
+        return [bool(bitmap_test(found, i)) for i in xrange(len(shas))]
+
+    ix = git.open_idx(names[0] + '.idx')
+    WVPASSEQ(bits(ix.exists_many(shas)),
+             [bool(ix.exists(sha)) for sha in shas])
+    WVPASSEQ(bits(ix.exists_many(shas)).count(True), 11)
+    check_call(['git', 'index-pack', '--index-version=1',
+                '-o', tmpdir + '/v1.idx', names[0] + '.pack'])
+    ix1 = git.open_idx(tmpdir + '/v1.idx')
+    WVPASS(isinstance(ix1, git.PackIdxV1))
+    WVPASSEQ(bits(ix1.exists_many(shas)), bits(ix.exists_many(shas)))
+    WVPASSEQ([ix1.find_offset(sha) for sha in shas],
+             [ix.find_offset(sha) for sha in shas])
+    WVPASSEQ(ix.exists_many([]), bytearray())
+
+    r = git.PackIdxList(packdir)
+    WVPASSEQ(len(r.packs), 4)
+    WVPASSEQ(bits(r.exists_many(shas)), expected)
+    orig_hot_packs = git.hot_packs
+    git.hot_packs = 2
+    try:
+        r._hot.clear()
+        before = dict(git._lookups)
+        for i in (0, 10, 0, 20, 10):
+            WVPASS(r.exists(hashes[i]))
+        WVPASSEQ(len(r._hot), 2)
+        WVPASSEQ([r.packs[i].name for i in r._hot],
+                 [names[2] + '.idx', names[1] + '.idx'])
+        WVPASSEQ(git._lookups['hot_hits'] - before['hot_hits'], 1)
+        WVPASSEQ(git._lookups['cold_hits'] - before['cold_hits'], 4)
+        WVPASS(not r.exists(missing[0]))
+        WVPASSEQ(git._lookups['misses'] - before['misses'], 1)
+    finally:
+        git.hot_packs = orig_hot_packs
+    del r
+
+    check_call([bup_exe, 'midx', '-f'])
+    check_call([bup_exe, 'bloom'])
+    r = git.PackIdxList(packdir)
+    WVPASSEQ(len(r.packs), 1)
+    WVPASS(r.bloom)
+    WVPASSEQ(bits(r.exists_many(shas)), expected)
+    WVPASSEQ(bits(r.packs[0].exists_many(shas)), expected)
+    WVPASSEQ([bool(r.packs[0].exists(sha)) for sha in shas], expected)
+    maybe = bits(r.bloom.exists_many(shas))
+    WVPASS(all(maybe[i] for i in xrange(len(shas)) if expected[i]))
+    del r
+
+    w = git.PackWriter()
+    new = w.new_blob('new')
+    found = w.exists_many([missing[0], new, hashes[0]])
+    WVPASSEQ([bool(bitmap_test(found, i)) for i in xrange(3)],
+             [False, True, True])
+    w.abort()
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
 @wvtest
 def test_long_index():
     initial_failures = wvfailure_count()
@@ -160,10 +597,10 @@ def test_long_index():
             0x22334455, 0x66778899, 0x00112233, 0x44556677, 0x88990011)
     pack_bin = struct.pack('!IIIII',
             0x99887766, 0x55443322, 0x11009988, 0x77665544, 0x33221100)
-    idx = list(list() for i in xrange(256))
-    idx[0].append((obj_bin, 1, 0xfffffffff))
-    idx[0x11].append((obj2_bin, 2, 0xffffffffff))
-    idx[0x22].append((obj3_bin, 3, 0xff))
+    idx = git.PackIdxTable()
+    idx.add(obj_bin, 1, 0xfffffffff)
+    idx.add(obj2_bin, 2, 0xffffffffff)
+    idx.add(obj3_bin, 3, 0xff)
     (fd,name) = tempfile.mkstemp(suffix='.idx', dir=git.repo('objects'))
     os.close(fd)
     w.count = 3
@@ -177,6 +614,112 @@ def test_long_index():
         subprocess.call(['rm', '-rf', tmpdir])
 
 
+@wvtest
+def test_midx_offsets():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bup_exe
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    packdir = git.repo('objects/pack')
+
+    idxs = []
+    hashes = []
+    for start in (0, 10, 20):
+        w = git.PackWriter()
+        for i in range(start, start+10):
+            hashes.append(w.new_blob(str(i)))
+        idxs.append(w.close() + '.idx')
+    # There's no pack for this one, but midx doesn't need it.
+    w = git.PackWriter()
+    idx = git.PackIdxTable()
+    for i in range(6):
+        idx.add(Sha1(str(i)).digest(), i, i % 2 and 0xffffffff + i or 100 + i)
+    w.count = 6
+    w._write_pack_idx_v2(packdir + '/pack-long.idx', idx, '\0'*20)
+    idxs.append(packdir + '/pack-long.idx')
+    expected = {}
+    for name in idxs:
+        ix = git.open_idx(name)
+        for sha in ix:
+            expected[str(sha)] = (os.path.basename(name), ix.find_offset(sha))
+    def found(m):
+        return dict((str(sha), m.find(sha)) for sha in m)
+
+    check_call([bup_exe, 'midx', '--format=4', '-o', packdir + '/v4.midx']
+               + idxs[:2])
+    m = midx.PackMidx(packdir + '/v4.midx')
+    WVPASSEQ(m.version, 4)
+    WVFAIL(m.has_offsets())
+    WVPASSEQ(found(m), dict((sha, (name, None))
+                            for sha, (name, ofs) in expected.iteritems()
+                            if name in m.idxnames))
+    m.close()
+
+    # A v4 midx is replaced by its idx files, since it has no offsets,
+    # and a v5 midx isn't.
+    check_call([bup_exe, 'midx', '-o', packdir + '/a.midx',
+                packdir + '/v4.midx', idxs[2]])
+    m = midx.PackMidx(packdir + '/a.midx')
+    WVPASSEQ(m.version, 5)
+    WVPASS(m.has_offsets())
+    WVPASSEQ(sorted(m.idxnames), sorted(os.path.basename(n) for n in idxs[:3]))
+    m.close()
+    check_call([bup_exe, 'midx', '-o', packdir + '/b.midx',
+                packdir + '/a.midx', idxs[3]])
+    m = midx.PackMidx(packdir + '/b.midx')
+    WVPASSEQ(found(m), expected)
+    WVPASSEQ(m.find_offset(hashes[0]), expected[hashes[0]][1])
+    WVPASSEQ(m.find('\0'*20), None)
+    m.close()
+    check_call([bup_exe, 'midx', '--check', packdir + '/b.midx'])
+
+    check_call(['git', 'index-pack', '--index-version=1',
+                '-o', tmpdir + '/v1.idx', idxs[0][:-4] + '.pack'])
+    check_call([bup_exe, 'midx', '-o', tmpdir + '/v1.midx',
+                tmpdir + '/v1.idx', idxs[1]])
+    m = midx.PackMidx(tmpdir + '/v1.midx')
+    names = {os.path.basename(idxs[0]): 'v1.idx',
+             os.path.basename(idxs[1]): os.path.basename(idxs[1])}
+    WVPASSEQ(found(m), dict((sha, (names[name], ofs))
+                            for sha, (name, ofs) in expected.iteritems()
+                            if name in names))
+    m.close()
+
+    # Objects are read straight from the pack, without its idx.
+    r = git.PackReader(packdir)
+    WVPASSEQ(r.get(hashes[3]), ('blob', '3'))
+    WVPASSEQ([p.idx for p in r.packs.values()], [None])
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_pack_idx_table():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    shas = [os.urandom(20) for i in xrange(2000)]
+    shas += [chr(7) + os.urandom(19) for i in xrange(100)]
+    idx = git.PackIdxTable()
+    for i, sha in enumerate(shas):
+        WVFAIL(idx.exists(sha))
+        idx.add(sha, i, i * 100)
+        WVPASS(idx.exists(sha))
+    WVPASSEQ(len(idx), len(shas))
+    WVPASS(all(idx.exists(sha) for sha in shas))
+    WVFAIL(idx.exists('\0' * 20))
+    WVFAIL(idx.exists('\xff' * 20))
+    name = tmpdir + '/t.idx'
+    w = git.PackWriter()
+    w.count = len(shas)
+    w._write_pack_idx_v2(name, idx, '\0' * 20)
+    i = git.PackIdxV2(name, open(name, 'rb'))
+    WVPASS(list(str(sha) for sha in i) == sorted(shas))
+    WVPASS(all(i.find_offset(sha) == n * 100 for n, sha in enumerate(shas)))
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
 @wvtest
 def test_check_repo_or_die():
     initial_failures = wvfailure_count()
@@ -287,6 +830,53 @@ def test_commit_parsing():
         subprocess.call(['rm', '-rf', tmpdir])
 
 
+@wvtest
+def test_pack_reader():
+    initial_failures = wvfailure_count()
+    orig_cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    workdir = tmpdir + '/work'
+    repodir = workdir + '/.git'
+    try:
+        os.environ['GIT_DIR'] = os.environ['BUP_DIR'] = repodir
+        readpipe(['git', 'init', workdir])
+        os.chdir(workdir)
+        lines = ['line %d\n' % i for i in xrange(2000)]
+        for i in xrange(8):
+            lines[i * 97] = 'changed %d\n' % i
+            with open('data', 'w') as f:
+                f.write(''.join(lines))
+            with open('other-%d' % i, 'w') as f:
+                f.write(os.urandom(100 * i))
+            exc('git', 'add', '.')
+            exc('git', '-c', 'user.name=bup test', '-c', 'user.email=bup@test',
+                'commit', '-q', '-m', 'commit %d' % i)
+        exc('git', 'repack', '-q', '-a', '-d', '-f')
+        objs = exo('git', 'rev-list', '--objects', '--all').split('\n')
+        objs = [x.split(' ')[0] for x in objs if x]
+        verify = exo('git', 'verify-pack', '-v',
+                     *glob.glob(repodir + '/objects/pack/*.idx'))
+        WVPASS(re.search(r'chain length = [1-9]', verify))
+        r = git.PackReader(repodir + '/objects/pack')
+        for hexsha in objs:
+            type = exo('git', 'cat-file', '-t', hexsha).strip()
+            content = exo('git', 'cat-file', type, hexsha)
+            WVPASSEQ(r.get(hexsha.decode('hex')), (type, content))
+        WVPASSEQ(r.get('\0' * 20), None)
+
+        git.check_repo_or_die(repodir)
+        cp = git.CatPipe(repodir)
+        it = cp.get(objs[0])
+        WVPASSEQ(it.next(), 'commit')
+        WVPASSEQ(''.join(it), exo('git', 'cat-file', 'commit', objs[0]))
+        WVPASS(cp.packs)
+        WVPASSEQ(''.join(cp.join('HEAD:data')), open('data').read())
+    finally:
+        os.chdir(orig_cwd)
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
 @wvtest
 def test_list_refs():
     initial_failures = wvfailure_count()
@@ -338,3 +928,81 @@ def test_list_refs():
     WVPASSEQ(frozenset(git.list_refs(limit_to_tags=True)), expected_tags)
     if wvfailure_count() == initial_failures:
         subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_git_config():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bup_exe
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    WVPASSEQ(git.git_config_get('bup.chunker'), None)
+    WVPASSEQ(git.git_config_get('pack.indexVersion'), '2')
+    git.git_config_set('bup.chunker', 'fastcdc')
+    WVPASSEQ(git.git_config_get('bup.chunker'), 'fastcdc')
+    WVPASSEQ(git.git_config_get('bup.chunker', repo_dir=bupdir), 'fastcdc')
+
+    # init only changes the chunker before there's any data
+    exc(bup_exe, 'init', '--chunker', 'bupsplit')
+    WVPASSEQ(git.git_config_get('bup.chunker'), 'bupsplit')
+    exc(bup_exe, 'init')
+    WVPASSEQ(git.git_config_get('bup.chunker'), 'bupsplit')
+    exc(bup_exe, 'init', '--chunker', 'fastcdc')
+    data = tmpdir + '/data'
+    with open(data, 'wb') as f:
+        f.write(os.urandom(200000))
+    exc(bup_exe, 'split', '-n', 'data', data)
+    WVEXCEPT(subprocess.CalledProcessError,
+             exc, bup_exe, 'init', '--chunker', 'bupsplit')
+    WVPASSEQ(git.git_config_get('bup.chunker'), 'fastcdc')
+
+    # split uses the repository's chunker, locally and remotely
+    local = exo(bup_exe, 'split', '-b', data)
+    remote = exo(bup_exe, 'split', '-r', ':' + bupdir, '-b', data)
+    WVPASSEQ(local, remote)
+    os.environ['BUP_DIR'] = otherdir = tmpdir + "/other"
+    git.init_repo(otherdir)
+    WVPASS(exo(bup_exe, 'split', '-b', data) != local)
+    WVPASSEQ(exo(bup_exe, 'split', '--noop', '--chunker', 'fastcdc',
+                 '--copy', data), open(data, 'rb').read())
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_mixed_split_settings():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bup_exe
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    data = tmpdir + '/data'
+    with open(data, 'wb') as f:
+        f.write(os.urandom(3 * 1024 * 1024))
+    content = open(data, 'rb').read()
+    exc(bup_exe, 'split', '-n', 'small', data)
+    git.git_config_set('bup.blobbits', '16')
+    git.git_config_set('bup.fanout', '4')
+    exc(bup_exe, 'split', '-n', 'large', data)
+    git.git_config_set('bup.chunker', 'fastcdc')
+    git.git_config_set('bup.blobbits', '11')
+    exc(bup_exe, 'split', '-n', 'tiny', data)
+    for name in ('small', 'large', 'tiny'):
+        WVPASS(exo(bup_exe, 'join', name) == content)
+        top = vfs.RefList(None)
+        f = top.lresolve('/%s/latest/data' % name).open()
+        WVPASS(f.read() == content)
+        f.seek(2000000)
+        WVPASS(f.read(100000) == content[2000000:2100000])
+    WVPASSNE(exo('git', '--git-dir', bupdir, 'rev-parse', 'small^{tree}'),
+             exo('git', '--git-dir', bupdir, 'rev-parse', 'large^{tree}'))
+    out = exo(bup_exe, 'split', '--noop', '--survey', 'blobbits=16',
+              '--survey', 'chunker=bupsplit,blobbits=13', data).split('\n')
+    WVPASSEQ(out[0].split()[0], 'settings')
+    nobjs = [int(line.split()[1]) for line in out[1:4]]
+    WVPASS(nobjs[0] > nobjs[2] > nobjs[1])
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
@@ -1,8 +1,15 @@
+import hashlib, os, subprocess, tempfile
+from array import array
 from io import BytesIO
 
 from wvtest import *
 
 from bup import hashsplit, _helpers, helpers
+from bup.helpers import mkdirp
+
+
+bup_tmp = os.path.realpath('../../../t/tmp')
+mkdirp(bup_tmp)
 
 
 def nr_regions(x, max_count=None):
@@ -79,10 +86,163 @@ def test_uncache_ours_upto():
         hashsplit._fadvise_pages_done = orig_pages_done
 
 
+@wvtest
+def test_buf():
+    buf = hashsplit.Buf(8)
+    f = BytesIO('0123456789abcdef')
+    WVPASSEQ(buf.fill(f, 6), 6)
+    WVPASSEQ(str(buf.peek(4)), '0123')
+    WVPASSEQ(str(buf.get(5)), '01234')
+    WVPASSEQ(buf.used(), 1)
+    WVPASSEQ(buf.fill(f, 6), 6)  # moves '5' to the front
+    WVPASSEQ(len(buf.data), 8)
+    WVPASSEQ(str(buf.peek(buf.used())), '56789ab')
+    buf.put('XYZ')  # grows
+    WVPASSEQ(str(buf.peek(100)), '56789abXYZ')
+    buf.eat(9)
+    WVPASSEQ(buf.fill(f, 6), 4)
+    WVPASSEQ(buf.fill(f, 6), 0)
+    WVPASSEQ(str(buf.get(buf.used())), 'Zcdef')
+    WVPASSEQ(buf.used(), 0)
+
+    # Without reuse, views survive whatever comes next
+    buf = hashsplit.Buf(8, reuse=False)
+    f = BytesIO('0123456789abcdef')
+    WVPASSEQ(buf.fill(f, 6), 6)
+    v = buf.get(5)
+    WVPASSEQ(buf.fill(f, 6), 6)
+    WVPASSEQ(len(buf.data), 8)
+    buf.put('XYZ')
+    WVPASSEQ(str(buf.peek(100)), '56789abXYZ')
+    WVPASSEQ(str(v), '01234')
+
+
 @wvtest
 def test_rolling_sums():
     WVPASS(_helpers.selftest())
 
+
+@wvtest
+def test_find_splits():
+    data = os.urandom(1024 * 1024)
+    for max_blob in (hashsplit.BLOB_MAX, 4096):
+        expected = []
+        pos = 0
+        while 1:
+            ofs, bits = _helpers.splitbuf(buffer(data, pos))
+            if not ofs:
+                break
+            if ofs > max_blob:
+                ofs, level = max_blob, 0
+            else:
+                level = (bits - _helpers.blobbits()) // 4
+            pos += ofs
+            expected.extend((pos, level))
+        WVPASS(len(expected) > 100)
+        WVPASSEQ(list(array('i', _helpers.find_splits(data, max_blob, 4))),
+                 expected)
+    WVPASSEQ(_helpers.find_splits('', 4096, 4), '')
+
+
+@wvtest
+def test_fastcdc():
+    data = os.urandom(1024 * 1024)
+    max_blob = hashsplit.BLOB_MAX
+    find = lambda d: list(array('i', _helpers.fastcdc_find_splits(d, max_blob,
+                                                                 4)))
+    splits = find(data)
+    ends = splits[::2]
+    sizes = [end - start for start, end in zip([0] + ends, ends)]
+    WVPASS(len(ends) > 50)
+    WVPASS(min(sizes) > 2048)
+    WVPASS(max(sizes) <= max_blob)
+    WVPASS(max(splits[1::2]) > 0)
+    WVPASS(len(data) - ends[-1] < max_blob)
+    WVPASS(find(data) == splits)
+    WVPASSEQ(find(''), [])
+
+    # Splitting always starts over at a split point
+    ofs = ends[10]
+    rest = find(data[ofs:])
+    WVPASS([x - ofs for x in ends[11:]] == rest[::2])
+
+    # ...so a change only affects the split points near it
+    mod = data[:100000] + 'x' + data[100000:]
+    mod_ends = [x > 100000 and x - 1 or x for x in find(mod)[::2]]
+    WVPASS(len(set(ends) & set(mod_ends)) > len(ends) - 5)
+
+    # Without any split points, blobs are cut at max_blob
+    WVPASSEQ(find('\0' * (max_blob * 3 + 5))[::2],
+             [max_blob, max_blob * 2, max_blob * 3])
+
+
+@wvtest
+def test_configure():
+    saved = (hashsplit.chunker, hashsplit.blobbits, hashsplit.BLOB_MAX,
+             hashsplit.BLOB_READ_SIZE, hashsplit.fanout, hashsplit.MAX_PER_TREE)
+    try:
+        data = os.urandom(4 * 1024 * 1024)
+        sizes = lambda: [len(b) for b, level
+                         in hashsplit.hashsplit_iter([BytesIO(data)],
+                                                     False, None)]
+        config = {}
+        hashsplit.configure(config.get)
+        WVPASSEQ((hashsplit.blobbits, hashsplit.BLOB_MAX, hashsplit.fanout,
+                  hashsplit.MAX_PER_TREE), (13, 8192 * 4, 16, 256))
+        default = sizes()
+        config['bup.blobbits'] = '16'
+        hashsplit.configure(config.get)
+        WVPASSEQ(hashsplit.BLOB_MAX, 4 << 16)
+        large = sizes()
+        WVPASS(len(large) * 4 < len(default))
+        WVPASS(max(large) > hashsplit.BLOB_MAX / 2)
+        WVPASS(max(large) <= hashsplit.BLOB_MAX)
+        config['bup.blobmax'] = '128k'
+        config['bup.fanout'] = '64'
+        config['bup.treemax'] = '1024'
+        config['bup.chunker'] = 'fastcdc'
+        hashsplit.configure(config.get)
+        WVPASSEQ((hashsplit.chunker, hashsplit.BLOB_MAX, hashsplit.fanout,
+                  hashsplit.MAX_PER_TREE), ('fastcdc', 128 * 1024, 64, 1024))
+        WVPASS(max(sizes()) <= 128 * 1024)
+        for k, v in (('bup.blobbits', '9'), ('bup.blobbits', '21'),
+                     ('bup.blobbits', 'x'), ('bup.blobmax', '1k'),
+                     ('bup.fanout', '1')):
+            bad = dict(config)
+            bad[k] = v
+            WVEXCEPT(ValueError, hashsplit.configure, bad.get)
+        WVEXCEPT(ValueError, _helpers.find_splits, data, 4096, 4, 30)
+        WVPASSEQ(_helpers.find_splits(data, 32768, 4),
+                 _helpers.find_splits(data, 32768, 4, 13))
+    finally:
+        (hashsplit.chunker, hashsplit.blobbits, hashsplit.BLOB_MAX,
+         hashsplit.BLOB_READ_SIZE, hashsplit.fanout,
+         hashsplit.MAX_PER_TREE) = saved
+
+
+@wvtest
+def test_chunker_selection():
+    orig_chunker = hashsplit.chunker
+    try:
+        data = os.urandom(1024 * 1024)
+        sizes = lambda: [len(b) for b, level
+                         in hashsplit.hashsplit_iter([BytesIO(data)],
+                                                     False, None)]
+        config = {}
+        hashsplit.configure(config.get)
+        WVPASSEQ(hashsplit.chunker, 'bupsplit')
+        bupsplit = sizes()
+        config['bup.chunker'] = 'fastcdc'
+        hashsplit.configure(config.get)
+        WVPASSEQ(hashsplit.chunker, 'fastcdc')
+        fastcdc = sizes()
+        WVPASSEQ(sum(fastcdc), len(data))
+        WVPASS(fastcdc != bupsplit)
+        config['bup.chunker'] = 'nonesuch'
+        WVEXCEPT(ValueError, hashsplit.configure, config.get)
+    finally:
+        hashsplit.chunker = orig_chunker
+
 @wvtest
 def test_fanout_behaviour():
 
@@ -97,8 +257,24 @@ def test_fanout_behaviour():
                 return ofs, ord(c)
         return 0, 0
 
-    old_splitbuf = _helpers.splitbuf
-    _helpers.splitbuf = splitbuf
+    # ...and for find_splits(), which reports all of them at once.
+    def find_splits(buf, max_blob, fanbits, blobbits=basebits):
+        splits = array('i')
+        pos = 0
+        while pos < len(buf):
+            ofs, bits = splitbuf(buffer(buf, pos))
+            if not ofs:
+                break
+            if ofs > max_blob:
+                ofs, level = max_blob, 0
+            else:
+                level = (bits - basebits) // fanbits
+            pos += ofs
+            splits.extend((pos, level))
+        return splits.tostring()
+
+    old_find_splits = _helpers.find_splits
+    _helpers.find_splits = find_splits
     old_BLOB_MAX = hashsplit.BLOB_MAX
     hashsplit.BLOB_MAX = 4
     old_BLOB_READ_SIZE = hashsplit.BLOB_READ_SIZE
@@ -124,7 +300,178 @@ def test_fanout_behaviour():
     WVPASSEQ(levels(split_many),
         [(1, 1), (4, 2), (4, 0), (1, 0), (4, 0), (1, 5), (1, 0)])
 
-    _helpers.splitbuf = old_splitbuf
+    _helpers.find_splits = old_find_splits
     hashsplit.BLOB_MAX = old_BLOB_MAX
     hashsplit.BLOB_READ_SIZE = old_BLOB_READ_SIZE
     hashsplit.fanout = old_fanout
+
+
+@wvtest
+def test_resplit_to_blobs():
+    makeblob = lambda b: hashlib.sha1(b).digest()
+    def split(data):
+        return list(hashsplit.split_to_blobs(makeblob, [BytesIO(data)],
+                                             False, None))
+    def resplit(old_data, data, changed):
+        old = [(size, sha, level) for sha, size, level in split(old_data)]
+        before = hashsplit.total_resplit_read
+        sl = list(hashsplit.resplit_to_blobs(makeblob, BytesIO(data),
+                                             len(data), old, len(old_data),
+                                             changed, lambda sha: True))
+        return sl, hashsplit.total_resplit_read - before
+
+    base = os.urandom(2 * 1024 * 1024)
+    WVPASS(len(split(base)) > 10)
+
+    # Nothing changed: nothing is read
+    sl, nread = resplit(base, base, [])
+    WVPASS(sl == split(base))
+    WVPASSEQ(nread, 0)
+
+    # Overwrite some bytes in the middle
+    mod = base[:1000000] + 'x' * 100 + base[1000100:]
+    sl, nread = resplit(base, mod, [(1000000, 1000100)])
+    WVPASS(sl == split(mod))
+    WVPASS(0 < nread < len(mod) / 4)
+
+    # Append to the end
+    mod = base + os.urandom(5000)
+    sl, nread = resplit(base, mod, [(len(base), len(mod))])
+    WVPASS(sl == split(mod))
+    WVPASS(0 < nread < len(mod) / 4)
+
+    # Truncate
+    mod = base[:1500000]
+    sl, nread = resplit(base, mod, [])
+    WVPASS(sl == split(mod))
+    WVPASS(nread < len(mod) / 4)
+
+    # Missing blobs are rewritten
+    sl = list(hashsplit.resplit_to_blobs(makeblob, BytesIO(base), len(base),
+                                         [(size, sha, level) for sha, size, level
+                                          in split(base)], len(base),
+                                         [], lambda sha: False))
+    WVPASS(sl == split(base))
+
+
+@wvtest
+def test_resplit_forced_cuts():
+    # With a tiny BLOB_MAX, most of the blobs are cut at BLOB_MAX, and
+    # where that happens might depend on where the reads end, which
+    # isn't a multiple of BLOB_MAX here...
+    old_BLOB_MAX = hashsplit.BLOB_MAX
+    old_BLOB_READ_SIZE = hashsplit.BLOB_READ_SIZE
+    old_RESPLIT_READ_SIZE = hashsplit.RESPLIT_READ_SIZE
+    hashsplit.BLOB_MAX = 1024
+    hashsplit.BLOB_READ_SIZE = 4103
+    try:
+        blobs = {}
+        def makeblob(b):
+            sha = hashlib.sha1(b).digest()
+            blobs[sha] = str(b)
+            return sha
+        def split(data):
+            return list(hashsplit.split_to_blobs(makeblob, [BytesIO(data)],
+                                                 False, None))
+        def data(seed, size):
+            # The same every time, so that this doesn't depend on luck
+            l = []
+            while len(l) * 20 < size:
+                seed = hashlib.sha1(seed).digest()
+                l.append(seed)
+            return ''.join(l)[:size]
+
+        base = data('base', 1 << 20)
+        old = [(size, sha, level) for sha, size, level in split(base)]
+        WVPASS(len([1 for size, sha, level in old
+                    if size == hashsplit.BLOB_MAX]) > len(old) / 2)
+        # ...but it doesn't
+        hashsplit.BLOB_READ_SIZE = 65536
+        WVPASS(split(base) == [(sha, size, level)
+                               for size, sha, level in old])
+        hashsplit.BLOB_READ_SIZE = 4103
+        hashsplit.RESPLIT_READ_SIZE = 3001
+        for start in range(0, 800000, 100000) + range(12345, 800000, 99991):
+            mod = base[:start] + data('mod', 200000) + base[start + 200000:]
+            sl = list(hashsplit.resplit_to_blobs(makeblob, BytesIO(mod),
+                                                 len(mod), old, len(base),
+                                                 [(start, start + 200000)],
+                                                 lambda sha: True))
+            WVPASS(''.join(blobs[sha] for sha, size, level in sl) == mod)
+            WVPASS(sl == split(mod))
+    finally:
+        hashsplit.BLOB_MAX = old_BLOB_MAX
+        hashsplit.BLOB_READ_SIZE = old_BLOB_READ_SIZE
+        hashsplit.RESPLIT_READ_SIZE = old_RESPLIT_READ_SIZE
+
+
+@wvtest
+def test_sparse_files():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-thashsplit-')
+    name = tmpdir + '/sparse'
+    data = [(0, os.urandom(5000)), (3 << 20, os.urandom(100000)),
+            ((5 << 20) + 7, os.urandom(3)), (9 << 20, 'tail')]
+    with open(name, 'wb') as f:
+        for ofs, x in data:
+            f.seek(ofs)
+            f.write(x)
+    with open(name, 'rb') as f:
+        content = f.read()
+    orig_skip_holes = hashsplit.skip_holes
+    orig_BLOB_MAX = hashsplit.BLOB_MAX
+    orig_BLOB_READ_SIZE = hashsplit.BLOB_READ_SIZE
+    try:
+        def chunks():
+            reads = hashsplit.readfile_iter([hashsplit.open_noatime(name)])
+            blobs = hashsplit.hashsplit_iter([hashsplit.open_noatime(name)],
+                                             False, None)
+            return ([str(x) for x in reads],
+                    [(str(b), level) for b, level in blobs])
+        hashsplit.skip_holes = False
+        before = hashsplit.total_hole_bytes
+        plain_reads, plain_blobs = chunks()
+        WVPASSEQ(hashsplit.total_hole_bytes, before)
+        WVPASSEQ(''.join(plain_reads), content)
+
+        hashsplit.skip_holes = True
+        sparse_reads, sparse_blobs = chunks()
+        WVPASSEQ(''.join(sparse_reads), content)
+        WVPASS(sparse_blobs == plain_blobs)
+        try:
+            fd = os.open(name, os.O_RDONLY)
+            has_holes = os.lseek(fd, 0, hashsplit._SEEK_HOLE) < len(content)
+            os.close(fd)
+        except (TypeError, OSError):
+            has_holes = False
+        if has_holes:
+            WVPASS(hashsplit.total_hole_bytes - before > len(content))
+
+        # With a tiny BLOB_MAX, most blobs are cut at BLOB_MAX, and
+        # where depends on where the reads end, so the holes (which
+        # aren't aligned to the reads here) mustn't end them early.
+        hashsplit.BLOB_MAX = 256
+        hashsplit.BLOB_READ_SIZE = 3 * 4096 + 7
+        with open(name, 'wb') as f:
+            for i in xrange(64):
+                # The same every time, so that this doesn't depend on luck
+                seed = str(i)
+                f.seek(i * 16384 + 4096)
+                for j in xrange(8192 // 16):
+                    seed = hashlib.sha1(seed).digest()
+                    f.write(seed[:16])
+            f.truncate(64 * 16384 + 100)
+        hashsplit.skip_holes = False
+        plain_reads, plain_blobs = chunks()
+        WVPASS(len([1 for b, level in plain_blobs
+                    if len(b) == hashsplit.BLOB_MAX]) > len(plain_blobs) / 2)
+        hashsplit.skip_holes = True
+        sparse_reads, sparse_blobs = chunks()
+        WVPASS(sparse_reads == plain_reads)
+        WVPASS(sparse_blobs == plain_blobs)
+    finally:
+        hashsplit.skip_holes = orig_skip_holes
+        hashsplit.BLOB_MAX = orig_BLOB_MAX
+        hashsplit.BLOB_READ_SIZE = orig_BLOB_READ_SIZE
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
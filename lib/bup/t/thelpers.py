@@ -48,6 +48,17 @@ def test_parse_num():
     WVPASSEQ(pn('1e+9 k'), 1000000000 * 1024)
     WVPASSEQ(pn('-3e-3mb'), int(-0.003 * 1024 * 1024))
 
+@wvtest
+def test_sha_batch():
+    shas = ['c'*20, buffer('a'*20), 'b'*20]
+    query, order = sha_batch(shas)
+    WVPASSEQ(query, 'a'*20 + 'b'*20 + 'c'*20)
+    WVPASSEQ(order, [1, 2, 0])
+    bits = unsort_bitmap(bytearray([0b101]), order)
+    WVPASSEQ([bool(bitmap_test(bits, i)) for i in range(3)],
+             [True, True, False])
+    WVPASSEQ(sha_batch([]), ('', []))
+
 @wvtest
 def test_detect_fakeroot():
     if os.getenv('FAKEROOTKEY'):
@@ -0,0 +1,121 @@
+import cPickle, os, tempfile
+
+from bup import hlinkdb
+from bup.helpers import *
+
+from wvtest import *
+
+bup_tmp = os.path.realpath('../../../t/tmp')
+mkdirp(bup_tmp)
+
+def saved(db):
+    db.prepare_save()
+    db.commit_save()
+
+@wvtest
+def test_hlinkdb():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-thlinkdb-')
+    name = tmpdir + '/hlink'
+
+    db = hlinkdb.HLinkDB(name)
+    WVEXCEPT(KeyError, db.node_paths, 1, 2)
+    db.add_path('/a', 1, 2)
+    db.add_path('/b', 1, 2)
+    db.add_path('/x', 1, 3)
+    db.add_path('/y', 1, 3)
+    db.del_path('/nothing')
+    saved(db)
+    WVPASS(os.path.exists(name + '.log'))
+    WVFAIL(os.path.exists(name))
+
+    db = hlinkdb.HLinkDB(name)
+    WVPASSEQ(db.node_paths(1, 2), ['/a', '/b'])
+    WVPASSEQ(db.node_paths(1, 3), ['/x', '/y'])
+    WVPASSEQ(db.path_node('/y'), (1, 3))
+    size = os.path.getsize(name + '.log')
+    saved(db)  # nothing changed
+    WVPASSEQ(os.path.getsize(name + '.log'), size)
+
+    db = hlinkdb.HLinkDB(name)
+    db.add_path('/a', 1, 2)  # already there
+    db.add_path('/b', 1, 3)  # moved
+    db.del_path('/x')
+    saved(db)
+
+    db = hlinkdb.HLinkDB(name)
+    WVPASSEQ(db.node_paths(1, 2), ['/a'])
+    WVPASSEQ(db.node_paths(1, 3), ['/y', '/b'])
+    WVPASSEQ(db.path_node('/x'), None)
+    WVPASSEQ(db.path_node('/b'), (1, 3))
+
+    # Merge the log into the base file.
+    orig_max = hlinkdb.max_log_size
+    hlinkdb.max_log_size = 0
+    try:
+        db.add_path('/z', 2, 1)
+        saved(db)
+        WVFAIL(os.path.exists(name + '.log'))
+        WVPASS(os.path.exists(name))
+
+        # And keep working from there, via the log.
+        hlinkdb.max_log_size = orig_max
+        db = hlinkdb.HLinkDB(name)
+        WVPASSEQ(db.node_paths(1, 3), ['/y', '/b'])
+        WVPASSEQ(db.node_paths(2, 1), ['/z'])
+        WVPASSEQ(db.path_node('/a'), (1, 2))
+        WVPASSEQ(db.path_node('/x'), None)
+        db.del_path('/a')
+        db.add_path('/c', 2, 1)
+        saved(db)
+        WVPASS(os.path.exists(name + '.log'))
+
+        db = hlinkdb.HLinkDB(name)
+        WVEXCEPT(KeyError, db.node_paths, 1, 2)
+        WVPASSEQ(db.node_paths(2, 1), ['/z', '/c'])
+        WVPASSEQ(db.path_node('/a'), None)
+
+        # A torn record at the end of the log is ignored, and replaced.
+        with open(name + '.log', 'ab') as f:
+            f.write('\0\0\1\0partial')
+        db = hlinkdb.HLinkDB(name)
+        WVPASSEQ(db.node_paths(2, 1), ['/z', '/c'])
+        db.del_path('/z')
+        saved(db)
+        db = hlinkdb.HLinkDB(name)
+        WVPASSEQ(db.node_paths(2, 1), ['/c'])
+
+        # Removing everything removes the files.
+        hlinkdb.max_log_size = 0
+        for path in ('/b', '/c', '/y'):
+            db.del_path(path)
+        saved(db)
+        WVFAIL(os.path.exists(name))
+        WVFAIL(os.path.exists(name + '.log'))
+    finally:
+        hlinkdb.max_log_size = orig_max
+
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_hlinkdb_pickle():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-thlinkdb-')
+    name = tmpdir + '/hlink'
+    with open(name, 'wb') as f:
+        cPickle.dump({'1:2': ['/a', '/b'], '3:4': ['/c', '/d']}, f, 2)
+    db = hlinkdb.HLinkDB(name)
+    WVPASSEQ(db.node_paths(1, 2), ['/a', '/b'])
+    WVPASSEQ(db.path_node('/d'), (3, 4))
+    saved(db)
+    with open(name, 'rb') as f:
+        WVPASSEQ(f.read(len(hlinkdb.HLINK_HDR)), hlinkdb.HLINK_HDR)
+    db = hlinkdb.HLinkDB(name)
+    WVPASSEQ(db.node_paths(1, 2), ['/a', '/b'])
+    WVPASSEQ(db.node_paths(3, 4), ['/c', '/d'])
+    WVPASSEQ(db.path_node('/d'), (3, 4))
+    WVPASSEQ(db.path_node('/e'), None)
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
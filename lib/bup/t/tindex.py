@@ -66,6 +66,58 @@ def eget(l, ename):
         if e.name == ename:
             return e
 
+@wvtest
+def index_metastore():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tindex-')
+    name = tmpdir + '/bupindex.meta'
+    metas = []
+    for i in xrange(3000):
+        m = metadata.from_path(lib_t_dir + '/tindex.py')
+        m.uid = i
+        metas.append(m)
+
+    ms = index.MetaStoreWriter(name)
+    blank_ofs = ms.store(metadata.Metadata())
+    WVPASSEQ(blank_ofs, 0)
+    ofs = [ms.store(m) for m in metas]
+    WVPASSEQ(len(set(ofs)), len(metas))
+    WVPASSEQ([ms.store(m) for m in metas], ofs)  # grown idx
+    ms.close()
+    size = os.path.getsize(name)
+
+    # Reopening shouldn't append anything, and should find records
+    # after the blank one (which reads as None).
+    ms = index.MetaStoreWriter(name)
+    WVPASSEQ(ms.store(metadata.Metadata()), blank_ofs)
+    WVPASSEQ([ms.store(m) for m in metas], ofs)
+    ms.close()
+    WVPASSEQ(os.path.getsize(name), size)
+
+    # Records appended without the .idx, or by a writer that didn't
+    # finish, are found too.
+    os.unlink(name + '.idx')
+    ms = index.MetaStoreWriter(name)
+    WVPASSEQ(ms.store(metas[500]), ofs[500])
+    extra = metadata.from_path(lib_t_dir)
+    extra.uid = 4242
+    extra_ofs = ms.store(extra)
+    ms._file.close()  # die without a close()
+    ms._idx.map.close()
+    ms._idx.map = ms._idx = ms._file = None
+    ms = index.MetaStoreWriter(name)
+    WVPASSEQ(ms.store(extra), extra_ofs)
+    WVPASSEQ(ms.store(metas[7]), ofs[7])
+    ms.close()
+    WVPASSEQ(os.path.getsize(name), extra_ofs + len(extra.encode(False)))
+
+    msr = index.MetaStoreReader(name)
+    WVPASSEQ(msr.metadata_at(ofs[123]).uid, 123)
+    msr.close()
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
 @wvtest
 def index_negative_timestamps():
     initial_failures = wvfailure_count()
@@ -95,6 +147,110 @@ def index_negative_timestamps():
         subprocess.call(['rm', '-rf', tmpdir])
 
 
+@wvtest
+def index_meta_unchanged():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tindex-')
+    foopath = tmpdir + '/foo'
+    open(foopath, 'wb').close()
+    os.chmod(foopath, 0644)
+    st = xstat.lstat(foopath)
+    now = xstat.fstime_floor_secs(st.st_ctime) * 10**9
+    later = now + 10**9
+    tmax = later
+
+    e = index.BlankNewEntry('foo', 0, tmax)
+    e.from_stat(st, 42, later)
+    WVPASS(e.flags & index.IX_METAVALID)
+    WVPASS(e.meta_unchanged(st))
+    os.chmod(foopath, 0600)
+    WVFAIL(e.meta_unchanged(xstat.lstat(foopath)))
+    # Racy: the ctime might not change again this second.
+    e.from_stat(st, 42, now)
+    WVFAIL(e.flags & index.IX_METAVALID)
+    WVFAIL(e.meta_unchanged(st))
+    e.from_stat(st, 42, later)
+    e.set_deleted()
+    WVFAIL(e.meta_unchanged(st))
+
+    w = index.Writer(tmpdir + '/index', index.MetaStoreWriter(tmpdir + '/m'),
+                     tmax)
+    w.add('/foo', st, 42, tstart=later)
+    w.add('/baz', st, 42)
+    w.add('/bar', st, 42, tstart=now)
+    r = w.new_reader()
+    WVPASSEQ([(e.name, e.meta_unchanged(st)) for e in r],
+             [('/foo', True), ('/baz', False), ('/bar', False), ('/', False)])
+    r.close()
+    w.close()
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def index_compaction_recovery():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tindex-')
+    indexfile = tmpdir + '/index'
+    st = xstat.lstat(lib_t_dir + '/tindex.py')
+    tmax = (time.time() - 1) * 10**9
+
+    def uids():
+        msr = index.MetaStoreReader(indexfile + '.meta')
+        r = index.Reader(indexfile)
+        result = [(e.name, msr.metadata_at(e.meta_ofs).uid) for e in r
+                  if e.name != '/']
+        r.close()
+        msr.close()
+        return result
+
+    # Die after the first, and before any, of compact_metastore()'s
+    # renames, and check that either way, the index and .meta agree
+    # again after recovery.
+    orig_rename = os.rename
+    for renames_before_crash in (1, 0):
+        ms = index.MetaStoreWriter(indexfile + '.meta')
+        metas = []
+        for i in xrange(4):
+            m = metadata.from_path(lib_t_dir + '/tindex.py')
+            m.uid = i
+            metas.append(ms.store(m))
+        w = index.Writer(indexfile, ms, tmax)
+        w.add('/foo', st, metas[3])
+        w.add('/bar', st, metas[1])
+        w.close()
+        ms.close()
+        expected = uids()
+        WVPASSEQ(expected, [('/foo', 3), ('/bar', 1)])
+
+        calls = []
+        def crashing_rename(src, dst):
+            if len(calls) == renames_before_crash:
+                raise KeyboardInterrupt()
+            calls.append(src)
+            orig_rename(src, dst)
+        os.rename = crashing_rename
+        try:
+            try:
+                index.compact_metastore(indexfile)
+            except KeyboardInterrupt:
+                pass
+        finally:
+            os.rename = orig_rename
+        WVEXCEPT(index.Error, index.MetaStoreWriter, indexfile + '.meta')
+        WVPASS(index.recover_compaction(indexfile))
+        WVFAIL(index.recover_compaction(indexfile))
+        WVPASSEQ(uids(), expected)
+        index.MetaStoreWriter(indexfile + '.meta').close()
+        WVPASSEQ(sorted(os.listdir(tmpdir)),
+                 ['index', 'index.meta', 'index.meta.idx'])
+        for name in os.listdir(tmpdir):
+            os.unlink(tmpdir + '/' + name)
+
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
 @wvtest
 def index_dirty():
     initial_failures = wvfailure_count()
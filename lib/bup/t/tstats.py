@@ -0,0 +1,96 @@
+import glob, json, os, subprocess, tempfile, threading
+from subprocess import check_call
+from bup import git, stats
+from bup.helpers import *
+from wvtest import *
+
+
+top_dir = os.path.realpath('../../..')
+bup_exe = top_dir + '/bup'
+bup_tmp = top_dir + '/t/tmp'
+
+
+@wvtest
+def test_phases():
+    try:
+        stats.enable()
+        stats.disable()
+        with stats.phase('x'):
+            pass
+        stats.count('n', 5)
+        WVPASSEQ(stats.report()['phases'], {})
+        WVPASSEQ(stats.report()['counters'], {})
+
+        stats.enable()
+        for i in xrange(3):
+            with stats.phase('x'):
+                sum(xrange(100000))
+        stats.count('n', 5)
+        stats.count('n')
+        @stats.timed('y')
+        def work():
+            stats.count('n', 10)
+        threads = [threading.Thread(target=work, name='t%d' % i)
+                   for i in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        r = stats.report()
+        WVPASSEQ(sorted(r['phases']), ['x', 'y'])
+        WVPASSEQ(r['phases']['x']['calls'], 3)
+        WVPASSEQ(r['phases']['y']['calls'], 4)
+        WVPASSEQ(sorted(r['phases']['y']['threads']),
+                 ['t0', 't1', 't2', 't3'])
+        WVPASSEQ(r['phases']['y']['threads']['t2']['calls'], 1)
+        WVPASSEQ(r['phases']['x']['threads'].keys(),
+                 [threading.current_thread().name])
+        WVPASSEQ(r['phases']['x']['threads'].values()[0]['wall'],
+                 r['phases']['x']['wall'])
+        WVPASS(r['phases']['x']['wall'] > 0)
+        WVPASS(r['phases']['x']['wall'] <= r['wall'])
+        WVPASSEQ(r['counters'], {'n': 46})
+        WVPASSEQ(sorted(r['index']), ['bloom', 'git', 'midx'])
+
+        # The phase is recorded even if it raises
+        try:
+            with stats.phase('z'):
+                raise ValueError()
+        except ValueError:
+            pass
+        WVPASSEQ(stats.report()['phases']['z']['calls'], 1)
+
+        stats.enable()
+        WVPASSEQ(stats.report()['phases'], {})
+    finally:
+        stats.disable()
+
+
+@wvtest
+def test_split_stats_json():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tstats-')
+    os.environ['BUP_MAIN_EXE'] = bup_exe
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    data = tmpdir + '/data'
+    with open(data, 'wb') as f:
+        f.write(os.urandom(1024 * 1024))
+    check_call([bup_exe, 'split', '-n', 'x', '--stats-json', tmpdir + '/s',
+                data])
+    with open(tmpdir + '/s') as f:
+        r = json.load(f)
+    WVPASSEQ(r['command'], 'split')
+    WVPASSEQ(r['bytes'], 1024 * 1024)
+    for name in ('read', 'split', 'sha1', 'zlib', 'exists', 'pack-write',
+                 'pack-finish'):
+        WVPASS(name in r['phases'])
+    counters = r['counters']
+    WVPASSEQ(counters['read-bytes'], 1024 * 1024)
+    WVPASSEQ(r['phases']['zlib']['calls'], counters['pack-objects'])
+    WVPASSEQ(r['index']['git']['searches'], r['phases']['exists']['calls'])
+    packs = glob.glob(bupdir + '/objects/pack/*.idx')
+    WVPASSEQ(len(packs), 1)
+    WVPASSEQ(len(git.open_idx(packs[0])), counters['pack-objects'])
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
@@ -116,3 +116,63 @@ def test_bup_lutimes():
     WVPASS(mtime_ts[1] == 0 or mtime_ts[1] == frac_ts[1] * 1000)
     if wvfailure_count() == initial_failures:
         subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_read_dir():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-txstat-')
+    for name in ('b', 'a.x', 'a'):
+        open(tmpdir + '/' + name, 'w').close()
+    os.mkdir(tmpdir + '/a-dir')
+    os.mkdir(tmpdir + '/c')
+    os.symlink('c', tmpdir + '/link')
+    # A second past the end of the times that fit in 64 bits of ns
+    xstat.utime(tmpdir + '/b', (0, (2**63 // 10**9 + 1) * 10**9))
+    xstat.utime(tmpdir + '/a', (0, -10**9 // 2))
+    expected = [('link', xstat.lstat(tmpdir + '/link')),
+                ('c/', xstat.lstat(tmpdir + '/c')),
+                ('b', xstat.lstat(tmpdir + '/b')),
+                ('a.x', xstat.lstat(tmpdir + '/a.x')),
+                ('a-dir/', xstat.lstat(tmpdir + '/a-dir')),
+                ('a', xstat.lstat(tmpdir + '/a'))]
+    WVPASSEQ(expected[2][1].st_mtime, (2**63 // 10**9 + 1) * 10**9)
+    def fields(st):
+        # Reading a directory may change its atime.
+        d = dict(vars(st))
+        del d['st_atime']
+        return d
+    def check(read):
+        st, entries, errors = read(tmpdir)
+        WVPASSEQ(fields(st), fields(xstat.lstat(tmpdir)))
+        WVPASSEQ([name for name, est in entries],
+                 [name for name, est in expected])
+        WVPASSEQ([fields(est) for name, est in entries],
+                 [fields(est) for name, est in expected])
+        WVPASSEQ(errors, [])
+        WVEXCEPT(OSError, read, tmpdir + '/link')
+        WVEXCEPT(OSError, read, tmpdir + '/a')
+        WVEXCEPT(OSError, read, tmpdir + '/missing')
+    check(xstat.read_dir)
+    orig = xstat._bup_read_dir
+    orig_fd_dir = xstat._fd_dir
+    orig_listdir = os.listdir
+    try:
+        xstat._bup_read_dir = False
+        check(xstat.read_dir)
+        xstat._fd_dir = None
+        check(xstat.read_dir)
+        # Without an fd to list through, a directory that's replaced
+        # while it's being read is noticed.
+        def replacing_listdir(path):
+            os.rename(tmpdir + '/c', tmpdir + '/c2')
+            os.rename(tmpdir + '/a-dir', tmpdir + '/c')
+            return orig_listdir(path)
+        os.listdir = replacing_listdir
+        WVEXCEPT(OSError, xstat.read_dir, tmpdir + '/c')
+    finally:
+        os.listdir = orig_listdir
+        xstat._fd_dir = orig_fd_dir
+        xstat._bup_read_dir = orig
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
@@ -1,5 +1,5 @@
 """Enhanced stat operations for bup."""
-import os
+import errno, os
 import stat as pystat
 from bup import _helpers
 
@@ -18,6 +18,13 @@ try:
 except AttributeError as e:
     _bup_lutimes = False
 
+try:
+    _bup_read_dir = _helpers.read_dir
+    _bup_open_dir = _helpers.open_dir
+except AttributeError as e:
+    _bup_read_dir = False
+    _bup_open_dir = False
+
 
 def timespec_to_nsecs((ts_s, ts_ns)):
     return ts_s * 10**9 + ts_ns
@@ -173,3 +180,77 @@ def classification_str(mode, include_exec):
         return '='
     else:
         return ''
+
+
+# Where the fallback read_dir() can name a directory by its open fd,
+# if anywhere.
+_fd_dir = '/proc/self/fd' if os.path.isdir('/proc/self/fd') else None
+
+# Whether open_dir() and read_dir() accept a dir_fd.
+have_dir_fd = bool(_bup_open_dir or _fd_dir)
+
+
+def _at_path(path, dir_fd):
+    if dir_fd is None:
+        return path
+    if not _fd_dir:
+        raise OSError(errno.ENOSYS, 'no way to open relative to a dir_fd',
+                      path)
+    return '%s/%d/%s' % (_fd_dir, dir_fd, path)
+
+
+def open_dir(path, dir_fd=None):
+    """Open the directory at path, relative to the directory open as
+    dir_fd if given, without following a symlink, and return the fd."""
+    if _bup_open_dir:
+        if dir_fd is None:
+            return _bup_open_dir(path)
+        return _bup_open_dir(path, dir_fd)
+    flags = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) \
+        | getattr(os, 'O_NOFOLLOW', 0) | os.O_NDELAY
+    return os.open(_at_path(path, dir_fd), flags)
+
+
+def read_dir(path, dir_fd=None):
+    """Return (st, entries, errors) for the directory at path, relative
+    to the directory open as dir_fd if given, which must not be a
+    symlink: its stat_result, the (name, stat_result) of each entry,
+    lstat()ed relative to it, in reverse sorted order with a '/' on the
+    end of directory names, and (name, OSError) for any entries that
+    couldn't be lstat()ed."""
+    if _bup_read_dir:
+        if dir_fd is None:
+            return _bup_read_dir(path, stat_result)
+        return _bup_read_dir(path, stat_result, dir_fd)
+    path = _at_path(path, dir_fd)
+    flags = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) \
+        | getattr(os, 'O_NOFOLLOW', 0)
+    fd = os.open(path, flags)
+    try:
+        st = fstat(fd)
+        if not pystat.S_ISDIR(st.st_mode):
+            raise OSError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+        # List and lstat() through the fd when possible, so that it's
+        # all the same directory, and otherwise check afterward that
+        # path still names the one that was opened.
+        dir = '%s/%d' % (_fd_dir, fd) if _fd_dir else path
+        entries = []
+        errors = []
+        for n in os.listdir(dir):
+            try:
+                est = lstat(os.path.join(dir, n))
+            except OSError as e:
+                errors.append((n, e))
+                continue
+            if pystat.S_ISDIR(est.st_mode):
+                n += '/'
+            entries.append((n, est))
+        if not _fd_dir:
+            pst = lstat(path)
+            if (pst.st_dev, pst.st_ino) != (st.st_dev, st.st_ino):
+                raise OSError(errno.ENOENT, 'directory replaced while read',
+                              path)
+    finally:
+        os.close(fd)
+    entries.sort(reverse=True)
+    return st, entries, errors
@@ -97,4 +97,29 @@ $(pwd)/src/a/
 $(pwd)/src/a-link
 $(pwd)/src/"
 
+WVSTART "drecurse --jobs"
+WVPASS mkdir -p src/b/d/e src/b/d/f src/ab
+WVPASS touch src/b/d/e/1 src/b/d/f/1 src/ab/1
+WVPASSEQ "$(bup drecurse -j4 src)" "$(bup drecurse src)"
+WVPASSEQ "$(bup drecurse -j2 --exclude src/b/d/e "$(pwd)/src")" \
+    "$(bup drecurse --exclude src/b/d/e "$(pwd)/src")"
+WVPASSEQ "$(bup drecurse -j3 --exclude-rx '/f/$' src)" \
+    "$(bup drecurse --exclude-rx '/f/$' src)"
+
+WVSTART "drecurse --jobs (path longer than PATH_MAX)"
+long="$(printf 'x%.0s' $(seq 200))"
+WVPASS mkdir deep
+deep_path=deep
+(WVPASS cd deep
+ for i in $(seq 25); do
+     WVPASS mkdir "$long-$i"
+     WVPASS cd "$long-$i"
+ done
+ WVPASS touch last) || exit $?
+for i in $(seq 25); do deep_path="$deep_path/$long-$i"; done
+WVPASS test "${#deep_path}" -gt 4096
+WVPASSEQ "$(bup drecurse -j2 deep | head -n 1)" "$deep_path/last"
+WVPASSEQ "$(bup drecurse -j2 deep | wc -l)" 27
+WVPASSEQ "$(bup drecurse -j2 deep)" "$(bup drecurse deep)"
+
 WVPASS rm -rf "$tmpdir"
@@ -124,4 +124,37 @@ WVPASS bup save -r ":$BUP_DIR" -n r-test $D
 WVFAIL bup save -r ":$BUP_DIR/fake/path" -n r-test $D
 WVFAIL bup save -r ":$BUP_DIR" -n r-test $D/fake/path
 
+WVSTART "index --jobs"
+WVPASS bup index -u $D
+expected="$(WVPASS bup index -p $D)" || exit $?
+WVPASS bup index --clear
+WVPASS bup index -u -j4 $D
+WVPASSEQ "$(bup index -p $D)" "$expected"
+WVPASS touch $D/d/y
+WVPASSEQ "$(bup index --check -us -j4 $D)" "$(bup index -s $D)"
+WVPASS rm $D/d/y
+WVPASSEQ "$(bup index -us -j4 $D | grep y)" "D $D/d/y"
+
+WVSTART "index --compact-meta"
+WVPASS bup index --clear
+WVPASS bup index -u $D
+for mode in 600 640 604; do
+    WVPASS chmod $mode $D/a $D/f
+    WVPASS bup index -u $D
+done
+WVPASS bup save -n compact $D
+size="$(WVPASS wc -c < "$BUP_DIR/bupindex.meta")" || exit $?
+expected="$(WVPASS bup index -p $D)" || exit $?
+WVPASS bup index --check --compact-meta
+WVPASSEQ "$(bup index -p $D)" "$expected"
+WVPASS test "$(wc -c < "$BUP_DIR/bupindex.meta")" -lt "$size"
+WVPASS bup index --compact-meta
+WVPASSEQ "$(bup index -um $D)" ""
+# Everything is valid, so this save takes all the metadata from the index.
+WVPASS bup save -n compact $D
+WVPASS bup restore -C restore "compact/latest$(pwd)/$D/a" \
+    "compact/latest$(pwd)/$D/f"
+WVPASSEQ "$(ls -l restore/a | cut -b -10)" "-rw----r--"
+WVPASSEQ "$(ls -l restore/f | cut -b -10)" "-rw----r--"
+
 WVPASS rm -rf "$tmpdir"
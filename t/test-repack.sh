@@ -0,0 +1,61 @@
+#!/usr/bin/env bash
+. ./wvtest-bup.sh || exit $?
+. t/lib.sh || exit $?
+
+set -o pipefail
+
+top="$(WVPASS pwd)" || exit $?
+tmpdir="$(WVPASS wvmktempdir)" || exit $?
+
+export BUP_DIR="$tmpdir/bup"
+export GIT_DIR="$tmpdir/bup"
+
+bup() { "$top/bup" "$@"; }
+packs() { ls "$BUP_DIR"/objects/pack/*.pack | wc -l; }
+
+WVPASS cd "$tmpdir"
+WVPASS bup init
+
+WVSTART "repack"
+for i in 1 2 3 4 5 6; do
+    WVPASS bup random -S$i 100k > data-$i
+    WVPASS bup split -n split-$i data-$i data-1
+done
+WVPASSEQ "$(packs)" 6
+WVPASS test "$(ls "$BUP_DIR"/objects/pack/*.midx | wc -l)" -gt 0
+WVPASSEQ "$(bup repack -n | wc -l)" 6
+WVPASSEQ "$(bup repack -n --smaller-than=1 | wc -l)" 0
+WVPASS bup --debug repack 2> repack.log
+WVPASSEQ "$(packs)" 1
+# The bloom filter was updated, not rebuilt, then or later
+WVFAIL grep regenerating repack.log
+WVPASS bup --debug bloom 2> bloom.log
+WVFAIL grep regenerating bloom.log
+WVPASSEQ "$(ls "$BUP_DIR"/objects/pack/*.midx | wc -l)" 0
+WVPASS git fsck --no-dangling
+for i in 1 2 3 4 5 6; do
+    WVPASS bup join split-$i > out
+    WVPASS cmp out <(cat data-$i data-1)
+done
+WVPASS bup midx --check -a
+WVPASS bup bloom -c $(ls -1 "$BUP_DIR"/objects/pack/*.idx)
+WVPASS bup repack
+WVPASSEQ "$(packs)" 1
+
+WVSTART "repack (deltas, recompression, size limit)"
+WVPASS git repack -a -d -f -q
+WVPASS bup random -S7 100k > data-7
+WVPASS bup split -n split-7 data-7
+WVPASS bup --debug repack -9 --max-pack-objects=20 2> repack.log
+WVPASS test "$(packs)" -gt 1
+WVFAIL grep regenerating repack.log
+WVPASS bup --debug bloom 2> bloom.log
+WVFAIL grep regenerating bloom.log
+WVPASS bup midx --check -a
+WVPASS git fsck --no-dangling
+WVPASS bup join split-2 > out
+WVPASS cmp out <(cat data-2 data-1)
+WVPASS bup join split-7 > out
+WVPASS cmp out data-7
+
+WVPASS rm -rf "$tmpdir"